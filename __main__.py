@@ -2,9 +2,12 @@ from lstore.db import Database
 from lstore.query import Query
 from time import process_time
 from random import choice, randrange
+import tempfile
 
 # Student Id and 4 grades
 db = Database()
+db_dir = tempfile.TemporaryDirectory()
+db.open(db_dir.name)
 grades_table = db.create_table('Grades', 5, 0)
 query = Query(grades_table)
 keys = []
@@ -16,6 +19,16 @@ for i in range(0, 10000):
 insert_time_1 = process_time()
 
 print("Inserting 10k records took:  \t\t\t", insert_time_1 - insert_time_0)
+print("Flushing 10k inserts wrote (bytes):  \t\t", db.bufferpool.flush_all())
+
+# Same 10k rows through the bulk insert path, into a separate table
+bulk_table = db.create_table('BulkGrades', 5, 0)
+bulk_query = Query(bulk_table)
+bulk_insert_time_0 = process_time()
+bulk_query.insert_many([906659671 + i, 93, 0, 0, 0] for i in range(0, 10000))
+bulk_insert_time_1 = process_time()
+print("Bulk inserting 10k records took:  \t\t", bulk_insert_time_1 - bulk_insert_time_0)
+db.bufferpool.flush_all() # Keep the bulk table's pages out of the update flush numbers
 
 # Measuring update Performance
 update_cols = [
@@ -31,6 +44,8 @@ for i in range(0, 10000):
     query.update(choice(keys), *(choice(update_cols)))
 update_time_1 = process_time()
 print("Updating 10k records took:  \t\t\t", update_time_1 - update_time_0)
+# Only the pages touched by the updates (indirection, schema encoding and tail pages) should get written
+print("Flushing 10k updates wrote (bytes):  \t\t", db.bufferpool.flush_all())
 
 # Measuring Select Performance
 select_time_0 = process_time()
@@ -53,4 +68,7 @@ delete_time_0 = process_time()
 for i in range(0, 10000):
     query.delete(906659671 + i)
 delete_time_1 = process_time()
-print("Deleting 10k records took:  \t\t\t", delete_time_1 - delete_time_0)
\ No newline at end of file
+print("Deleting 10k records took:  \t\t\t", delete_time_1 - delete_time_0)
+
+db.close()
+db_dir.cleanup()
@@ -1,10 +1,18 @@
 import os
 import pickle
+import threading
 import time
 import json
-from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Optional
 
+import lstore.config as config
+from lstore.conceptual_page import ConceptualPage
 from lstore.page_range import PageRange
+from lstore.page import PAGE_SIZE
+from lstore.segment import SegmentFile
+from lstore.replacement import ReplacementPolicy, ClockPolicy
 
 
 class Frame:
@@ -21,9 +29,56 @@ class Frame:
         self.table_name: str = table_name
         self.position: int = position
         self.pin = 0
+        # Guards pin and evicted, so a hit can pin the frame without the pool lock and eviction never drops a frame
+        # someone just pinned
+        self.latch = threading.Lock()
+        self.evicted = False
+        self.resident_pages = 0  # Physical pages of this page range that are in memory
 
         self.page_range: PageRange = page_range
 
+    @property
+    def resident_bytes(self) -> int:
+        return self.resident_pages * PAGE_SIZE
+
+    def try_pin(self) -> bool:
+        """
+        Pins the frame unless it has already been evicted
+        """
+        with self.latch:
+            if self.evicted:
+                return False
+            self.pin += 1
+            return True
+
+    def unpin(self):
+        with self.latch:
+            self.pin -= 1
+
+    def __enter__(self):
+        # get_frame hands frames out pinned, the with block only releases that pin at the end
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.unpin()
+
+
+class PageFrame:
+    """
+    One cached physical page. The page itself stays in its ConceptualPage, this is what the bufferpool needs to find
+    it, pin it and write it back
+    """
+
+    def __init__(self, conceptual_page: ConceptualPage, column: int, level: int):
+        self.conceptual_page: ConceptualPage = conceptual_page
+        self.column: int = column
+        self.level: int = level
+        self.pin = 0
+
+    @property
+    def page(self):
+        return self.conceptual_page.pages[self.column].pages[self.level]
+
     def __enter__(self):
         self.pin += 1
         return self
@@ -32,13 +87,74 @@ class Frame:
         self.pin -= 1
 
 
+class RingBuffer:
+    """
+    A small private set of physical pages for one bulk operation, see BufferPool.ring. Pages the operation reads in
+    go into the ring instead of the main pool. Once the ring is full every new page pushes out the oldest one, so a pass
+    over a whole table can't flush out the pages point selects and updates are using.
+    """
+
+    def __init__(self, bufferpool: "BufferPool", size: int):
+        self.bufferpool = bufferpool
+        self.size = size
+        self.keys: OrderedDict = OrderedDict()  # Page keys, oldest first
+        self.previous: Optional[RingBuffer] = None
+
+    def __enter__(self):
+        self.previous = getattr(self.bufferpool.local, "ring", None)
+        self.bufferpool.local.ring = self
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.bufferpool.local.ring = self.previous
+        self.bufferpool.release_ring(self)
+
+
 class BufferPool:
-    def __init__(self, path):
-        self.frame_request_count = 0  # For Most Used
-        self.frames: dict[str, list[Frame]] = {}
-        self.capacity = 16  # M3: Do we need more frames?
+    def __init__(
+        self,
+        path,
+        capacity: int = 64,
+        policy: Optional[ReplacementPolicy] = None,
+        memory_budget: Optional[int] = None,
+        page_policy: Optional[ReplacementPolicy] = None,
+    ):
+        self.frame_request_count = 0  # Every get_frame call, hits and misses
+        # table name -> page range index -> frame, only resident frames are in here
+        self.frames: dict[str, dict[int, Frame]] = {}
+        # Page range frames only hold structure, their pages are what counts against memory_budget
+        self.capacity = capacity
+        # Any ReplacementPolicy works, frames are handed to it keyed by (table name, page range index)
+        self.policy: ReplacementPolicy = policy if policy else ClockPolicy()
+        self.resident = 0  # Number of frames currently in the pool
+        # Physical pages are cached on their own so memory follows the pages queries touch, not the page ranges.
+        # Keys are (table name, page range index, "base" or "tail", conceptual page index, column, level)
+        self.page_frames: dict[tuple, PageFrame] = {}
+        # Bytes of physical pages the pool may keep in memory, config.BUFFERPOOL_BYTES by default
+        self.memory_budget = memory_budget if memory_budget is not None else config.BUFFERPOOL_BYTES
+        self.page_capacity = max(self.memory_budget // PAGE_SIZE, 1)
+        self.page_policy: ReplacementPolicy = page_policy if page_policy else ClockPolicy()
+        self.resident_pages = 0
+        # Taken on a miss, so loading and evicting frames happens one at a time
+        self.lock = threading.RLock()
         self.path = path
         self.next_file_name = 0
+        # Counters behind stats(), reset_stats sets them all to 0
+        self.reset_stats()
+        # Background flusher, see start_flusher
+        self.flusher: Optional[threading.Thread] = None
+        self.flusher_stop = threading.Event()
+        # Read ahead, see prefetch. Started the first time something gets prefetched
+        self.prefetcher: Optional[ThreadPoolExecutor] = None
+        self.prefetching: set[tuple[str, int]] = set()  # (table name, page range index) queued or loading
+        self.last_range: dict[str, int] = {}  # Last page range index asked for, per table
+        # Ring buffer of the bulk operation running on each thread, if any, see ring
+        self.local = threading.local()
+        # (table name, page range index) -> Future of a frame that is being read in right now, see __load_frame
+        self.loading: dict[tuple[str, int], Future] = {}
+        # Checkpoint that writes into existing blocks are undo logged against (see segment.UndoLog), so a crash can be
+        # rolled back to it. Set by the Database, None means no undo logs
+        self.checkpoint_sequence: Optional[int] = None
 
         table_path = os.path.join(self.path, "tables")
         self.table_range_start_indices = {}
@@ -49,7 +165,7 @@ class BufferPool:
                     indices = [
                         int(f.split(".")[0])
                         for f in os.listdir(table_dir)
-                        if f.endswith(".json") and f.split(".")[0].isnumeric()
+                        if (f.endswith(".seg") or f.endswith(".json")) and f.split(".")[0].isnumeric()
                     ]
                     index = max(indices, default=-1)
                     if index > -1:
@@ -58,143 +174,557 @@ class BufferPool:
         pass
 
     def get_frame(self, table_name: str, page_range_index: int, num_columns: int):
-        # TODO: HAS CAPACITY if not evict
-        # TODO: Diego: Very incomplete, list needs to expand to right index and table key needs to be put in at some point possibly here along with an empty expandable list
-        self.frames.setdefault(table_name, [])
-        if table_name in self.frames:
-            frames: list[Frame] = self.frames[table_name]
-            append_count = max(0, page_range_index - len(frames) + 1)
-            frames.extend([None] * append_count)
-            # frame: Frame = frames[page_range_index]
-            frame = frames[page_range_index]
-            if not frame:
-                # print("reading frame from disk")
-                self.read_frame(table_name, page_range_index, num_columns)
-                frame = frames[page_range_index]
-
-            # print(f"frame is {frame}, table name is {table_name}, self frames is {self.frames}\n")    
-            frame.request_count += 1
-            self.last_accessed = time.time()
+        """
+        Returns the frame of a page range, reading it in if it isn't in memory. The frame comes back pinned so it can't
+        be evicted while it's being used, call frame.unpin() (or use it in a with block) when done with it
+        """
+        if self.last_range.get(table_name) != page_range_index:
+            self.__track_sequential(table_name, page_range_index)
+        return self.__get_frame(table_name, page_range_index, num_columns)
+
+    def __get_frame(self, table_name: str, page_range_index: int, num_columns: Optional[int]):
+        table_frames = self.frames.setdefault(table_name, {})
+        self.frame_request_count += 1
+        while True:
+            frame = table_frames.get(page_range_index)
+            if frame:
+                # Hits never take the pool lock, only the frame's latch. If the frame got evicted before we could pin
+                # it we go around again and miss
+                if not frame.try_pin():
+                    continue
+                self.hits += 1
+                self.policy.touch((table_name, page_range_index))
+            else:
+                frame = self.__load_frame(table_name, page_range_index, num_columns)
+                if frame is None:
+                    continue
+            break
+
+        frame.request_count += 1
+        frame.last_accessed = time.time()
+        return frame
+
+    def __track_sequential(self, table_name: str, page_range_index: int):
+        # Moving on to the next page range means the table is being read in order, so load the ones after it early
+        last = self.last_range.get(table_name)
+        self.last_range[table_name] = page_range_index
+        if last is not None and page_range_index == last + 1:
+            self.prefetch(table_name, range(page_range_index + 1, page_range_index + 1 + config.READ_AHEAD), [])
+
+    def prefetch(self, table_name: str, range_indices: Iterable[int], columns: Optional[list[int]] = None) -> list[Future]:
+        """
+        Loads page ranges in the background on the prefetch threads so a scan doesn't have to wait for them. With
+        columns given, the metadata columns and those data columns of every base page get read in as well, unless this
+        thread is reading through a ring: warming pages would only cycle them through the ring ahead of the scan. Page
+        ranges that are already in memory or don't exist on disk are skipped. Returns the futures of the loads that were
+        queued, a load that fails raises from its future and is counted in stats()["prefetch_failures"]
+        """
+        if getattr(self.local, "ring", None) is not None:
+            columns = None
+        futures = []
+        table_frames = self.frames.get(table_name, {})
+        for page_range_index in range_indices:
+            key = (table_name, page_range_index)
+            if page_range_index in table_frames:
+                continue
+            with self.lock:
+                if key in self.prefetching:
+                    continue
+                self.prefetching.add(key)
+                if self.prefetcher is None:
+                    self.prefetcher = ThreadPoolExecutor(config.PREFETCH_WORKERS, thread_name_prefix="prefetch")
+            futures.append(self.prefetcher.submit(self.__prefetch_range, table_name, page_range_index, columns))
+        return futures
+
+    def __prefetch_range(self, table_name: str, page_range_index: int, columns: Optional[list[int]]):
+        try:
+            with self.lock:
+                # Checked again now that it's our turn. If a query already has it in memory or is reading it in there
+                # is nothing left to do, and stepping in could only make room by evicting something
+                if page_range_index in self.frames.get(table_name, {}) or (table_name, page_range_index) in self.loading:
+                    return
+            table_dir = os.path.join(self.path, "tables", table_name)
+            if not os.path.exists(os.path.join(table_dir, f"{page_range_index}.seg")) \
+                    and not os.path.exists(os.path.join(table_dir, f"{page_range_index}.json")):
+                return
+            with self.__get_frame(table_name, page_range_index, None) as frame:
+                if columns is None:
+                    return
+                physical_columns = list(range(config.NUM_META_COLUMNS)) + [config.NUM_META_COLUMNS + column for column in columns]
+                for conceptual_page in frame.page_range.base_pages:
+                    for column in physical_columns:
+                        column_pages = conceptual_page.pages[column]
+                        for level in range(len(column_pages)):
+                            column_pages[level]
+        except Exception:
+            # Counted, and left on the future for whoever is waiting on it. A query that needs this page range loads
+            # it itself and gets the error then
+            self.prefetch_failures += 1
+            raise
+        finally:
+            self.prefetching.discard((table_name, page_range_index))
+
+    def __load_frame(self, table_name: str, page_range_index: int, num_columns: Optional[int]) -> Frame:
+        """
+        Single flight: the first thread to miss on a page range loads it, everyone else who misses on it in the
+        meantime waits for that one load instead of reading their own copy. Loads of different page ranges run at the
+        same time, the pool lock is only held to make room and to put the frame in
+        """
+        key = (table_name, page_range_index)
+        with self.lock:
+            # Another thread might have loaded it while we waited. Frames can only be evicted under the pool lock, so
+            # pinning it here always works
+            frame = self.frames[table_name].get(page_range_index)
+            if frame and frame.try_pin():
+                self.hits += 1
+                return frame
+            self.misses += 1
+            latch = self.loading.get(key)
+            waiting = latch is not None
+            if not waiting:
+                latch = self.loading[key] = Future()
+                # Make room first. If everything left is pinned we go over capacity until something gets unpinned
+                while not self.has_capacity():
+                    if not self.evict_frame():
+                        break
+                # Hold the slot while we read so concurrent loads of other page ranges can't overfill the pool
+                self.resident += 1
+        if waiting:
+            # The loader pinned it for itself, we need our own pin. None means it was evicted again before we got it
+            frame = latch.result()
+            return frame if frame.try_pin() else None
+
+        try:
+            start_time = time.perf_counter()
+            frame = self.read_frame(table_name, page_range_index, num_columns)
+            self.frame_loads += 1
+            self.frame_load_seconds += time.perf_counter() - start_time
+            with self.lock:
+                frame.try_pin()
+                self.frames[table_name][page_range_index] = frame
+                self.policy.admit(key)
+                frame.page_range.attach_cache(self, table_name, page_range_index)
+            latch.set_result(frame)
             return frame
+        except BaseException as e:
+            with self.lock:
+                self.resident -= 1
+            latch.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.loading[key]
+
+    def admit_page(self, conceptual_page: ConceptualPage, column: int, level: int, load_seconds: Optional[float] = None):
+        """
+        Called by a ConceptualPage whenever one of its physical pages comes into memory, either read from disk (then
+        load_seconds is how long that took) or newly allocated. Evicts other pages first if the pool is full
+        """
+        with self.lock:
+            if load_seconds is not None:
+                self.page_loads += 1
+                self.page_load_seconds += load_seconds
+                self.bytes_read += PAGE_SIZE
+            if conceptual_page.cache is not self:
+                # Its page range was evicted while the page was being read
+                return
+            key = conceptual_page.cache_key + (column, level)
+            page_frame = self.page_frames.get(key)
+            if page_frame is not None:
+                # Already counted. Only the page object changes, and the old one goes if it belonged to a stale copy
+                if page_frame.conceptual_page is not conceptual_page:
+                    page_frame.conceptual_page.unload_page(page_frame.column, page_frame.level)
+                    page_frame.conceptual_page = conceptual_page
+                self.page_policy.touch(key)
+                column_pages = conceptual_page.pages[column]
+                column_pages.keys[level] = key
+                column_pages.touch = self.page_policy.touch
+                return
+            ring = getattr(self.local, "ring", None)
+            if ring is not None:
+                # Recycle the ring's oldest page. While the ring is still filling up it takes pages from the pool
+                if len(ring.keys) >= ring.size:
+                    self.__evict_from_ring(ring)
+                elif self.resident_pages >= self.page_capacity:
+                    self.evict_page()
+                ring.keys[key] = None
+            else:
+                while self.resident_pages >= self.page_capacity:
+                    if not self.evict_page():
+                        break
+            self.page_frames[key] = PageFrame(conceptual_page, column, level)
+            self.resident_pages += 1
+            frame = self.frames.get(key[0], {}).get(key[1])
+            if frame is not None:
+                frame.resident_pages += 1
+            if ring is None:
+                self.page_policy.admit(key)
+            column_pages = conceptual_page.pages[column]
+            column_pages.keys[level] = key
+            column_pages.touch = self.page_policy.touch
+
+    def get_page_frame(self, key: tuple) -> Optional[PageFrame]:
+        """
+        Returns the PageFrame of a cached physical page, or None if it isn't in memory. Pin it (with page_frame: ...)
+        to keep the page in memory while its page range isn't pinned
+        """
+        return self.page_frames.get(key)
+
+    def __page_evictable(self, key: tuple) -> bool:
+        return not self.page_frames[key].pin
+
+    def evict_page(self) -> bool:
+        """
+        Evicts the physical page the page policy picks, writing it into its block of the segment first if it is dirty.
+        Pages of pinned page ranges can go too, but not while their conceptual page is loading or writing a page.
+        Returns False if nothing could be evicted
+        """
+        with self.lock:
+            for _ in range(len(self.page_frames)):
+                key = self.page_policy.victim(self.__page_evictable)
+                if key is None:
+                    return False
+                if self.__evict_page(key):
+                    return True
+                # Somebody is writing into it right now, give it another turn
+                self.page_policy.touch(key)
+            return False
+
+    def __evict_page(self, key: tuple) -> bool:
+        # Writes back and drops one page, unless its conceptual page is busy loading or writing
+        conceptual_page = self.page_frames[key].conceptual_page
+        if not conceptual_page.lock.acquire(blocking=False):
+            return False
+        try:
+            self.__write_back_page(key)
+            self.__drop_page(key)
+            self.page_evictions += 1
+        finally:
+            conceptual_page.lock.release()
+        return True
+
+    def ring(self, size: Optional[int] = None) -> RingBuffer:
+        """
+        Access strategy for bulk operations that go over every page range once (create_index, big sums). Use it as
+        "with bufferpool.ring(): ...". Pages the current thread reads in while it's active cycle through a ring of size
+        pages (config.RING_PAGES by default) instead of going into the main pool. Pages that were already cached are
+        used as usual. The ring's pages are dropped when the block ends
+        """
+        return RingBuffer(self, size if size is not None else config.RING_PAGES)
+
+    def __evict_from_ring(self, ring: RingBuffer):
+        # Oldest page first. Pages that are pinned or busy move to the back, pages that already left the pool are skipped
+        for _ in range(len(ring.keys)):
+            key, _ = ring.keys.popitem(last=False)
+            page_frame = self.page_frames.get(key)
+            if page_frame is None:
+                continue
+            if not page_frame.pin and self.__evict_page(key):
+                return
+            ring.keys[key] = None
+
+    def release_ring(self, ring: RingBuffer):
+        """
+        Drops the pages a ring still holds once its operation is done. Pages that can't go right now (pinned or busy)
+        are handed to the main pool instead
+        """
+        with self.lock:
+            for key in ring.keys:
+                page_frame = self.page_frames.get(key)
+                if page_frame is None:
+                    continue
+                if page_frame.pin or not self.__evict_page(key):
+                    self.page_policy.admit(key)
+            ring.keys.clear()
+
+    def __write_back_page(self, key: tuple):
+        page_frame = self.page_frames[key]
+        conceptual_page = page_frame.conceptual_page
+        page = page_frame.page
+        block = conceptual_page.blocks[page_frame.column][page_frame.level]
+        if block is not None and not page.dirty:
+            return
+        start_time = time.perf_counter()
+        if block is None:
+            # The page doesn't have a block yet. Saving the whole page range gives it one and keeps the segment's page
+            # table in sync with its blocks. The frame stays dirty, queries may still be writing into it
+            folder_path = os.path.join(self.path, "tables", key[0])
+            os.makedirs(folder_path, exist_ok=True)
+            page_range = self.frames[key[0]][key[1]].page_range
+            self.bytes_written += page_range.save_segment(os.path.join(folder_path, f"{key[1]}.seg"),
+                                                          self.checkpoint_sequence)
         else:
-            print("error: table name is not in frame list")
-            # TODO OOPS
-            return None
+            with SegmentFile(conceptual_page.segment_path, self.checkpoint_sequence) as segment:
+                self.bytes_written += segment.write_page(block, page)
+        self.write_backs += 1
+        self.flush_seconds += time.perf_counter() - start_time
+
+    def __drop_page(self, key: tuple):
+        page_frame = self.page_frames.pop(key)
+        page_frame.conceptual_page.unload_page(page_frame.column, page_frame.level)
+        self.page_policy.remove(key)
+        self.resident_pages -= 1
+        frame = self.frames.get(key[0], {}).get(key[1])
+        if frame is not None:
+            frame.resident_pages -= 1
+
+    @property
+    def resident_bytes(self) -> int:
+        """
+        Memory used by cached physical pages, kept under memory_budget unless everything left is pinned
+        """
+        return self.resident_pages * PAGE_SIZE
 
     def has_capacity(self):
-        sum = 0
-        for table_frames in self.frames.values():
-            for frame in table_frames:
-                if frame:
-                    sum += 1
-        
-        return sum <= self.capacity
+        return self.resident < self.capacity
 
     def read_frame(self, table_name: str, page_range_index: int, num_columns: int):
         # TODO Look into possible issues with this way of reading
-        dir_path = os.path.join(
-            self.path, "tables", table_name, f"{page_range_index}"
-        )
+        table_dir = os.path.join(self.path, "tables", table_name)
+        segment_path = os.path.join(table_dir, f"{page_range_index}.seg")
+        # Page ranges saved before segment files existed are still readable, they get written back as a segment
+        dir_path = os.path.join(table_dir, f"{page_range_index}")
         json_path = dir_path + ".json"
         # self.evict_frame()
         # print(f"frame path is {json_path}\n")
 
-        if os.path.exists(json_path):
+        # A page range that can't be read raises, __load_frame hands the error to whoever asked for it
+        if os.path.exists(segment_path):
+            return Frame(
+                table_name,
+                page_range_index,
+                PageRange.from_segment(segment_path, num_columns),
+                from_disk=True,
+            )
+        elif os.path.exists(json_path):
             # print("path exists")
-            try:
-                with open(json_path, "rb") as file:
-                    self.frames[table_name][page_range_index] = Frame(
-                        table_name,
-                        page_range_index,
-                        PageRange.from_dict(json.load(file), dir_path),
-                        from_disk=True,
-                    )
-            except Exception as e:
-                print(f"Exception raised while reading frame from disk: {e.with_traceback()}")
+            with open(json_path, "rb") as file:
+                return Frame(
+                    table_name,
+                    page_range_index,
+                    PageRange.from_dict(json.load(file), dir_path),
+                    from_disk=True,
+                )
         else:
             # print("in else\n")
-            self.frames[table_name][page_range_index] = Frame(
+            return Frame(
                 table_name, page_range_index, PageRange(num_columns)
             )
 
-    def write_frame(self, frame: Frame):
+    def write_frame(self, frame: Frame) -> int:
+        """
+        Saves a frame's page range to its segment. Only the physical pages that changed get written. If the save fails
+        the frame is left dirty and the error is raised, so it is kept in memory and written again later
+        """
         folder_path = os.path.join(self.path, "tables", frame.table_name)
         os.makedirs(folder_path, exist_ok=True)
-        if os.path.exists(folder_path):
-            frame_path = os.path.join(folder_path, f"{frame.position}.json")
-            frame_dir = os.path.join(folder_path, f"{frame.position}")
-            os.makedirs(frame_dir, exist_ok=True)
-            # if os.path.exists(frame_path):
-            #     # print("Overwrite Log")
-            #     pass
-            try:
-                with open(frame_path, "w+", encoding="utf-8") as file:
-                    json.dump(frame.page_range.to_dict(), file)
-                    # call function to save contents
-                    frame.page_range.save_contents(path=frame_dir)
-            except Exception as e:
-                print(f"Exception raised while writing frame to disk: {e.with_traceback()}")
-        else:
-            print("Somehow the write path didn't exist after making it.")
-            pass
-
-    def __oldget_least_needed_frame(self) -> Optional[Frame]:
-        all_frames: list[Frame] = []
-        for key in self.frames.keys:
-            all_frames.extend(self.frames[key])
-        sorted_frames = sorted(
-            all_frames, key=Frame.request_count
-        )  # Frames sorted from least requested to most requested
-        stop_index = 0
-        least_requests = 0
-        for i, frame in enumerate(sorted_frames):
-            if i == 0:
-                least_requests = frame.request_count
-            if frame.request_count > least_requests:
-                stop_index = i
-                break
-        sorted_frames = sorted(
-            sorted_frames[0:stop_index], key=Frame.last_accessed
-        )  # Least requested pages sorted from oldest access to most recent access
-        return sorted_frames[0] if sorted_frames else None
-    
-    def get_least_needed_frames_first(self) -> list[Frame]:
-        all_frames: list[Frame] = []
-        for key in self.frames.keys():
-            all_frames.extend(self.frames[key])
-            
-        sorted_frames = sorted(all_frames, key=lambda frame: (frame.pin, frame.last_accessed, frame.request_count))
-        stop_index = 0
-        least_requests = 0
-        for i, frame in enumerate(sorted_frames):
-            if i == 0:
-                least_requests = frame.request_count
-            if frame.request_count > least_requests:
-                stop_index = i
-                break
-        sorted_frames = sorted(
-            sorted_frames[0:stop_index], key=Frame.last_accessed
-        )  # Least requested pages sorted from oldest access to most recent access
-        return sorted_frames
+        segment_path = os.path.join(folder_path, f"{frame.position}.seg")
+        start_time = time.perf_counter()
+        # Cleared before the pages are copied so a query writing during the save marks the frame dirty again
+        frame.is_dirty = False
+        try:
+            bytes_written = frame.page_range.save_segment(segment_path, self.checkpoint_sequence)
+        except BaseException:
+            frame.is_dirty = True
+            raise
+        self.bytes_written += bytes_written
+        self.flush_count += 1
+        self.write_backs += 1
+        self.flush_seconds += time.perf_counter() - start_time
+        return bytes_written
 
     # Evict Frame aka a Page Range with the Frame Data
-    def evict_frame(self):
-        # If Frame Dirty, write to Disk
-        if self.frames and not self.has_capacity():
-            frames = self.get_least_needed_frames_first()
-            if not frames:
-                raise Exception("No frames to evict.")
-            frame = frames[0]
-            if frame.is_dirty and not frame.pin:
-                if frame.table_name in self.frames:
-                        self.write_frame(frame)
-                        self.frames[frame.table_name][frame.position] = None
+    def evict_frame(self) -> bool:
+        """
+        Evicts the frame the replacement policy picks, writing it back first if it is dirty. Pinned frames are
+        never picked. Returns False if there was nothing that could be evicted
+        """
+        with self.lock:
+            for _ in range(self.resident + 1):
+                key = self.policy.victim(lambda key: not self.frames[key[0]][key[1]].pin)
+                if key is None:
+                    return False
+                table_name, page_range_index = key
+                frame = self.frames[table_name][page_range_index]
+                # A hit can pin the frame without the pool lock, so the pin is checked again under its latch. Once
+                # evicted is set nobody else can pin it
+                with frame.latch:
+                    if not frame.pin:
+                        frame.evicted = True
+                        break
+                self.policy.touch(key)
             else:
-                raise Exception("Failed to evict.")
+                return False
 
-    def on_close(self):
-        for table_frames in self.frames.values():
-            for frame in table_frames:
-                if frame.is_dirty:
+            # If Frame Dirty, write to Disk. This happens before the frame leaves the pool so nobody can read a stale
+            # copy back in from disk in the meantime. If that fails the frame stays, its changes only live in memory
+            if frame.is_dirty:
+                try:
                     self.write_frame(frame)
-            
+                except BaseException:
+                    with frame.latch:
+                        frame.evicted = False
+                    self.policy.touch(key)
+                    raise
+            # Its physical pages go with it
+            for _, _, conceptual_page in frame.page_range.conceptual_pages():
+                for column_pages in conceptual_page.pages:
+                    for page_key in column_pages.keys:
+                        if page_key is not None:
+                            self.__drop_page(page_key)
+                # Anyone still holding the old page range reads straight from disk instead of putting pages back in
+                # the pool under keys that now belong to the next copy of it
+                conceptual_page.cache = None
+                conceptual_page.cache_key = None
+            frame.page_range.cache = None
+            frame.page_range.cache_key = None
+            del self.frames[table_name][page_range_index]
+            self.policy.remove(key)
+            self.resident -= 1
+            self.evictions += 1
+            return True
+
+    def flush_all(self) -> int:
+        """
+        Writes every dirty frame back to disk. Returns the number of bytes written. A frame that can't be written
+        raises, it stays dirty for the next try
+        """
+        bytes_written = 0
+        for table_frames in list(self.frames.values()):
+            for frame in list(table_frames.values()):
+                if frame.is_dirty:
+                    with self.lock:
+                        bytes_written += self.write_frame(frame)
+        return bytes_written
+
+    def flush_pages(self, budget: int, high_water: Optional[int] = None) -> int:
+        """
+        Writes dirty physical pages back, oldest first, until about budget bytes have been written. If more than
+        high_water pages are dirty it keeps going until they are back down to high_water. The frames stay dirty, their
+        page table still has to be written by write_frame, but that's all that is left for eviction or close.
+        Returns the number of bytes written
+        """
+        dirty = [key for key, page_frame in list(self.page_frames.items())
+                 if page_frame.page is not None and page_frame.page.dirty]
+        excess = len(dirty) - high_water if high_water is not None else 0
+        bytes_written = 0
+        for count, key in enumerate(dirty):
+            if bytes_written >= budget and count >= excess:
+                break
+            # One page at a time under the lock, so the page can't be evicted or its page range reloaded mid write
+            with self.lock:
+                page_frame = self.page_frames.get(key)
+                if page_frame is None or page_frame.page is None or not page_frame.page.dirty:
+                    continue
+                before = self.bytes_written
+                self.__write_back_page(key)
+                bytes_written += self.bytes_written - before
+        return bytes_written
+
+    def start_flusher(
+        self,
+        interval: Optional[float] = None,
+        bytes_per_second: Optional[int] = None,
+        high_water: Optional[float] = None,
+    ):
+        """
+        Starts a background thread that writes dirty pages back a little at a time, so eviction mostly finds clean
+        pages and close only has the remainder to write. Defaults come from config.FLUSH_*. high_water is the fraction
+        of the memory budget that can be dirty before the flusher ignores its bytes per second budget
+        """
+        if self.flusher:
+            return
+        interval = interval if interval is not None else config.FLUSH_INTERVAL
+        bytes_per_second = bytes_per_second if bytes_per_second is not None else config.FLUSH_BYTES_PER_SECOND
+        high_water = high_water if high_water is not None else config.FLUSH_HIGH_WATER
+
+        budget = int(bytes_per_second * interval)
+        dirty_pages = int(high_water * self.page_capacity)
+
+        def flush_loop():
+            while not self.flusher_stop.wait(interval):
+                try:
+                    self.flush_pages(budget, dirty_pages)
+                except Exception as e:
+                    print(f"Exception raised in background flusher: {e}")
+
+        self.flusher_stop.clear()
+        self.flusher = threading.Thread(target=flush_loop, daemon=True)
+        self.flusher.start()
+
+    def stop_flusher(self):
+        if self.flusher:
+            self.flusher_stop.set()
+            self.flusher.join()
+            self.flusher = None
+
+    def reset_stats(self):
+        """
+        Zeroes every counter stats() reports, so a benchmark can take the difference over just its own run
+        """
+        self.frame_request_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetch_failures = 0
+        self.page_loads = 0
+        self.page_evictions = 0
+        self.write_backs = 0  # Frames saved plus physical pages written back on their own
+        self.flush_count = 0  # Frames saved
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.frame_loads = 0
+        self.frame_load_seconds = 0.0
+        self.page_load_seconds = 0.0
+        self.flush_seconds = 0.0
+
+    def stats(self) -> dict:
+        """
+        Returns the counters since the pool was made (or reset_stats was called) along with what is in memory right
+        now. Counters are plain increments so they are cheap enough to leave on, under heavy concurrency they can be
+        off by a few. Latencies are averages in milliseconds
+        """
+        tables = {}
+        for table_name, table_frames in list(self.frames.items()):
+            frames = list(table_frames.values())
+            tables[table_name] = {
+                "resident": len(frames),
+                "pinned": sum(1 for frame in frames if frame.pin > 0),
+                "dirty": sum(1 for frame in frames if frame.is_dirty),
+                "resident_pages": sum(frame.resident_pages for frame in frames),
+                "resident_bytes": sum(frame.resident_bytes for frame in frames),
+                "pinned_pages": 0,
+            }
+        for key, page_frame in list(self.page_frames.items()):
+            table = tables.get(key[0])
+            if table is not None:
+                table["pinned_pages"] += page_frame.pin > 0
+
+        return {
+            "requests": self.frame_request_count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / self.frame_request_count if self.frame_request_count else 0.0,
+            "evictions": self.evictions,
+            "prefetch_failures": self.prefetch_failures,
+            "page_loads": self.page_loads,
+            "page_evictions": self.page_evictions,
+            "write_backs": self.write_backs,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "avg_frame_load_ms": 1000 * self.frame_load_seconds / self.frame_loads if self.frame_loads else 0.0,
+            "avg_page_load_ms": 1000 * self.page_load_seconds / self.page_loads if self.page_loads else 0.0,
+            "avg_flush_ms": 1000 * self.flush_seconds / self.write_backs if self.write_backs else 0.0,
+            "resident": self.resident,
+            "resident_pages": self.resident_pages,
+            "resident_bytes": self.resident_bytes,
+            "memory_budget": self.memory_budget,
+            "tables": tables,
+        }
+
+    def on_close(self):
+        self.stop_flusher()
+        if self.prefetcher:
+            self.prefetcher.shutdown(wait=True)
+            self.prefetcher = None
+        self.flush_all()
@@ -1,7 +1,57 @@
-from lstore.page import Page  # Assuming your Page class is defined in page.py
+from lstore.page import Page, MappedPage, PAGE_SIZE  # Assuming your Page class is defined in page.py
+from lstore.segment import SegmentFile
 import os, json
+import threading
+import time
+import lstore.config as config
 from lstore.config import NUM_META_COLUMNS
 
+class ColumnPages:
+  """
+  The physical pages of one column, one per level. Levels that are still on disk, or that the bufferpool evicted,
+  are None and get read back in the first time they are used, so only the pages a query touches are in memory.
+  """
+  __slots__ = ("owner", "column", "pages", "keys", "touch")
+
+  def __init__(self, owner, column, pages):
+    self.owner = owner  # The ConceptualPage these pages belong to
+    self.column = column
+    self.pages = pages
+    # Bufferpool key of each level while it is cached, None otherwise
+    self.keys = [None] * len(pages)
+    self.touch = None  # Tells the bufferpool a cached level was used, set when the first level is cached
+
+  def __getitem__(self, level):
+    page = self.pages[level]
+    if page is None:
+      return self.owner.load_page(self.column, level)
+    key = self.keys[level]
+    if key is not None:
+      self.touch(key)
+    return page
+
+  def __len__(self):
+    return len(self.pages)
+
+  def __iter__(self):
+    for level in range(len(self.pages)):
+      yield self[level]
+
+  def append(self, page):
+    self.keys.append(None)
+    self.pages.append(page)
+
+  def is_loaded(self):
+    return any(page is not None for page in self.pages)
+
+class LazyColumns(list):
+  """
+  One ColumnPages per column of a ConceptualPage
+  """
+
+  def is_loaded(self, column):
+    return self[column].is_loaded()
+
 class ConceptualPage:
   def __init__(self, num_columns):
     """
@@ -15,15 +65,31 @@ class ConceptualPage:
     # For the sake of consistency, the first four columns should be the metadata columns
     # Since everything is lazy, we start off with one row of column pages and expand until we reach 16
     # BasePages holds 4096 records = 512 records * 8 physical pages PER COLUMN
-    self.pages = [[Page()] for _ in range(self.total_columns)]
+    self.pages = LazyColumns(ColumnPages(self, column, [Page()]) for column in range(self.total_columns))
+    # Block number of each physical page inside the page range's segment file, None until it is saved
+    self.blocks = [[None] for _ in range(self.total_columns)]
+    self.segment_path = None  # Segment file the blocks are in, None until the page is saved or read from one
+    self.buffer = None  # Mapping of that segment file when pages are memory mapped
+    # The bufferpool caching this page's physical pages and the key prefix it uses for them, see attach_cache
+    self.cache = None
+    self.cache_key = None
+    # Held while loading or writing physical pages, the bufferpool won't evict a page while it's taken
+    self.lock = threading.RLock()
 
   def __allocate_new_physical_pages(self):
     # First check is so we don't go over 8 ConceptualPages
     # The second check makes sure the next_slot (num_records) can't be stored in a physical page we already have
     physical_page_level = self.num_records // 512
-    if physical_page_level <= 7 and physical_page_level >= len(self.pages[0]):
+    if physical_page_level <= 7 and physical_page_level >= len(self.blocks[0]):
+      # Blocks go first so anything saving this page concurrently never sees a page without a block entry
+      for column in self.blocks:
+        column.append(None)
       for column in self.pages:
         column.append(Page())
+      cache = self.cache
+      if cache is not None:
+        for column in range(self.total_columns):
+          cache.admit_page(self, column, physical_page_level)
 
   def has_capacity(self):
     """
@@ -60,7 +126,7 @@ class ConceptualPage:
   def read_metadata_at(self, slot):
     """
     Specifically only for reading the metadata of a record. Useful if you need to update something
-    like the indirection column or schema encoding.
+    like the indirection column or schema encoding. Only the metadata columns get loaded from disk.
     """
 
     physical_page_level = slot // 512
@@ -72,6 +138,58 @@ class ConceptualPage:
 
     return record
 
+  def read_records(self, slots, projected_columns_index):
+    """
+    Reads many slots in one call. Returns the data column major: one list per column (metadata columns included)
+    with the values in the same order as the slots. Columns that aren't projected are None. Slots are grouped by
+    physical page so each page is read with a single read_many.
+    """
+    if len(projected_columns_index) != self.regular_columns:
+      raise Exception(f"In ConceptualPage, expected projected columns index of size #{self.regular_columns}, not #{len(projected_columns_index)}")
+
+    # physical page level -> (positions in the slots list, slots inside that physical page)
+    levels = {}
+    for position, slot in enumerate(slots):
+      if slot < 0 or slot >= self.num_records:
+        raise IndexError("No record to read in that slot")
+      positions, page_slots = levels.setdefault(slot // 512, ([], []))
+      positions.append(position)
+      page_slots.append(slot % 512)
+
+    columns = []
+    for column in range(self.total_columns):
+      if column >= self.metadata_columns and not projected_columns_index[column - self.metadata_columns]:
+        columns.append(None)
+        continue
+      values = [None] * len(slots)
+      pages = self.pages[column]
+      for level, (positions, page_slots) in levels.items():
+        for position, value in zip(positions, pages[level].read_many(page_slots)):
+          values[position] = value
+      columns.append(values)
+
+    return columns
+
+  def scan_column(self, column, start_slot=0, end_slot=None):
+    """
+    Yields memoryviews over one column, one view per physical page, covering the slots from start_slot up to (not
+    including) end_slot. The column number includes the metadata columns like update_column does.
+    Summing or filtering the views avoids building a list for every record.
+    The views are zero-copy for in memory pages. Memory mapped pages are big endian on disk, so on little endian
+    machines their slots get decoded into a native copy (only the slots being scanned, see MappedPage.view).
+    """
+    if end_slot is None or end_slot > self.num_records:
+      end_slot = self.num_records
+
+    slot = max(start_slot, 0)
+    while slot < end_slot:
+      physical_page_level = slot // 512
+      physical_page_slot = slot % 512
+      # Stop at whichever comes first, the end of the physical page or the end of the scan
+      count = min(512 - physical_page_slot, end_slot - slot)
+      yield self.pages[column][physical_page_level].view(physical_page_slot, physical_page_slot + count)
+      slot += count
+
   def write_record(self, record):
     """
       Adding a new record in the Conceptual Page. This can be for base pages or tail pages. So please be sure
@@ -87,11 +205,37 @@ class ConceptualPage:
     physical_page_level = new_slot // 512
     physical_page_slot = new_slot % 512
 
-    for column_num, data in enumerate(record):
-      self.pages[column_num][physical_page_level].write(value=data, slot=physical_page_slot)
+    with self.lock:
+      for column_num, data in enumerate(record):
+        self.pages[column_num][physical_page_level].write(value=data, slot=physical_page_slot)
 
-    self.num_records += 1
-    self.__allocate_new_physical_pages() # In case you fill the physical page up
+      self.num_records += 1
+      self.__allocate_new_physical_pages() # In case you fill the physical page up
+
+  def write_records(self, records):
+    """
+    Bulk version of write_record. Writes as many of the records as fit, one physical page and one column at a time
+    instead of one record at a time. Returns how many records were written
+    """
+    count = min(len(records), 4096 - self.num_records)
+    written = 0
+    while written < count:
+      physical_page_level = self.num_records // 512
+      physical_page_slot = self.num_records % 512
+      # Fill up to the end of the current physical page
+      chunk = records[written:written + min(512 - physical_page_slot, count - written)]
+      if any(len(record) != self.total_columns for record in chunk):
+        raise Exception("Not enough columns")
+
+      with self.lock:
+        for column_num in range(self.total_columns):
+          self.pages[column_num][physical_page_level].write_many(physical_page_slot, [record[column_num] for record in chunk])
+
+        self.num_records += len(chunk)
+        self.__allocate_new_physical_pages()
+      written += len(chunk)
+
+    return written
 
   def update_column(self, column ,slot, new_indirection):
     """
@@ -103,7 +247,8 @@ class ConceptualPage:
 
     physical_page_level = slot // 512
     physical_page_slot = slot % 512
-    self.pages[column][physical_page_level].write(new_indirection, physical_page_slot)
+    with self.lock:
+      self.pages[column][physical_page_level].write(new_indirection, physical_page_slot)
 
 
   def to_dict(self):
@@ -132,6 +277,92 @@ class ConceptualPage:
 
     return new_conceptual_page
 
+  def save_to_segment(self, segment):
+    """
+    Writes the dirty physical pages into the segment, giving new pages a block first. Pages that haven't changed since
+    they were last saved are skipped. Returns this page's entry for the segment's page table and the bytes written
+    """
+    bytes_written = 0
+    for column_num in range(self.total_columns):
+      # Pages that aren't in memory can't have changed
+      for level, page in enumerate(self.pages[column_num].pages):
+        if page is None:
+          continue
+        if self.blocks[column_num][level] is None:
+          self.blocks[column_num][level] = segment.allocate_block()
+        elif not page.dirty:
+          continue
+        bytes_written += segment.write_page(self.blocks[column_num][level], page)
+    self.segment_path = segment.path
+
+    data = self.to_dict()
+    data["blocks"] = self.blocks
+    return data, bytes_written
+
+  @classmethod
+  def from_segment(cls, data, segment_path, buffer=None):
+    """
+    Builds a conceptual page from its page table entry. Nothing is read yet, each physical page is loaded from the
+    segment the first time it is used. If a mapping of the segment is given the pages are MappedPages pointing at their
+    blocks, otherwise they are read with pread
+    """
+    new_conceptual_page = cls(data["regular_columns"])
+    new_conceptual_page.metadata_columns = data["metadata_columns"]
+    new_conceptual_page.num_records = data["num_records"]
+    new_conceptual_page.blocks = data["blocks"]
+    new_conceptual_page.segment_path = segment_path
+    new_conceptual_page.buffer = buffer
+    new_conceptual_page.pages = LazyColumns(ColumnPages(new_conceptual_page, column, [None] * len(blocks))
+                                            for column, blocks in enumerate(new_conceptual_page.blocks))
+    return new_conceptual_page
+
+  def load_page(self, column, level):
+    """
+    Reads one physical page back in from the segment file and hands it to the bufferpool, if there is one
+    """
+    with self.lock:
+      column_pages = self.pages[column]
+      # Someone else may have loaded it while we were waiting
+      page = column_pages.pages[level]
+      if page is not None:
+        return page
+
+      start_time = time.perf_counter()
+      block = self.blocks[column][level]
+      # Blocks added after the segment was mapped are past the end of the mapping
+      if self.buffer is not None and (block + 1) * PAGE_SIZE <= len(self.buffer):
+        page = MappedPage(self.buffer, block * PAGE_SIZE, self.segment_path)
+      else:
+        with SegmentFile(self.segment_path) as segment:
+          page = segment.read_page(block)
+      column_pages.pages[level] = page
+      cache = self.cache
+      if cache is not None:
+        cache.admit_page(self, column, level, time.perf_counter() - start_time)
+      return page
+
+  def unload_page(self, column, level):
+    """
+    Drops one physical page from memory. Only the bufferpool should call this, after writing the page back if it was
+    dirty. The next read loads it from the segment again
+    """
+    column_pages = self.pages[column]
+    column_pages.pages[level] = None
+    column_pages.keys[level] = None
+
+  def attach_cache(self, cache, cache_key):
+    """
+    Lets the bufferpool cache this page's physical pages. cache_key is the prefix of their keys (table name, page range
+    index, "base" or "tail", conceptual page index), the column and level get added to it. Pages already in memory are
+    handed over straight away
+    """
+    self.cache = cache
+    self.cache_key = cache_key
+    for column_pages in self.pages:
+      for level, page in enumerate(column_pages.pages):
+        if page is not None:
+          cache.admit_page(self, column_pages.column, level)
+
   def dump_file(self, name):
     with open(f"{name}.json", "w") as file:
       json.dump(self.to_dict(), file, indent=4)
@@ -176,15 +407,16 @@ class ConceptualPage:
               bin_paths.append(subdir)
 
             # order the subdirectories numerically
-            bin_paths.sort(key=lambda x: int(os.path.basename(x[0])))
+            bin_paths.sort(key=lambda x: int(os.path.splitext(x)[0]))
             
             # this is the path fo the column, and each of the subdirectories inside the column folder
             page_path.append((dir_path, bin_paths))
   
-    new_page_path = sorted(page_path, key=lambda x: int(os.path.basename(x[0][-1])))
+    # By the whole column number, col10 goes after col9 and not after col1
+    new_page_path = sorted(page_path, key=lambda x: int(os.path.basename(x[0])[3:]))
 
     # RESET THE PAGE LIST
-    self.pages = []
+    pages = []
 
     # probably could have done this part where the paths were appended to page_path, but i found it easier to make it modular since i was bug hunting
     for path_dir, path_bins in new_page_path:
@@ -194,7 +426,14 @@ class ConceptualPage:
       # iterate through the subdirectories to create the column
       for bin in path_bins:
         path = os.path.join(path_dir, bin)
-        column.append(Page.from_dict(path=path))
+        if config.MMAP_PAGES:
+          column.append(MappedPage.from_file(path))
+        else:
+          column.append(Page.from_dict(path=path))
       
       # add completed column to the page list
-      self.pages.append(column)
\ No newline at end of file
+      pages.append(column)
+
+    self.pages = LazyColumns(ColumnPages(self, column, column_pages) for column, column_pages in enumerate(pages))
+    # None of these pages are in a segment file yet
+    self.blocks = [[None] * len(column) for column in pages]
\ No newline at end of file
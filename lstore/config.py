@@ -5,3 +5,27 @@ RID_COLUMN = 1
 TIMESTAMP_COLUMN = 2
 SCHEMA_ENCODING_COLUMN = 3
 # }
+
+# Storage {
+# When True, physical pages loaded from disk are memory mapped instead of read into memory
+MMAP_PAGES = False
+# Memory the bufferpool may use for cached physical pages, in bytes. See BufferPool
+BUFFERPOOL_BYTES = 32 * 1024 * 1024
+# Bulk operations read through a ring of this many pages, see BufferPool.ring
+RING_PAGES = 256
+SCAN_RING_KEYS = 4096  # Sums over more keys than this use a ring
+# Background flusher, see BufferPool.start_flusher
+FLUSH_INTERVAL = 0.1  # Seconds between rounds
+FLUSH_BYTES_PER_SECOND = 32 * 1024 * 1024  # I/O budget
+FLUSH_HIGH_WATER = 0.25  # Once this fraction of the page capacity is dirty the flusher ignores its budget
+# Seconds between background checkpoints (see Database.checkpoint), 0 turns them off
+CHECKPOINT_INTERVAL = 30
+# Read ahead, see BufferPool.prefetch
+READ_AHEAD = 2  # Page ranges loaded ahead once a table is being read in order
+PREFETCH_WORKERS = 2
+# }
+
+# Index {
+# Keys with more RIDs than this keep them in a compressed bitmap instead of a sorted array, see lstore/postings.py
+POSTING_ARRAY_MAX = 64
+# }
@@ -1,9 +1,18 @@
 import json
 import pickle
 import os
+import re
+import threading
+import time
+from typing import Optional
+import lstore.config as config
 from lstore.bufferpool import BufferPool
 from lstore.table import Table
 from lstore.index import Index
+from lstore.segment import fsync_directory, recover_database, remove_undo_logs, sync_segments
+
+# Table files a checkpoint wrote under its sequence number, like Grades.3.json or Gradesindex.3.bin
+CHECKPOINT_FILE = re.compile(r"^(?P<name>.+)\.(?P<sequence>\d+)(?P<extension>\.json|\.bin)$")
 
 class Database():
 
@@ -11,22 +20,144 @@ class Database():
         self.tables: dict[str, Table] = {}
         self.start_path = None
         self.bufferpool: BufferPool = None
+        # Background checkpoints, see start_checkpoints
+        self.checkpointer: Optional[threading.Thread] = None
+        self.checkpointer_stop = threading.Event()
+        self.checkpoint_lock = threading.Lock()
+        self.last_checkpoint: Optional[dict] = None  # Contents of the latest checkpoint marker
 
     def open(self, path):
         self.start_path = path
+        marker_path = os.path.join(self.start_path, "checkpoint.json")
+        if os.path.exists(marker_path):
+            with open(marker_path, "r", encoding="utf-8") as file:
+                self.last_checkpoint = json.load(file)
+        # Anything written since the last checkpoint (or since the database was made, if there isn't one) is rolled
+        # back first, in case we didn't get to close last time
+        sequence = self.last_checkpoint["sequence"] if self.last_checkpoint else 0
+        self.__recover(sequence)
         self.bufferpool = BufferPool(self.start_path)
+        self.bufferpool.checkpoint_sequence = sequence
+        self.bufferpool.start_flusher()
+        if config.CHECKPOINT_INTERVAL:
+            self.start_checkpoints(config.CHECKPOINT_INTERVAL)
 
     def close(self):
+        self.stop_checkpoints()
         self.bufferpool.on_close()
         if self.start_path:
+            # Closing is one last checkpoint, so the next open starts from exactly here
+            self.checkpoint()
             for table in self.tables.values():
-                table_path = os.path.join(self.start_path, "tables", table.name)
-                with open(f"{table_path}index.json","w+", encoding="utf-8") as file:
-                    json.dump(table.index.to_arr(), file)
-
                 table.index = None
-                with open(f"{table_path}.json", 'w+', encoding="utf-8") as file:
-                    json.dump(table.to_dict(), file)
+
+    def __recover(self, sequence):
+        # Segments go back to the checkpoint with their undo logs. A checkpoint that wrote its marker but didn't get to
+        # renaming its table files gets them renamed now, table files of one that never finished are dropped
+        recover_database(self.start_path, sequence)
+        tables_path = os.path.join(self.start_path, "tables")
+        if not os.path.isdir(tables_path):
+            return
+        for file_name in os.listdir(tables_path):
+            match = CHECKPOINT_FILE.match(file_name)
+            if match is None:
+                continue
+            if int(match["sequence"]) == sequence:
+                os.replace(os.path.join(tables_path, file_name),
+                           os.path.join(tables_path, match["name"] + match["extension"]))
+            else:
+                os.remove(os.path.join(tables_path, file_name))
+
+    def __write_table_files(self, name, table_data, index_data, sequence):
+        # Written under the checkpoint's sequence number, they only replace the current files once its marker is out
+        table_path = os.path.join(self.start_path, "tables", name)
+        os.makedirs(os.path.dirname(table_path), exist_ok=True)
+        write_bytes_atomically(f"{table_path}index.{sequence}.bin", index_data)
+        write_json_atomically(f"{table_path}.{sequence}.json", table_data)
+
+    def __commit_table_files(self, name, sequence):
+        table_path = os.path.join(self.start_path, "tables", name)
+        os.replace(f"{table_path}index.{sequence}.bin", f"{table_path}index.bin")
+        os.replace(f"{table_path}.{sequence}.json", f"{table_path}.json")
+        # Databases saved before the binary index had a JSON one, it would only get in the way now
+        if os.path.exists(f"{table_path}index.json"):
+            os.remove(f"{table_path}index.json")
+
+    def checkpoint(self) -> dict:
+        """
+        Fuzzy checkpoint, done in two passes. The first flush of the dirty frames runs while queries keep going and does
+        almost all of the writing. Then every write (inserts, updates, deletes and the undos) is held for a moment
+        while the table metadata (page directory, rid counter, index) is copied and whatever changed during the first
+        pass is flushed, so the copies match what is on disk. From then on the pages written by the flusher or by eviction are undo logged against
+        this checkpoint. The copies and the checkpoint marker are written after that, the marker is what makes the
+        checkpoint count. It is only written once the segments and the copies are fsynced, so after a crash or a
+        power loss open rolls the segments back to the last checkpoint and get_table comes back to it. Returns the
+        marker
+        """
+        with self.checkpoint_lock:
+            tables = [table for table in list(self.tables.values()) if table.index is not None]
+            sequence = self.last_checkpoint["sequence"] + 1 if self.last_checkpoint else 1
+            bytes_written = self.bufferpool.flush_all()
+
+            held = []
+            try:
+                for table in tables:
+                    for lock in (table.new_record, table.update_record):
+                        lock.acquire()
+                        held.append(lock)
+                snapshots = [(table.name, table.to_dict(), table.index.to_bytes()) for table in tables]
+                bytes_written += self.bufferpool.flush_all()
+                # The segments match the copies now
+                with self.bufferpool.lock:
+                    self.bufferpool.checkpoint_sequence = sequence
+            finally:
+                for lock in reversed(held):
+                    lock.release()
+
+            for name, table_data, index_data in snapshots:
+                self.__write_table_files(name, table_data, index_data, sequence)
+
+            marker = {
+                "sequence": sequence,
+                "time": time.time(),
+                "tables": {name: {"rid": table_data["rid"], "page_ranges_index": table_data["page_ranges_index"]}
+                           for name, table_data, _ in snapshots},
+                "bytes_written": bytes_written,
+            }
+            os.makedirs(self.start_path, exist_ok=True)
+            # Everything the marker vouches for has to be on disk before it is
+            sync_segments(self.start_path)
+            write_json_atomically(os.path.join(self.start_path, "checkpoint.json"), marker)
+            self.last_checkpoint = marker
+            for name, _, _ in snapshots:
+                self.__commit_table_files(name, sequence)
+            # Nothing can roll back to an older checkpoint anymore
+            remove_undo_logs(self.start_path, sequence)
+            return marker
+
+    def start_checkpoints(self, interval: float):
+        """
+        Takes a checkpoint every interval seconds on a background thread until close
+        """
+        if self.checkpointer:
+            return
+
+        def checkpoint_loop():
+            while not self.checkpointer_stop.wait(interval):
+                try:
+                    self.checkpoint()
+                except Exception as e:
+                    print(f"Exception raised while taking a checkpoint: {e}")
+
+        self.checkpointer_stop.clear()
+        self.checkpointer = threading.Thread(target=checkpoint_loop, name="CheckpointThread", daemon=True)
+        self.checkpointer.start()
+
+    def stop_checkpoints(self):
+        if self.checkpointer:
+            self.checkpointer_stop.set()
+            self.checkpointer.join()
+            self.checkpointer = None
 
     """
     # Creates a new table
@@ -58,7 +189,7 @@ class Database():
     def get_table(self, name):
         # table_path = f"{self.start_path}/tables/{name}/"
         table_path = os.path.join(self.start_path, "tables", name)
-        if os.path.exists(table_path):
+        if os.path.exists(f"{table_path}.json"):
             with open(f"{table_path}.json", 'r') as file:
                 data = json.load(file)
                 new_page_directory = {}
@@ -69,7 +200,27 @@ class Database():
                 table = Table(name=data["name"], num_columns=data["num_columns"], key=data["key"],
                               bufferpool=self.bufferpool, page_ranges_index= data["page_ranges_index"], page_directory=new_page_directory, rid=data["rid"])
                 self.tables[name] = table
-                with open(f"{table_path}index.json", 'r') as file:
-                    table.index = Index.from_arr(table, json.load(file))
+                if os.path.exists(f"{table_path}index.bin"):
+                    # One read for the whole file, the trees get bulk loaded from it
+                    with open(f"{table_path}index.bin", 'rb') as file:
+                        table.index = Index.from_bytes(table, file.read())
+                else:
+                    with open(f"{table_path}index.json", 'r') as file:
+                        table.index = Index.from_arr(table, json.load(file))
                 return table
 
+
+def write_bytes_atomically(path, data):
+    # Written next to the real file and renamed over it, so a crash never leaves half a file behind. Both the data
+    # and the rename are synced, once this returns the new file survives a power loss too
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(os.path.dirname(path) or ".")
+
+
+def write_json_atomically(path, data):
+    write_bytes_atomically(path, json.dumps(data).encode("utf-8"))
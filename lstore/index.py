@@ -1,20 +1,53 @@
+import struct
+import sys
+from array import array
+from itertools import chain, groupby
+from operator import itemgetter
+
 from BTrees.OOBTree import OOBTree
 import lstore.config as config
+from lstore.postings import RidBitmap, posting_add, posting_remove, posting_rids, posting_from_rids
 
 """
 A data strucutre holding indices for various columns of a table. Key column should be indexd by default, other columns can be indexed through this object. Indices are usually B-Trees, but other data structures can be used as well.
 """
 
 # Some quick ideas...We know primary keys can be unique but if we choose to index other columns,
-# there is no guarantee that the numbers there will be unique. For this reason, I believe that
-# the Btree should store sets of RIDs as values. Since primary keys are unique, that's not needed but for other
-# indexes it is.That way, you can iterate through each set if RIDs.
-# For example, self.indices[1][10] = {20, 4, 19}. Here we are looking for records where the first column has a value of 10
-# the records in question are stored in a set.
+# there is no guarantee that the numbers there will be unique. For this reason the Btree stores a posting list of
+# RIDs as values. A key with one RID (every primary key) just stores the int, more RIDs go in a sorted array and a lot
+# of them in a compressed bitmap, see lstore/postings.py.
+# For example, self.indices[1][10] = array('q', [4, 19, 20]). Here we are looking for records where the first column
+# has a value of 10. Use locate to get the RIDs back no matter how they are stored.
 
 # The tree is made up of key, value pairs where the key is value in a column and value is an RID which
 # can later be used by the page range.
 
+"""
+Indices are saved in a binary file (tables/<table>index.bin), all little endian 8 byte ints:
+
+  header          magic, version, number of columns
+  column table    for every column: number of keys (-1 if the column has no index), number of RIDs and the kind of
+                  index (position in INDEX_KINDS)
+  covering table  number of covered columns, then for each one: the column and its number of keys (version 3 on)
+  per index       the sorted keys, then where each key's RIDs start (number of keys + 1 offsets, left out when every
+                  key has exactly one RID), then the RIDs themselves
+  per covered     the sorted primary keys, then the value of the column for each of them
+
+The whole file is read in one go and every tree is bulk loaded from the sorted keys, see Index.from_bytes.
+"""
+
+INDEX_MAGIC = b"SQRLIDX1"
+INDEX_VERSION = 3
+_INDEX_HEADER = struct.Struct("<8sIQ")
+_INDEX_COLUMN = struct.Struct("<qqq")
+_INDEX_COVERING_COUNT = struct.Struct("<q")
+_INDEX_COVERING = struct.Struct("<qq")
+_INDEX_COLUMN_V1 = struct.Struct("<qq")  # Version 1 files only had B-trees
+
+# A B-tree (OOBTree) keeps its keys in order so it can answer ranges. A hash index is a plain dict, equality lookups
+# only, but a lookup is one hash instead of a walk down the tree. Both map a key to its posting
+INDEX_KINDS = ("btree", "hash")
+
 
 class Index:
     def __init__(self, table):
@@ -23,6 +56,8 @@ class Index:
         self.key = table.key
         self.table = table
         self.indices[self.key] = OOBTree()
+        # Covering index, column -> OOBTree of primary key -> latest value of that column. See create_covering_index
+        self.covering: dict = {}
 
     def add(self, record):
         """
@@ -36,11 +71,37 @@ class Index:
             # We have to do i + config.NUM_META_COLUMNS because the first config.NUM_META_COLUMNS columns are metadata columns. In other words, I am aligning
             key = record[i + config.NUM_META_COLUMNS]
             if column_index != None:
-                # If we are going to allow duplicate values we should store RIDs in a set. RIDs are for certain unique
-                if key not in column_index:
-                    column_index[key] = set()
-                # All nodes should contain sets
-                column_index[key].add(rid)
+                # The posting might change type as it grows, so it always gets stored back
+                column_index[key] = posting_add(column_index.get(key), rid)
+
+        for column, tree in self.covering.items():
+            tree[record[self.key + config.NUM_META_COLUMNS]] = record[column + config.NUM_META_COLUMNS]
+
+    def add_many(self, records):
+        """
+        Bulk version of add. The keys for each indexed column are grouped and sorted first so every tree gets
+        one sorted batch of inserts instead of one insert per record.
+        """
+        for i, column_index in enumerate(self.indices):
+            if column_index is None:
+                continue
+            column = i + config.NUM_META_COLUMNS
+            new_keys = {}
+            for record in records:
+                rids = new_keys.get(record[column])
+                if rids is None:
+                    new_keys[record[column]] = [record[config.RID_COLUMN]]
+                else:
+                    rids.append(record[config.RID_COLUMN])
+
+            # Keys that are already in the tree get their new RIDs merged into the posting they have
+            for key in [key for key in new_keys if key in column_index]:
+                column_index[key] = posting_from_rids(list(posting_rids(column_index[key])) + new_keys.pop(key))
+            column_index.update([(key, posting_from_rids(new_keys[key])) for key in sorted(new_keys)])
+
+        key_column = self.key + config.NUM_META_COLUMNS
+        for column, tree in self.covering.items():
+            tree.update(sorted((record[key_column], record[column + config.NUM_META_COLUMNS]) for record in records))
 
     def delete(self, record):
         """
@@ -51,15 +112,39 @@ class Index:
         rid = record[config.RID_COLUMN]
         for i, column_index in enumerate(self.indices):
             if column_index != None:
-                key = record[i + config.NUM_META_COLUMNS]
-                if key in column_index:
-                    # Recall the tree keys are SETs with RIDs
-                    column_index[key].remove(rid)
-                    # If the set is empty might as well delete thr key from the tree
-                    if len(column_index[key]) == 0:
-                        del column_index[key]
-                else:
-                    raise Exception("The key was not in the index")
+                self.__remove(column_index, record[i + config.NUM_META_COLUMNS], rid)
+
+        for tree in self.covering.values():
+            tree.pop(record[self.key + config.NUM_META_COLUMNS], None)
+
+    def move(self, column, rid, old_key, new_key):
+        """
+        Moves rid from old_key to new_key in the index of column. Used by updates that change an indexed value, the
+        other indices don't have to be touched
+        """
+        tree = self.indices[column]
+        self.__remove(tree, old_key, rid)
+        tree[new_key] = posting_add(tree.get(new_key), rid)
+
+    def update_covered(self, key, columns):
+        """
+        Stores the values an update wrote for the record with primary key key in the covering index. columns is the
+        update's columns, None where it didn't write anything
+        """
+        for column, tree in self.covering.items():
+            if columns[column] is not None:
+                tree[key] = columns[column]
+
+    def __remove(self, tree, key, rid):
+        posting = tree.get(key)
+        if posting is None:
+            raise Exception("The key was not in the index")
+        new_posting = posting_remove(posting, rid)
+        # If that was the last RID might as well delete the key from the tree
+        if new_posting is None:
+            del tree[key]
+        elif new_posting is not posting:
+            tree[key] = new_posting
 
     """
     # returns the location of all records with the given value on column "column"
@@ -68,20 +153,27 @@ class Index:
     def locate(self, column, value):
         # Search down an index for a specific set of RIDs. If it's not found, then it doesn't exist
         tree = self.indices[column]
-        if value not in tree:
+        posting = tree.get(value)
+        if posting is None:
             return None
 
-        return tree[value].copy()  # For now this returns a set of RIDs
+        # No copy, this is the posting in the tree. Copy it first if the index is going to change while you use it
+        return posting_rids(posting)
 
     """
     # Returns the RIDs of all records with values in column "column" between "begin" and "end"
     """
 
     def locate_range(self, begin, end, column):
-        # This one confuses me a bit too. Not the most efficient way but we could start with an empty
-        # array then we iterate from begin to end and append each of the RIDs in the set to this array.
-        # By the end of the function we should have an array with all RIDs that were within the specified range.
-        pass
+        # Only walks the keys that are actually in the tree between begin and end (both included), so a wide range
+        # with a few keys in it is as cheap as a narrow one
+        tree = self.indices[column]
+        if isinstance(tree, dict):
+            raise Exception("A hash index can't look up ranges, create a btree index for this column instead")
+        rids = []
+        for key, posting in tree.items(begin, end):
+            rids.extend(posting_rids(posting))
+        return rids
 
     def to_arr(self):
       index_arr = []
@@ -89,8 +181,9 @@ class Index:
         data = {}
         if index:
 
-          for v, k in index.items():
-            data[v] = list(k)
+          # Copied first, a checkpoint can run while queries are changing the tree
+          for v, k in list(index.items()):
+            data[v] = list(posting_rids(k))
 
           index_arr.append(data)
         else:
@@ -105,34 +198,215 @@ class Index:
         if data:
           index.indices[i] = OOBTree()
           for k, v in data.items():
-            index.indices[i][int(k)] = set(v)
+            index.indices[i][int(k)] = posting_from_rids(v)
       return index
+    def to_bytes(self):
+      """
+      The whole index in the binary format above. Copies everything it needs from the trees, so the result can be
+      written out after queries start changing the index again
+      """
+      columns = []
+      sections = []
+      for tree in self.indices:
+        if tree is None:
+          columns.append(_INDEX_COLUMN.pack(-1, 0, 0))
+          continue
+        if isinstance(tree, dict):
+          # A hash index isn't in key order, the file always is
+          items = sorted(tree.items(), key=itemgetter(0))
+          keys = array('q', [key for key, posting in items])
+          postings = [posting for key, posting in items]
+        else:
+          keys = array('q', tree.keys())
+          postings = list(tree.values())
+        try:
+          # Every key has a single RID (primary keys), so the postings are the RIDs and no offsets are needed
+          rids = array('q', postings)
+          offsets = None
+        except TypeError:
+          rids = array('q')
+          offsets = array('q', [0])
+          for posting in postings:
+            rids.extend(posting_rids(posting))
+            offsets.append(len(rids))
+        columns.append(_INDEX_COLUMN.pack(len(keys), len(rids), INDEX_KINDS.index(self.kind(tree))))
+        sections += [keys, rids] if offsets is None else [keys, offsets, rids]
+
+      covering = [_INDEX_COVERING_COUNT.pack(len(self.covering))]
+      for column, tree in self.covering.items():
+        keys = array('q', tree.keys())
+        covering.append(_INDEX_COVERING.pack(column, len(keys)))
+        sections += [keys, array('q', tree.values())]
+
+      if sys.byteorder == "big":
+        for section in sections:
+          section.byteswap()
+      header = _INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(self.indices))
+      return b"".join([header] + columns + covering + [section.tobytes() for section in sections])
+
+    @classmethod
+    def from_bytes(cls, table, data):
+      magic, version, num_columns = _INDEX_HEADER.unpack_from(data, 0)
+      if magic != INDEX_MAGIC or version not in (1, 2, INDEX_VERSION):
+        raise Exception("Not an index file")
+      offset = _INDEX_HEADER.size
+      column_struct = _INDEX_COLUMN if version > 1 else _INDEX_COLUMN_V1
+      columns = []
+      for _ in range(num_columns):
+        values = column_struct.unpack_from(data, offset)
+        # Version 1 columns are B-trees
+        columns.append(values if version > 1 else values + (0,))
+        offset += column_struct.size
+      covered = []
+      if version > 2:
+        num_covered, = _INDEX_COVERING_COUNT.unpack_from(data, offset)
+        offset += _INDEX_COVERING_COUNT.size
+        for _ in range(num_covered):
+          covered.append(_INDEX_COVERING.unpack_from(data, offset))
+          offset += _INDEX_COVERING.size
+
+      view = memoryview(data)
+      def read_array(count):
+        nonlocal offset
+        values = array('q')
+        values.frombytes(view[offset:offset + 8 * count])
+        if sys.byteorder == "big":
+          values.byteswap()
+        offset += 8 * count
+        return values
+
+      index = Index(table)
+      for column, (num_keys, num_rids, kind) in enumerate(columns):
+        if num_keys < 0:
+          index.indices[column] = None
+          continue
+        keys = read_array(num_keys)
+        if num_keys == num_rids:
+          postings = read_array(num_rids)
+        else:
+          offsets = read_array(num_keys + 1)
+          rids = read_array(num_rids)
+          postings = []
+          for start, end in zip(offsets, offsets[1:]):
+            # Saved in RID order, so the slices can be used as they are
+            if end - start == 1:
+              postings.append(rids[start])
+            elif end - start > config.POSTING_ARRAY_MAX:
+              postings.append(RidBitmap.from_sorted(rids[start:end]))
+            else:
+              postings.append(rids[start:end])
+        # Keys come out of the file sorted, so this is one bulk load instead of a search per key
+        tree = index.__new_index(INDEX_KINDS[kind])
+        tree.update(list(zip(keys, postings)))
+        index.indices[column] = tree
+
+      for column, num_keys in covered:
+        keys = read_array(num_keys)
+        tree = OOBTree()
+        tree.update(list(zip(keys, read_array(num_keys))))
+        index.covering[column] = tree
+      return index
+
+    def kind(self, tree):
+      # "btree" or "hash", see INDEX_KINDS
+      return "hash" if isinstance(tree, dict) else "btree"
+
+    def __new_index(self, kind):
+      if kind == "btree":
+        return OOBTree()
+      if kind == "hash":
+        return {}
+      raise Exception(f"Unknown index kind {kind}, expected one of {INDEX_KINDS}")
+
     """
     # optional: Create index on specific column
     """
 
-    def create_index(self, column_number):
-      # We are going to grab every thing that has been index, and use a query to get the latest version of the data
-      # Then we put this version into the new indexed column
-
-      # This needs to be done in here to prevent errors
-      from lstore.query import Query
-      query = Query(self.table)
-
+    def create_index(self, column_number, kind="btree"):
+      # Builds the index straight from the page ranges: one pass over the base pages collects the latest value of the
+      # column for every record, then the (value, rid) pairs are sorted and loaded into the tree in key order.
+      # kind="hash" builds a hash index instead, for columns that only ever get equality lookups
       if (self.indices[column_number]):
         raise IndexError("An index for this column already exists")
+      tree = self.__new_index(kind)
+
+      # Every page range is about to be read front to back. Reading through a ring keeps the pages other queries use
+      # in the bufferpool
+      bufferpool = self.table.bufferpool
+      with bufferpool.ring():
+        bufferpool.prefetch(self.table.name, range(self.table.page_ranges_index + 1), [column_number])
+        pairs = self.__scan_latest_values(column_number)
+
+      pairs.sort()
+      postings = []
+      for key, group in groupby(pairs, key=itemgetter(0)):
+        postings.append((key, posting_from_rids([rid for value, rid in group])))
+      tree.update(postings)
+      self.indices[column_number] = tree
+
+    def create_covering_index(self, columns):
+      """
+      Opt-in covering index on the primary key. For every column in columns the latest value is kept by primary key
+      next to the index, and insert, update and delete keep it up to date. Query.sum on those columns is then answered
+      from the index alone without reading any page range. Costs one tree entry per record for every column
+      """
+      # The primary key index turned around gives the key of every RID
+      keys = {}
+      for key, posting in self.indices[self.key].items():
+        for rid in posting_rids(posting):
+          keys[rid] = key
+
+      if any(column in self.covering for column in columns):
+        raise IndexError("The covering index already has this column")
+
+      bufferpool = self.table.bufferpool
+      with bufferpool.ring():
+        bufferpool.prefetch(self.table.name, range(self.table.page_ranges_index + 1), columns)
+        for column in columns:
+          tree = OOBTree()
+          tree.update(sorted((keys[rid], value) for value, rid in self.__scan_latest_values(column) if rid in keys))
+          self.covering[column] = tree
+
+    def __scan_latest_values(self, column_number):
+      """
+      Returns a (value, rid) pair with the latest value of column_number for every record in the table. Only records
+      that had that column updated get their tail record read, and those are read in one batch per page range
+      """
+      column = column_number + config.NUM_META_COLUMNS
+      projected_columns_index = [1 if i == column_number else 0 for i in range(self.table.num_columns)]
+      # Same bit order as the schema encoding in Query, the first column is the highest bit
+      schema_bit = 1 << (self.table.num_columns - 1 - column_number)
+      scanned_columns = [config.RID_COLUMN, config.INDIRECTION_COLUMN, config.SCHEMA_ENCODING_COLUMN, column]
+
+      pairs = []
+      for page_range_index in range(self.table.page_ranges_index + 1):
+        frame = self.table.bufferpool.get_frame(self.table.name, page_range_index, self.table.num_columns)
+        try:
+          page_range = frame.page_range
+          updated = []  # (rid, latest tail rid, base value) of records whose value might be in a tail record
+          for base_page in page_range.base_pages:
+            scans = [chain.from_iterable(view.tolist() for view in base_page.scan_column(scanned_column))
+                     for scanned_column in scanned_columns]
+            for rid, indirection, schema_encoding, value in zip(*scans):
+              if rid == 0:
+                continue  # Deleted
+              if indirection and schema_encoding & schema_bit:
+                updated.append((rid, indirection, value))
+              else:
+                pairs.append((value, rid))
+
+          if updated:
+            locations = [self.table.page_directory[tail_rid][1:] for rid, tail_rid, value in updated]
+            tail_columns = page_range.read_tail_records(locations, projected_columns_index)
+            for position, (rid, tail_rid, value) in enumerate(updated):
+              # The base schema encoding can have bits the latest tail doesn't after undo_latest_update
+              if tail_columns[config.SCHEMA_ENCODING_COLUMN][position] & schema_bit:
+                value = tail_columns[column][position]
+              pairs.append((value, rid))
+        finally:
+          frame.unpin()
 
-      # Create the new Btree
-      self.indices[column_number] = OOBTree()
-
-      # Grab all the rids in the primary key
-      for key in self.indices[self.key].keys():
-        records = query.select(key, self.key, [1] * self.table.num_columns)
-        for record in records:
-          # This includes the meta_data columns which is why it looks so weird
-          full_record = [record.indirection, record.rid, record.timestamp, record.schema_encoding]
-          full_record = full_record + record.columns
-          self.add(full_record)
+      return pairs
 
     """
     # optional: Drop index of specific column
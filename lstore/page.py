@@ -1,41 +1,99 @@
-import json
-import base64
+import mmap
+import struct
+import sys
+from array import array
+
+# Each physical page is 4096 bytes, which is 512 slots of 64 bit ints
+PAGE_SIZE = 4096
+SLOTS_PER_PAGE = PAGE_SIZE // 8
+
+# Pages are stored on disk as big endian 64 bit ints. The array module uses the native byte order, so on
+# little endian machines we have to swap the bytes every time a page goes to or comes from disk.
+_NEEDS_BYTESWAP = sys.byteorder == 'little'
+_SLOT = struct.Struct('>q')
 
 class Page:
 
   def __init__(self, num_records=0):
     # self.num_records = num_records
-    self.data = bytearray(4096)
+    # The slots live in a typed array so reads and writes are a single index instead of a byte loop
+    self.data = array('q', [0]) * SLOTS_PER_PAGE
+    # Pages that haven't been written to disk yet are dirty. Cleared once the page is saved
+    self.dirty = True
 
   def has_capacity(self):
     # each page can hold 512 8 bytes records
-    return self.num_records < 512
+    return self.num_records < SLOTS_PER_PAGE
 
   def write(self, value, slot):
     """
-    Writing to the page. Slot number has to be specified. Value is converted into bytes because
-    the page stores data in a byte array.
+    Writing to the page. Slot number has to be specified. Value is stored as a 64 bit (aka 8byte) int
     """
-    # Value is a 64 bit (aka 8byte) int
-    val_to_byte = value.to_bytes(8, byteorder='big')
-    # Insert by bytes
-    i = slot * 8
-    for byte in val_to_byte:
-      self.data[i] = byte
-      i += 1
+    if slot < 0:
+      raise IndexError("Page slot out of range")
+    self.data[slot] = value
+    self.dirty = True
 
   def read(self, slot):
-    return int.from_bytes(self.data[slot * 8: (slot + 1) * 8], byteorder='big')
+    if slot < 0:
+      raise IndexError("Page slot out of range")
+    return self.data[slot]
+
+  def read_many(self, slots):
+    """
+    Reads a group of slots in one call. Returns the values in the same order as the slots were given
+    """
+    data = self.data
+    return [data[slot] for slot in slots]
+
+  def view(self, start_slot=0, end_slot=SLOTS_PER_PAGE):
+    """
+    A memoryview of native 64 bit ints over the slots from start_slot up to (not including) end_slot. No copy is
+    made, the view points straight at the page
+    """
+    return memoryview(self.data)[start_slot:end_slot]
+
+  def write_many(self, start_slot, values):
+    """
+    Writes values into consecutive slots starting at start_slot. Useful for filling up a page with a batch of
+    records instead of going one slot at a time
+    """
+    end_slot = start_slot + len(values)
+    if start_slot < 0 or end_slot > SLOTS_PER_PAGE:
+      raise IndexError("Page slot out of range")
+    self.data[start_slot:end_slot] = array('q', values)
+    self.dirty = True
+
+  def to_bytes(self):
+    """
+    Returns the page in its on disk format (512 big endian 64 bit ints)
+    """
+    if not _NEEDS_BYTESWAP:
+      return self.data.tobytes()
+    swapped = array('q', self.data)
+    swapped.byteswap()
+    return swapped.tobytes()
 
   @classmethod
-  def from_dict(cls, path):
+  def from_bytes(cls, raw):
     new_page = cls()
+    new_page.data = array('q')
+    new_page.data.frombytes(raw)
+    if _NEEDS_BYTESWAP:
+      new_page.data.byteswap()
+    new_page.dirty = False
+    return new_page
+
+  def save(self, path):
+    with open(path, 'wb+') as data_file:
+      data_file.write(self.to_bytes())
+    self.dirty = False
 
+  @classmethod
+  def from_dict(cls, path):
     # read the page from disk
     with open(path, 'rb') as data_file:
-        new_page.data = bytearray(data_file.read())
-
-    return new_page
+        return cls.from_bytes(data_file.read())
 
   # def to_json_string(self):
   #   return json.dumps(self.to_dict())
@@ -47,4 +105,81 @@ class Page:
   #   new_page = Page()
   #   # new_page.data = base64.b64decode(data["byte_array"])
   #   new_page.num_records = data["num_records"]
-  #   return new_page
\ No newline at end of file
+  #   return new_page
+
+
+class MappedPage(Page):
+  """
+  A physical page that reads and writes straight through a memory mapping of its file instead of loading
+  the file into memory. Nothing is read from disk until a slot is actually touched, and writes land in the
+  mapping so saving only has to flush it. The mapping keeps the on disk big endian layout, so slots are
+  decoded with struct instead of going through an array.
+  """
+
+  def __init__(self, buffer, offset=0, path=None):
+    self.buffer = buffer
+    self.offset = offset
+    self.path = path
+    self.dirty = False
+
+  @property
+  def data(self):
+    # A native array copy of the whole page. This is a copy, writes to it don't reach the mapping
+    return Page.from_bytes(self.to_bytes()).data
+
+  def view(self, start_slot=0, end_slot=SLOTS_PER_PAGE):
+    # The mapping is big endian. On big endian machines that's the native layout so the view points straight at the
+    # mapping, everywhere else only the slots asked for are decoded into a native copy
+    raw = memoryview(self.buffer)[self.offset + start_slot * 8:self.offset + end_slot * 8]
+    if not _NEEDS_BYTESWAP:
+      return raw.cast('q')
+    values = array('q')
+    values.frombytes(raw)
+    raw.release()
+    values.byteswap()
+    return memoryview(values)
+
+  def write(self, value, slot):
+    if slot < 0 or slot >= SLOTS_PER_PAGE:
+      raise IndexError("Page slot out of range")
+    _SLOT.pack_into(self.buffer, self.offset + slot * 8, value)
+    self.dirty = True
+
+  def read(self, slot):
+    if slot < 0 or slot >= SLOTS_PER_PAGE:
+      raise IndexError("Page slot out of range")
+    return _SLOT.unpack_from(self.buffer, self.offset + slot * 8)[0]
+
+  def read_many(self, slots):
+    buffer = self.buffer
+    offset = self.offset
+    return [_SLOT.unpack_from(buffer, offset + slot * 8)[0] for slot in slots]
+
+  def write_many(self, start_slot, values):
+    end_slot = start_slot + len(values)
+    if start_slot < 0 or end_slot > SLOTS_PER_PAGE:
+      raise IndexError("Page slot out of range")
+    struct.pack_into(f'>{len(values)}q', self.buffer, self.offset + start_slot * 8, *values)
+    self.dirty = True
+
+  def to_bytes(self):
+    return bytes(self.buffer[self.offset:self.offset + PAGE_SIZE])
+
+  def flush(self):
+    self.buffer.flush(self.offset, PAGE_SIZE)
+    self.dirty = False
+
+  def save(self, path):
+    # Writes already went through the mapping, so the file only needs to be synced. If the page is being saved
+    # somewhere else we fall back to writing a copy.
+    if path == self.path:
+      self.flush()
+    else:
+      super().save(path)
+
+  @classmethod
+  def from_file(cls, path):
+    with open(path, 'r+b') as data_file:
+      # mmap keeps its own handle on the file so we can close ours right away
+      buffer = mmap.mmap(data_file.fileno(), PAGE_SIZE)
+    return cls(buffer, 0, path)
@@ -1,5 +1,6 @@
 from lstore.conceptual_page import ConceptualPage
 from lstore.page import Page
+from lstore.segment import SegmentFile
 import lstore.config as config
 from time import time
 import os, json
@@ -16,6 +17,9 @@ class PageRange:
     self.tail_pages = [ConceptualPage(num_columns)]
     self.tail_pages_index = 0 # M3: TODO: Atomize
     self.tail_pages_slot = 0 # M3: TODO: Atomize
+    # The bufferpool caching this page range's physical pages and the key prefix for them, see attach_cache
+    self.cache = None
+    self.cache_key = None
 
   def has_base_page_capacity(self):
     """
@@ -30,16 +34,42 @@ class PageRange:
     Allocates a new basepage only if needed and changes the location pointers of where to write to
     """
     if len(self.base_pages) < 16 and not self.base_pages[-1].has_capacity():
-      self.base_pages.append(ConceptualPage(self.regular_columns))
+      self.base_pages.append(self.__new_conceptual_page("base", len(self.base_pages)))
       self.base_pages_index += 1 # Move up the base pages we are writing into
       self.base_pages_slot = 0 # This should get reset from 4095 to 0
 
   def __allocate_new_tail_page(self):
     if not self.tail_pages[-1].has_capacity():
-      self.tail_pages.append(ConceptualPage(self.regular_columns))
+      self.tail_pages.append(self.__new_conceptual_page("tail", len(self.tail_pages)))
       self.tail_pages_index += 1  # Move up the base pages we are writing into
       self.tail_pages_slot = 0  # This should get reset from 4095 to 0
 
+  def __new_conceptual_page(self, kind, index):
+    conceptual_page = ConceptualPage(self.regular_columns)
+    if self.cache is not None:
+      conceptual_page.attach_cache(self.cache, self.cache_key + (kind, index))
+    return conceptual_page
+
+  def attach_cache(self, cache, table_name, position):
+    """
+    Hands the physical pages of every conceptual page, including ones allocated later, to the bufferpool so it can
+    cache and evict them one at a time. Keys look like (table name, page range index, "base" or "tail", conceptual
+    page index, column, level)
+    """
+    self.cache = cache
+    self.cache_key = (table_name, position)
+    for kind, index, conceptual_page in self.conceptual_pages():
+      conceptual_page.attach_cache(cache, self.cache_key + (kind, index))
+
+  def conceptual_pages(self):
+    """
+    Yields ("base" or "tail", index, conceptual page) for every conceptual page in the range
+    """
+    for index, conceptual_page in enumerate(self.base_pages):
+      yield "base", index, conceptual_page
+    for index, conceptual_page in enumerate(self.tail_pages):
+      yield "tail", index, conceptual_page
+
   def write_base_record(self, record):
     """
     Writes a new record into one of the base pages. Returns the location of the page within the
@@ -56,6 +86,21 @@ class PageRange:
 
     return location
 
+  def write_base_records(self, records):
+    """
+    Bulk version of write_base_record. Writes records until they run out or the page range is full. Returns the
+    locations (base page index, slot) of the records that were written, in order, so the caller can tell how many fit
+    """
+    locations = []
+    while len(locations) < len(records) and self.has_base_page_capacity():
+      written = self.base_pages[self.base_pages_index].write_records(records[len(locations):])
+      locations.extend((self.base_pages_index, slot) for slot in range(self.base_pages_slot, self.base_pages_slot + written))
+
+      self.base_pages_slot += written
+      self.__allocate_new_base_page()
+
+    return locations
+
   def write_tail_record(self, record):
     if len(record) != self.total_columns:
       raise IndexError(f"Expected #{self.regular_columns}, you only gave #{len(record)} in PageRange")
@@ -85,6 +130,62 @@ class PageRange:
     regular_data = self.tail_pages[tail_page_index].read_record_at(tail_page_slot, projected_column_index)
     return meta_data + regular_data
 
+  def __read_records(self, conceptual_pages, locations, projected_column_index):
+    if len(locations) == 1:
+      # Point lookups are the common case, grouping isn't worth it for one record
+      page_index, slot = locations[0]
+      conceptual_page = conceptual_pages[page_index]
+      record = conceptual_page.read_metadata_at(slot)
+      if any(projected_column_index):
+        record += conceptual_page.read_record_at(slot, projected_column_index)
+      else:
+        record += [None] * self.regular_columns
+      return [[value] if column < self.meta_data_columns or projected_column_index[column - self.meta_data_columns] else None
+              for column, value in enumerate(record)]
+
+    # Group the locations by conceptual page, read each group in one go, then put the values back in order
+    pages = {}
+    for position, (page_index, slot) in enumerate(locations):
+      positions, slots = pages.setdefault(page_index, ([], []))
+      positions.append(position)
+      slots.append(slot)
+
+    columns = [None] * self.total_columns
+    for page_index, (positions, slots) in pages.items():
+      page_columns = conceptual_pages[page_index].read_records(slots, projected_column_index)
+      for column, values in enumerate(page_columns):
+        if values is None:
+          continue
+        if columns[column] is None:
+          columns[column] = [None] * len(locations)
+        for position, value in zip(positions, values):
+          columns[column][position] = value
+
+    return columns
+
+  def read_base_records(self, locations, projected_column_index):
+    """
+    Batched read_base_record. locations is a list of (base page index, slot) pairs. Returns one list per column
+    (metadata columns first) with the values in the same order as the locations, or None for columns that aren't
+    projected
+    """
+    return self.__read_records(self.base_pages, locations, projected_column_index)
+
+  def read_tail_records(self, locations, projected_column_index):
+    """
+    Batched read_tail_record, same format as read_base_records
+    """
+    return self.__read_records(self.tail_pages, locations, projected_column_index)
+
+  def scan_column(self, column):
+    """
+    Chains ConceptualPage.scan_column across every base page in the range. Yields memoryviews over the physical pages
+    of one column (metadata columns included in the numbering), in slot order. Mapped pages may hand out copies, see
+    ConceptualPage.scan_column.
+    """
+    for base_page in self.base_pages:
+      yield from base_page.scan_column(column)
+
   def update_base_record_column(self, base_page_index, base_page_slot, column, data):
     """
     A method should be used for actions like rewriting the schema encoding, rewriting the indirection column, setting the RID column
@@ -129,6 +230,49 @@ class PageRange:
     
     return new_page_range
   
+  def save_segment(self, path, checkpoint=None):
+    """
+    Saves the page range into a single segment file (see lstore/segment.py). Only dirty physical pages are written.
+    With a checkpoint, blocks written in place are undo logged against it first. Returns the number of bytes written
+    """
+    bytes_written = 0
+    with SegmentFile(path, checkpoint) as segment:
+      page_table = self.to_dict()
+      for key, conceptual_pages in (("base_pages", self.base_pages), ("tail_pages", self.tail_pages)):
+        page_table[key] = []
+        for conceptual_page in conceptual_pages:
+          data, page_bytes = conceptual_page.save_to_segment(segment)
+          page_table[key].append(data)
+          bytes_written += page_bytes
+      bytes_written += segment.write_page_table(page_table)
+
+    return bytes_written
+
+  @classmethod
+  def from_segment(cls, path, num_columns=None):
+    """
+    Loads a page range from its segment file. A segment without a page table never got a save finished (the first one
+    was cut off), so nothing in it counts: with num_columns given that's an empty page range, without it an error
+    """
+    with SegmentFile(path) as segment:
+      page_table = segment.read_page_table()
+      if page_table is None:
+        if num_columns is None:
+          raise Exception(f"{path} has no page table, it was never saved completely")
+        return cls(num_columns)
+      new_page_range = cls(page_table["regular_columns"])
+      new_page_range.meta_data_columns = page_table["meta_data_columns"]
+      new_page_range.base_pages_index = page_table["base_pages_index"]
+      new_page_range.base_pages_slot = page_table["base_pages_slot"]
+      new_page_range.tail_pages_index = page_table["tail_pages_index"]
+      new_page_range.tail_pages_slot = page_table["tail_pages_slot"]
+
+      buffer = segment.map() if config.MMAP_PAGES else None
+    new_page_range.base_pages = [ConceptualPage.from_segment(data, path, buffer) for data in page_table["base_pages"]]
+    new_page_range.tail_pages = [ConceptualPage.from_segment(data, path, buffer) for data in page_table["tail_pages"]]
+
+    return new_page_range
+
   def save_contents(self, path):
 
     # save base pages
@@ -151,8 +295,7 @@ class PageRange:
         # write binary data to path
         for k in range(len(page)):
           bin_path = os.path.join(bp_col_path, f"{k}.bin")
-          with open(bin_path, 'wb+') as data_file:
-            data_file.write(page[k].data)
+          page[k].save(bin_path)
         
     # save tail pages
     for i in range(len(self.tail_pages)):
@@ -174,8 +317,7 @@ class PageRange:
         # write binary data to disk
         for k in range(len(page)):
           bin_path = os.path.join(tp_col_path, f"{k}.bin")
-          with open(bin_path, 'wb+') as data_file:
-            data_file.write(page[k].data)
+          page[k].save(bin_path)
 
   def open_conceptual_pages(self, path):
     base_pairs = []
@@ -0,0 +1,195 @@
+from array import array
+from bisect import bisect_left
+
+import lstore.config as config
+
+"""
+Posting lists for the index, the RIDs stored under one key. Each key keeps its RIDs in the smallest thing that fits:
+
+  one RID         a plain int. Every primary key ends up like this
+  a few RIDs      a sorted array('q'), 8 bytes per RID
+  lots of RIDs    a RidBitmap (see below), used once an array gets past config.POSTING_ARRAY_MAX RIDs
+
+The functions here take the posting that is in the tree and return the one that should be stored from now on, which
+might be a different type than the one that came in.
+"""
+
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+ARRAY_CHUNK_MAX = 4096  # Past this many RIDs a chunk takes less room as a bitmap (8 KB) than as an array('H')
+
+
+class RidBitmap:
+  """
+  Compressed bitmap in the style of roaring bitmaps. RIDs are split by their high bits into chunks of 2^16, and each
+  chunk only stores the low 16 bits: a sorted array('H') while the chunk is sparse, a 8 KB bitmap once it's dense.
+  RIDs are handed out in order so the RIDs of a low cardinality column mostly land in dense chunks.
+  """
+  __slots__ = ("chunks", "size")
+
+  def __init__(self, rids=()):
+    self.chunks = {}  # high bits -> array('H') of low bits or a bytearray bitmap
+    self.size = 0
+    if rids:
+      self.__fill(sorted(set(rids)))
+
+  @classmethod
+  def from_sorted(cls, rids):
+    """
+    Same as RidBitmap(rids) for RIDs that are already sorted with no duplicates in them, skips sorting them again
+    """
+    bitmap = cls()
+    bitmap.__fill(rids)
+    return bitmap
+
+  def __fill(self, rids):
+    # Built a whole chunk at a time instead of one add per RID
+    start = 0
+    while start < len(rids):
+      high = rids[start] >> CHUNK_BITS
+      end = bisect_left(rids, (high + 1) << CHUNK_BITS, start)
+      chunk = array('H', map(CHUNK_MASK.__and__, rids[start:end]))
+      self.chunks[high] = self.__to_bitmap(chunk) if len(chunk) > ARRAY_CHUNK_MAX else chunk
+      self.size += end - start
+      start = end
+
+  def add(self, rid):
+    high, low = rid >> CHUNK_BITS, rid & CHUNK_MASK
+    chunk = self.chunks.get(high)
+    if chunk is None:
+      self.chunks[high] = array('H', [low])
+    elif isinstance(chunk, bytearray):
+      if chunk[low >> 3] & (1 << (low & 7)):
+        return
+      chunk[low >> 3] |= 1 << (low & 7)
+    else:
+      position = bisect_left(chunk, low)
+      if position < len(chunk) and chunk[position] == low:
+        return
+      chunk.insert(position, low)
+      if len(chunk) > ARRAY_CHUNK_MAX:
+        self.chunks[high] = self.__to_bitmap(chunk)
+    self.size += 1
+
+  def remove(self, rid):
+    high, low = rid >> CHUNK_BITS, rid & CHUNK_MASK
+    chunk = self.chunks.get(high)
+    if chunk is None:
+      raise KeyError(rid)
+    if isinstance(chunk, bytearray):
+      if not chunk[low >> 3] & (1 << (low & 7)):
+        raise KeyError(rid)
+      chunk[low >> 3] &= ~(1 << (low & 7))
+      # Dense chunks stay bitmaps when they empty out a bit, it's only dropped once nothing is left in it
+      if not any(chunk):
+        del self.chunks[high]
+    else:
+      position = bisect_left(chunk, low)
+      if position == len(chunk) or chunk[position] != low:
+        raise KeyError(rid)
+      del chunk[position]
+      if not chunk:
+        del self.chunks[high]
+    self.size -= 1
+
+  def __to_bitmap(self, chunk):
+    bitmap = bytearray((CHUNK_MASK + 1) >> 3)
+    for low in chunk:
+      bitmap[low >> 3] |= 1 << (low & 7)
+    return bitmap
+
+  def __contains__(self, rid):
+    chunk = self.chunks.get(rid >> CHUNK_BITS)
+    if chunk is None:
+      return False
+    low = rid & CHUNK_MASK
+    if isinstance(chunk, bytearray):
+      return bool(chunk[low >> 3] & (1 << (low & 7)))
+    position = bisect_left(chunk, low)
+    return position < len(chunk) and chunk[position] == low
+
+  def __len__(self):
+    return self.size
+
+  def __iter__(self):
+    # In RID order. The chunks are listed first so a writer adding a chunk doesn't break someone iterating
+    for high in sorted(self.chunks):
+      chunk = self.chunks.get(high)
+      if chunk is None:
+        continue
+      base = high << CHUNK_BITS
+      if isinstance(chunk, bytearray):
+        for byte_index, byte in enumerate(chunk):
+          while byte:
+            bit = byte & -byte
+            yield base | (byte_index << 3) | (bit.bit_length() - 1)
+            byte ^= bit
+      else:
+        for low in chunk:
+          yield base | low
+
+
+def posting_add(posting, rid):
+  """
+  Adds rid to posting (None for a key that isn't in the tree yet). Returns the posting to store
+  """
+  if posting is None:
+    return rid
+  if isinstance(posting, int):
+    if posting == rid:
+      return posting
+    return array('q', (posting, rid) if posting < rid else (rid, posting))
+  if isinstance(posting, array):
+    position = bisect_left(posting, rid)
+    if position < len(posting) and posting[position] == rid:
+      return posting
+    posting.insert(position, rid)
+    if len(posting) > config.POSTING_ARRAY_MAX:
+      return RidBitmap.from_sorted(posting)
+    return posting
+  posting.add(rid)
+  return posting
+
+
+def posting_remove(posting, rid):
+  """
+  Removes rid from posting. Returns the posting to store, or None once the last RID is gone. Raises a KeyError if
+  rid wasn't there
+  """
+  if isinstance(posting, int):
+    if posting != rid:
+      raise KeyError(rid)
+    return None
+  if isinstance(posting, array):
+    position = bisect_left(posting, rid)
+    if position == len(posting) or posting[position] != rid:
+      raise KeyError(rid)
+    del posting[position]
+    return posting[0] if len(posting) == 1 else posting
+  posting.remove(rid)
+  # Halfway back down before going back to an array so a key hovering around the limit doesn't keep converting
+  if len(posting) <= config.POSTING_ARRAY_MAX // 2:
+    return posting_from_rids(posting)
+  return posting
+
+
+def posting_rids(posting):
+  """
+  The RIDs in a posting as something iterable that also supports len and in. No copy is made, this is the posting
+  itself unless it's a single RID
+  """
+  if isinstance(posting, int):
+    return (posting,)
+  return posting
+
+
+def posting_from_rids(rids):
+  """
+  Builds the posting for a bunch of RIDs in one go
+  """
+  rids = sorted(set(rids))
+  if len(rids) == 1:
+    return rids[0]
+  if len(rids) > config.POSTING_ARRAY_MAX:
+    return RidBitmap.from_sorted(rids)
+  return array('q', rids)
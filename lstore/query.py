@@ -1,13 +1,14 @@
 import threading
 import time
 from binascii import b2a_hex
+from contextlib import nullcontext
+from itertools import islice
 
 from lstore.bufferpool import BufferPool, Frame
 from lstore.page_range import PageRange
 from lstore.table import Table
-from lstore.record import Record
+from lstore.record import LazyRecord
 import lstore.config as config
-from datetime import datetime
 
 class Query:
     """
@@ -49,46 +50,52 @@ class Query:
     """
     def delete(self, primary_key):
         # After your all done, remove the primary key from the primary key index
-        rids = self.table.index.locate(self.table.key, primary_key).copy()
+        rids = self.table.index.locate(self.table.key, primary_key)
 
         if not rids:
           return False
+        # The index changes as the records get deleted
+        rids = list(rids)
 
-        for rid in rids:
-          page_range_index, base_page_index, base_slot = self.table.page_directory[rid]
+        # Held like update does, so a checkpoint never copies the table halfway through a delete
+        with self.table.update_record:
+          for rid in rids:
+            page_range_index, base_page_index, base_slot = self.table.page_directory[rid]
 
-          frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index,
-                                                   self.table.num_columns)
-          frame.pin += 1
-          page_range: PageRange = frame.page_range
+            frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index,
+                                                     self.table.num_columns)
+            page_range: PageRange = frame.page_range
 
-          base_record = page_range.read_base_record(base_page_index, base_slot, [1] * self.table.num_columns)
+            base_record = page_range.read_base_record(base_page_index, base_slot, [1] * self.table.num_columns)
 
-          page_range.update_base_record_column(base_page_index, base_slot, config.RID_COLUMN, 0)
+            # The index has the record's latest values, not the ones it was inserted with. Done before the RID is
+            # cleared so a failing index delete doesn't leave the record half deleted
+            self.table.index.delete(self.__latest_record(page_range, base_record))
 
-          self.table.index.delete(base_record)
-          frame.is_dirty = True
-          frame.pin -= 1
-          # self.table.page_directory[rid] = None
+            page_range.update_base_record_column(base_page_index, base_slot, config.RID_COLUMN, 0)
+            frame.is_dirty = True
+            frame.unpin()
+            # self.table.page_directory[rid] = None
 
         return True
 
     def undo_delete(self, base_rid):
-        page_range_index, base_page_index, base_slot = self.table.page_directory[base_rid]
+        with self.table.update_record:
+          page_range_index, base_page_index, base_slot = self.table.page_directory[base_rid]
 
-        frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index,
-                                                 self.table.num_columns)
-        frame.pin += 1
-        page_range: PageRange = frame.page_range
+          frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index,
+                                                   self.table.num_columns)
+          page_range: PageRange = frame.page_range
 
-        base_record = page_range.read_base_record(base_page_index, base_slot, [1] * self.table.num_columns)
-        base_record[config.RID_COLUMN] = base_rid
+          base_record = page_range.read_base_record(base_page_index, base_slot, [1] * self.table.num_columns)
+          base_record[config.RID_COLUMN] = base_rid
 
-        page_range.update_base_record_column(base_page_index, base_slot, config.RID_COLUMN, base_rid)
+          page_range.update_base_record_column(base_page_index, base_slot, config.RID_COLUMN, base_rid)
 
-        self.table.index.add(base_record)
-        frame.is_dirty = True
-        frame.pin -= 1
+          # Back in the index (and its covered columns) with its latest values, same as delete took out
+          self.table.index.add(self.__latest_record(page_range, base_record))
+          frame.is_dirty = True
+          frame.unpin()
 
         return
 
@@ -105,15 +112,19 @@ class Query:
     def __number_to_bit_array(self, num, bit_size):
             return [int(bit) for bit in f"{num:0{bit_size}b}"]
 
-    def __build_record(self, record_data, search_key):
-      time = datetime.fromtimestamp(float(record_data[config.TIMESTAMP_COLUMN]))
-      schema_encoding = self.__number_to_bit_array(record_data[config.SCHEMA_ENCODING_COLUMN], self.table.num_columns)
-      # I'm sorry this is a little long
-      record_data[config.TIMESTAMP_COLUMN] = time
-      record_data[config.SCHEMA_ENCODING_COLUMN] = schema_encoding
-
-      record = Record(record_data, search_key)
-      return record
+    def __latest_record(self, page_range, base_record):
+      # A copy of a full base record with the values from its latest tail record filled in. The tail's own schema
+      # encoding says what it has, the base one can have extra bits after undo_latest_update
+      latest_record = list(base_record)
+      latest_tail_rid = base_record[config.INDIRECTION_COLUMN]
+      if latest_tail_rid != 0:
+        _, tail_index, tail_slot = self.table.page_directory[latest_tail_rid]
+        tail_record = page_range.read_tail_record(tail_index, tail_slot, [1] * self.table.num_columns)
+        for i, data in enumerate(
+          self.__number_to_bit_array(tail_record[config.SCHEMA_ENCODING_COLUMN], self.table.num_columns)):
+          if data == 1:
+            latest_record[config.NUM_META_COLUMNS + i] = tail_record[config.NUM_META_COLUMNS + i]
+      return latest_record
 
     def insert(self, *columns):
         if len(columns) != self.table.num_columns:
@@ -124,19 +135,18 @@ class Query:
         if columns[pk_column] in self.table.index.indices[pk_column]:
           return False
 
-        rid = self.table.new_rid()
         # TODO: Request Page logic (???) maybe link page range logic to bufferpool
         # bufferpool request range (self.table, index)
 
         frame: Frame = self.bufferpool.get_frame(self.table.name, self.table.page_ranges_index, self.table.num_columns)
-        frame.pin += 1
         page_range: PageRange = frame.page_range
 
-        frame.is_dirty = True
         # TODO: Decrement Pin Count
 
         # Create an array with the metadata columns, and then add in the regular data columns
         with self.table.new_record:
+          # RID taken under the lock, like insert_many, so a checkpoint never saves a RID whose record isn't written yet
+          rid = self.table.new_rid()
           new_record = self.create_metadata(rid)
           for data in columns:
             new_record.append(data)
@@ -145,14 +155,76 @@ class Query:
           # - add the RID and location into the page directory
           self.table.page_directory[rid] = (self.table.page_ranges_index, index, slot)
           self.table.index.add(new_record)
-        # - add the record in the index
-
-        frame.pin -= 1
+          # - add the record in the index
+          # Marked dirty before the lock is let go, like insert_many. A checkpoint that copies the page directory
+          # with this RID in it has to see the frame dirty too, or it won't flush the record
+          frame.is_dirty = True
+        frame.unpin()
 
         self.table.add_new_page_range() # Page range is only added if needed
 
         return True
 
+    """
+    # Insert many records at once. rows can be any iterable of column lists, including a generator
+    # Rows that insert would reject (wrong number of columns or a primary key that already exists) are skipped
+    # Returns the number of records inserted
+    """
+    def insert_many(self, rows):
+        inserted = 0
+        rows = iter(rows)
+        while True:
+          # One base page worth of rows at a time, so a generator never has to be loaded all at once
+          batch = list(islice(rows, 4096))
+          if not batch:
+            break
+          inserted += self.__insert_batch(batch)
+
+        return inserted
+
+    def __insert_batch(self, rows):
+        pk_column = self.table.index.key
+        primary_index = self.table.index.indices[pk_column]
+
+        # Check the keys for the whole batch up front, this includes duplicates inside the batch itself
+        batch_keys = set()
+        valid_rows = []
+        for columns in rows:
+          if len(columns) != self.table.num_columns:
+            continue
+          key = columns[pk_column]
+          if key in batch_keys or key in primary_index:
+            continue
+          batch_keys.add(key)
+          valid_rows.append(columns)
+
+        if not valid_rows:
+          return 0
+
+        with self.table.new_record:
+          rids = self.table.new_rids(len(valid_rows))
+          # Same metadata create_metadata builds, but with one timestamp for the whole batch
+          timestamp = int(time.time())
+          new_records = [[0, rid, timestamp, 0, *columns] for rid, columns in zip(rids, valid_rows)]
+
+          written = 0
+          while written < len(new_records):
+            frame: Frame = self.bufferpool.get_frame(self.table.name, self.table.page_ranges_index, self.table.num_columns)
+            # Fills whole physical pages column by column, stops early if the page range runs out of room
+            locations = frame.page_range.write_base_records(new_records[written:])
+            frame.is_dirty = True
+            page_range_index = self.table.page_ranges_index
+            self.table.page_directory.update(
+              zip(rids[written:], [(page_range_index, index, slot) for index, slot in locations]))
+            frame.unpin()
+
+            written += len(locations)
+            self.table.add_new_page_range() # Page range is only added if needed
+
+          self.table.index.add_many(new_records)
+
+        return len(new_records)
+
     """
     # Read matching record with specified search key
     # :param search_key: the value you want to search based on
@@ -173,21 +245,28 @@ class Query:
       if rids is None:
         return []
 
-      with threading.RLock():
-        for rid in rids:
-          page_range_index, base_page_index, slot = self.table.page_directory[rid]
+      # Group the rids by page range so every page range is fetched once and read in one batch
+      page_ranges = {}
+      for rid in rids:
+        page_range_index, base_page_index, slot = self.table.page_directory[rid]
+        page_ranges.setdefault(page_range_index, []).append((base_page_index, slot))
 
+      with threading.RLock():
+        for page_range_index, locations in page_ranges.items():
           # Get the needed page range
           frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index, self.table.num_columns)
-          frame.pin += 1
           page_range: PageRange = frame.page_range
 
           # We know we can read from a base record because the rid in a page directory points to a page record
-          record_data = page_range.read_base_record(base_page_index, slot, projected_columns_index)
-          record = self.__build_record(record_data, search_key)
-          records.append(record)
+          # Everything is read in one batch while the frame is pinned, the records only build their column lists
+          # when someone actually uses them
+          columns = page_range.read_base_records(locations, projected_columns_index)
+          for position in range(len(locations)):
+            metadata = [columns[i][position] for i in range(config.NUM_META_COLUMNS)]
+            record = LazyRecord(columns, position, projected_columns_index, search_key, metadata)
+            records.append(record)
 
-        frame.pin -= 1
+          frame.unpin()
 
       return records
     """
@@ -216,7 +295,6 @@ class Query:
 
             frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index,
                                                      self.table.num_columns)
-            frame.pin += 1
             page_range: PageRange = frame.page_range
             return_base_record = False
             # Get the tail record
@@ -232,7 +310,7 @@ class Query:
               tail_record = page_range.read_tail_record(tail_index, tail_slot, projected_columns_index)
               version_num -= 1
 
-            frame.pin -= 1
+            frame.unpin()
 
             # relative_version < version_num means that we ran out of versions to traverse
             if return_base_record or relative_version < version_num:
@@ -253,46 +331,48 @@ class Query:
 
     def undo_latest_update(self, base_rid):
       # Note: This should only run when the base_record has an update
-      page_range_index, bp_index, bp_slot =  self.table.page_directory[base_rid]
-
-      frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index,
-                                               self.table.num_columns)
-      frame.pin += 1
-      page_range: PageRange = frame.page_range
-
-      base_record = page_range.read_base_record(bp_index, bp_slot, [1] * self.table.num_columns)
-      latest_tail_rid = base_record[config.INDIRECTION_COLUMN]
-      page_range_index, tp_index, tp_slot = self.table.page_directory[latest_tail_rid]
-      latest_tail_record = page_range.read_tail_record(tp_index, tp_slot, [1] * self.table.num_columns)
-
-      latest_version = base_record
+      with self.table.update_record:
+        page_range_index, bp_index, bp_slot =  self.table.page_directory[base_rid]
 
-      for i, data in enumerate(
-        self.__number_to_bit_array(latest_tail_record[config.SCHEMA_ENCODING_COLUMN], self.table.num_columns)):
-        # Only add in the updated data
-        if data == 1:
-          latest_version[config.NUM_META_COLUMNS + i] = latest_tail_record[config.NUM_META_COLUMNS + i]
+        frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index,
+                                                 self.table.num_columns)
+        page_range: PageRange = frame.page_range
 
-      self.table.index.delete(latest_version) # Maintaining the index
+        base_record = page_range.read_base_record(bp_index, bp_slot, [1] * self.table.num_columns)
+        latest_tail_rid = base_record[config.INDIRECTION_COLUMN]
+        page_range_index, tp_index, tp_slot = self.table.page_directory[latest_tail_rid]
+        latest_tail_record = page_range.read_tail_record(tp_index, tp_slot, [1] * self.table.num_columns)
 
-      behind_latest_rid = latest_tail_record[config.INDIRECTION_COLUMN]
+        latest_version = list(base_record)  # A copy, base_record is still needed as it was
 
-      if behind_latest_rid == base_rid: # This will change the indirection for the base_record back to 0
-        behind_latest_rid = 0
-        self.table.index.add(base_record) # Maintaining the index
-      else:
-        page_range_index, new_latest_tail, new_latest_slot = self.table.page_directory[behind_latest_rid]
-        new_latest_tail = page_range.read_tail_record(new_latest_tail, new_latest_slot, [1] * self.table.num_columns)
-        updated_record = base_record
         for i, data in enumerate(
-          self.__number_to_bit_array(new_latest_tail[config.SCHEMA_ENCODING_COLUMN], self.table.num_columns)):
+          self.__number_to_bit_array(latest_tail_record[config.SCHEMA_ENCODING_COLUMN], self.table.num_columns)):
           # Only add in the updated data
           if data == 1:
-            updated_record[config.NUM_META_COLUMNS + i] = new_latest_tail[config.NUM_META_COLUMNS + i]
-        self.table.index.add(updated_record) # Maintaining the index
-
-      # Pretty much skipping over the last update
-      page_range.update_base_record_column(bp_index, bp_slot, config.INDIRECTION_COLUMN, behind_latest_rid)
+            latest_version[config.NUM_META_COLUMNS + i] = latest_tail_record[config.NUM_META_COLUMNS + i]
+
+        self.table.index.delete(latest_version) # Maintaining the index
+
+        behind_latest_rid = latest_tail_record[config.INDIRECTION_COLUMN]
+
+        if behind_latest_rid == base_rid: # This will change the indirection for the base_record back to 0
+          behind_latest_rid = 0
+          self.table.index.add(base_record) # Maintaining the index
+        else:
+          page_range_index, new_latest_tail, new_latest_slot = self.table.page_directory[behind_latest_rid]
+          new_latest_tail = page_range.read_tail_record(new_latest_tail, new_latest_slot, [1] * self.table.num_columns)
+          updated_record = base_record
+          for i, data in enumerate(
+            self.__number_to_bit_array(new_latest_tail[config.SCHEMA_ENCODING_COLUMN], self.table.num_columns)):
+            # Only add in the updated data
+            if data == 1:
+              updated_record[config.NUM_META_COLUMNS + i] = new_latest_tail[config.NUM_META_COLUMNS + i]
+          self.table.index.add(updated_record) # Maintaining the index
+
+        # Pretty much skipping over the last update
+        page_range.update_base_record_column(bp_index, bp_slot, config.INDIRECTION_COLUMN, behind_latest_rid)
+        frame.is_dirty = True
+        frame.unpin()
 
       return
     """
@@ -306,25 +386,28 @@ class Query:
       if columns[pk_column] is not None and primary_key != columns[pk_column]:
         return False
 
-      rids = self.table.index.locate(self.table.key, primary_key).copy()
-
-      # Now that we have the RIDS, lets remove the old version of the records from our index, but this will
-      # be done after we are done updating
-      old_records = self.select(primary_key, self.table.index.key, [1] * self.table.num_columns)
+      rids = self.table.index.locate(self.table.key, primary_key)
 
       if rids is None:
         return False
 
+      # Only the indexed columns this update writes can change the index. Their old values are read while
+      # updating, and the RIDs are moved to their new keys once we're done
+      index = self.table.index
+      indexed_columns = [i for i, data in enumerate(columns) if data is not None and index.indices[i] is not None]
+      projected_columns_index = [1 if i in indexed_columns else 0 for i in range(self.table.num_columns)]
+      moves = []
+
       with self.table.update_record:
-        for rid in rids:
+        for rid in list(rids):
           page_range_index, base_page_index, base_slot = self.table.page_directory[rid]
 
           frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index,
                                                    self.table.num_columns)
-          frame.pin += 1
           page_range: PageRange = frame.page_range
 
-          base_record = page_range.read_base_record(base_page_index, base_slot, [0] * self.table.num_columns)
+          base_record = page_range.read_base_record(base_page_index, base_slot, projected_columns_index)
+          latest_tail_record = None
           record_data = None
           schema_encoding_num = None
 
@@ -367,21 +450,101 @@ class Query:
           page_range.update_base_record_column(base_page_index, base_slot, config.SCHEMA_ENCODING_COLUMN,
                                                schema_encoding_num)
 
-        frame.is_dirty = True
-        frame.pin -= 1
+          frame.is_dirty = True
+          frame.unpin()
 
+          for i in indexed_columns:
+            # The old value is in the latest tail record if that column was updated before, otherwise in the base
+            old_value = base_record[config.NUM_META_COLUMNS + i]
+            if latest_tail_record is not None and self.__number_to_bit_array(
+                latest_tail_record[config.SCHEMA_ENCODING_COLUMN], self.table.num_columns)[i]:
+              old_value = latest_tail_record[config.NUM_META_COLUMNS + i]
+            if old_value != columns[i]:
+              moves.append((i, rid, old_value, columns[i]))
 
-      new_records = self.select(primary_key, self.table.index.key, [1] * self.table.num_columns)
-      # Remove the old records from the index and...
-      for record in old_records:
-        self.table.index.delete(record.entire_record)
+        for column, rid, old_value, new_value in moves:
+          index.move(column, rid, old_value, new_value)
+        index.update_covered(primary_key, columns)
 
-      # add in the new records
-      for record in new_records:
-        self.table.index.add(record.entire_record)
+      return True
 
+    def __locate_key_range(self, start_range, end_range):
+      # Only the keys that exist in the range, grouped by page range so each one is fetched and read in one batch
+      page_ranges = {}
+      for rid in self.table.index.locate_range(start_range, end_range, self.table.key):
+        page_range_index, base_page_index, slot = self.table.page_directory[rid]
+        page_ranges.setdefault(page_range_index, []).append((base_page_index, slot))
+      return page_ranges
+
+    def __prefetch_page_ranges(self, page_range_indices, aggregate_column_index):
+      # Let the bufferpool start loading the page ranges the sum is going to walk through
+      table_frames = self.bufferpool.frames.get(self.table.name, {})
+      missing = sorted(index for index in page_range_indices if index not in table_frames)
+      if missing:
+        self.bufferpool.prefetch(self.table.name, missing, [aggregate_column_index])
+
+    def __scan_strategy(self, num_records):
+      # Big sums go over a lot of pages once, they read through a ring so they don't push out everyone else's pages
+      if num_records > config.SCAN_RING_KEYS:
+        return self.bufferpool.ring()
+      return nullcontext()
+
+    def __version_value(self, page_range, base_rid, indirection, aggregate_column_index, projected_columns_index,
+                        relative_version):
+      # Same walk down the tail records as select_version, but only for the one column being summed.
+      # Returns None when the wanted version is the base record
+      version_num = 0
+      page_range_index, tail_index, tail_slot = self.table.page_directory[indirection]
+      tail_record = page_range.read_tail_record(tail_index, tail_slot, projected_columns_index)
+      while version_num > relative_version:
+        if tail_record[config.INDIRECTION_COLUMN] == base_rid:
+          return None
+        page_range_index, tail_index, tail_slot = self.table.page_directory[tail_record[config.INDIRECTION_COLUMN]]
+        tail_record = page_range.read_tail_record(tail_index, tail_slot, projected_columns_index)
+        version_num -= 1
+
+      if self.__number_to_bit_array(tail_record[config.SCHEMA_ENCODING_COLUMN], self.table.num_columns)[aggregate_column_index]:
+        return tail_record[config.NUM_META_COLUMNS + aggregate_column_index]
+      return None
+
+    def __sum_range(self, start_range, end_range, aggregate_column_index, relative_version):
+      covered = self.table.index.covering.get(aggregate_column_index)
+      if covered is not None and relative_version >= 0:
+        # The covering index has the latest values, no page range has to be read
+        values = covered.values(start_range, end_range)
+        return sum(values) if len(values) else False
+
+      page_ranges = self.__locate_key_range(start_range, end_range)
+      if not page_ranges:
+        return False
 
-      return True
+      projected_columns_index = [1 if i == aggregate_column_index else 0 for i in range(self.table.num_columns)]
+      column = config.NUM_META_COLUMNS + aggregate_column_index
+      total_sum = 0
+      with self.__scan_strategy(sum(len(locations) for locations in page_ranges.values())):
+        self.__prefetch_page_ranges(page_ranges, aggregate_column_index)
+        for page_range_index in sorted(page_ranges):
+          locations = page_ranges[page_range_index]
+          frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index, self.table.num_columns)
+          try:
+            page_range: PageRange = frame.page_range
+            columns = page_range.read_base_records(locations, projected_columns_index)
+            for position in range(len(locations)):
+              value_to_sum = columns[column][position]
+              indirection = columns[config.INDIRECTION_COLUMN][position]
+              if indirection != 0:
+                # The record was updated, the value might be in one of its tail records
+                tail_value = self.__version_value(page_range, columns[config.RID_COLUMN][position], indirection,
+                                                  aggregate_column_index, projected_columns_index, relative_version)
+                if tail_value is not None:
+                  value_to_sum = tail_value
+              if value_to_sum is None:
+                value_to_sum = 0
+              total_sum += value_to_sum
+          finally:
+            frame.unpin()
+
+      return total_sum
 
     """
     :param start_range: int         # Start of the key range to aggregate
@@ -392,22 +555,8 @@ class Query:
     # Returns False if no record exists in the given range
     """
     def sum(self, start_range, end_range, aggregate_column_index):
-      total_sum = 0
-      rids = []
-      for primary_key in range(start_range, end_range + 1):
-        record = self.select(primary_key, self.table.key,
-                                     [1 if i == aggregate_column_index else 0 for i in range(self.table.num_columns)])
-        if record and record is not False:
-          value_to_sum = record[0].columns[aggregate_column_index]
-          if value_to_sum is None:
-            value_to_sum = 0
-          total_sum += value_to_sum
-          rids.append(record)
-
-      if not rids :
-        return False
-
-      return total_sum
+      # Sum wants the latest version so this is sum version 0
+      return self.__sum_range(start_range, end_range, aggregate_column_index, 0)
 
 
     """
@@ -420,51 +569,36 @@ class Query:
     # Returns False if no record exists in the given range
     """
     def sum_version(self, start_range, end_range, aggregate_column_index, relative_version):
-      total_sum = 0
-      rids = []
-      for primary_key in range(start_range, end_range + 1):
-        record = self.select_version(primary_key, self.table.key,
-                             [1 if i == aggregate_column_index else 0 for i in range(self.table.num_columns)], relative_version)
-        if record and record is not False:
-          value_to_sum = record[0].columns[aggregate_column_index]
-          if value_to_sum is None:
-            value_to_sum = 0
-          total_sum += value_to_sum
-          rids.append(record)
-
-      if not rids:
-        return False
-
-      return total_sum
+      return self.__sum_range(start_range, end_range, aggregate_column_index, relative_version)
 
     def undo_insert(self, rid, primary_key, isBaseRecord=bool):
-      page_range_index, page_index, page_slot = self.table.page_directory[rid]
-      frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index, self.table.num_columns)
-      frame.pin += 1
-      page_range: PageRange = frame.page_range
-
-      old_records = None
-      if isBaseRecord:
-        base_record = page_range.read_base_record(page_index, page_slot, [1] * self.table.num_columns)
-        page_range.update_base_record_column(page_index, page_slot, config.RID_COLUMN, 0)
-        self.table.index.delete(base_record)
-      else:
-        old_records = self.select(primary_key, self.table.index.key, [1] * self.table.num_columns)
-        page_range.update_tail_record_column(page_index, page_slot, config.RID_COLUMN, 0)
-
-      frame.is_dirty = True
-      frame.pin -= 1
-      del self.table.page_directory[rid]
-
-      if not isBaseRecord:
-        new_records = self.select(primary_key, self.table.index.key, [1] * self.table.num_columns)
-        # Remove the old records from the index and...
-        for record in old_records:
-          self.table.index.delete(record.entire_record)
-
-        # add in the new records
-        for record in new_records:
-          self.table.index.add(record.entire_record)
+      with self.table.update_record:
+        page_range_index, page_index, page_slot = self.table.page_directory[rid]
+        frame: Frame = self.bufferpool.get_frame(self.table.name, page_range_index, self.table.num_columns)
+        page_range: PageRange = frame.page_range
+
+        old_records = None
+        if isBaseRecord:
+          base_record = page_range.read_base_record(page_index, page_slot, [1] * self.table.num_columns)
+          page_range.update_base_record_column(page_index, page_slot, config.RID_COLUMN, 0)
+          self.table.index.delete(base_record)
+        else:
+          old_records = self.select(primary_key, self.table.index.key, [1] * self.table.num_columns)
+          page_range.update_tail_record_column(page_index, page_slot, config.RID_COLUMN, 0)
+
+        frame.is_dirty = True
+        frame.unpin()
+        del self.table.page_directory[rid]
+
+        if not isBaseRecord:
+          new_records = self.select(primary_key, self.table.index.key, [1] * self.table.num_columns)
+          # Remove the old records from the index and...
+          for record in old_records:
+            self.table.index.delete(record.entire_record)
+
+          # add in the new records
+          for record in new_records:
+            self.table.index.add(record.entire_record)
 
 
     """
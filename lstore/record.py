@@ -1,3 +1,4 @@
+from datetime import datetime
 import lstore.config as config
 
 class Record:
@@ -10,3 +11,64 @@ class Record:
     self.schema_encoding = record_data[config.SCHEMA_ENCODING_COLUMN]
     self.key = key
     self.columns = record_data[config.NUM_META_COLUMNS:]
+
+
+class LazyRecord:
+  """
+  A Record that only decodes what gets used. The raw metadata is kept as ints and the columns stay in the column major
+  lists they were read into (one list per column, shared by every record of the same read) until someone asks for
+  them. Those lists are read while the page range is pinned, so nothing goes back to the page range afterwards. The
+  timestamp and schema encoding are only turned into a datetime and a list of bits when they are accessed. Works
+  anywhere a Record does (record.columns[i], record.rid, ...).
+  """
+  __slots__ = ("read_columns", "position", "projected_columns_index", "key", "metadata", "_base_columns", "_columns")
+
+  def __init__(self, read_columns, position, projected_columns_index, key, metadata):
+    # read_columns is what PageRange.read_base_records returns, this record is at position in each list
+    self.read_columns = read_columns
+    self.position = position
+    self.projected_columns_index = projected_columns_index
+    self.key = key
+    # Raw metadata columns as stored in the page
+    self.metadata = metadata
+    self._base_columns = None
+    self._columns = None
+
+  @property
+  def indirection(self):
+    return self.metadata[config.INDIRECTION_COLUMN]
+
+  @property
+  def rid(self):
+    return self.metadata[config.RID_COLUMN]
+
+  @property
+  def timestamp(self):
+    return datetime.fromtimestamp(float(self.metadata[config.TIMESTAMP_COLUMN]))
+
+  @property
+  def schema_encoding(self):
+    return [int(bit) for bit in f"{self.metadata[config.SCHEMA_ENCODING_COLUMN]:0{len(self.projected_columns_index)}b}"]
+
+  def __read_base_columns(self):
+    if self._base_columns is None:
+      position = self.position
+      self._base_columns = [None if values is None else values[position]
+                            for values in self.read_columns[config.NUM_META_COLUMNS:]]
+    return self._base_columns
+
+  @property
+  def columns(self):
+    # Read once, after that it's a normal list so select_version can patch in the tail record values
+    if self._columns is None:
+      self._columns = list(self.__read_base_columns())
+    return self._columns
+
+  @columns.setter
+  def columns(self, columns):
+    self._columns = columns
+
+  @property
+  def entire_record(self):
+    # Same as Record.entire_record, the metadata plus the columns of the base record
+    return [self.indirection, self.rid, self.timestamp, self.schema_encoding] + self.__read_base_columns()
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+
+class ReplacementPolicy:
+    """
+    Decides which frame the bufferpool evicts next. The bufferpool tells the policy when a frame comes in (admit),
+    gets used again (touch) and leaves (remove), and asks for a victim on a miss when it is full. Frames are
+    identified by a hashable key. Every call should be O(1), victim only has to walk past frames that can't be
+    evicted right now (pinned frames).
+    """
+
+    def admit(self, key: Hashable):
+        raise NotImplementedError
+
+    def touch(self, key: Hashable):
+        raise NotImplementedError
+
+    def remove(self, key: Hashable):
+        raise NotImplementedError
+
+    def victim(self, evictable: Callable[[Hashable], bool]) -> Optional[Hashable]:
+        """
+        Returns the key of the frame to evict, or None if every frame is pinned
+        """
+        raise NotImplementedError
+
+
+class LRUPolicy(ReplacementPolicy):
+    """
+    Least recently used. The OrderedDict keeps keys from oldest to newest use
+    """
+
+    def __init__(self):
+        self.order: OrderedDict = OrderedDict()
+
+    def admit(self, key):
+        self.order[key] = None
+
+    def touch(self, key):
+        if key in self.order:
+            self.order.move_to_end(key)
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+    def victim(self, evictable):
+        for key in self.order:
+            if evictable(key):
+                return key
+        return None
+
+
+class ClockPolicy(ReplacementPolicy):
+    """
+    CLOCK (second chance). Keys sit on a circular list with a reference bit that is set whenever they are used.
+    The hand clears bits as it goes around and picks the first key it finds with its bit already cleared.
+    """
+
+    def __init__(self):
+        self.keys: list = []  # The clock face, None where a key was removed
+        self.referenced: list[bool] = []
+        self.positions: dict = {}  # key -> position on the clock face
+        self.free: list[int] = []  # Positions left empty by removed keys
+        self.hand = 0
+
+    def admit(self, key):
+        # A key that is already on the clock keeps its slot, giving it a second one would leave the old slot for
+        # victim() to hand out after the key is gone
+        position = self.positions.get(key)
+        if position is not None:
+            self.referenced[position] = True
+            return
+        if self.free:
+            position = self.free.pop()
+            self.keys[position] = key
+            self.referenced[position] = True
+        else:
+            position = len(self.keys)
+            self.keys.append(key)
+            self.referenced.append(True)
+        self.positions[key] = position
+
+    def touch(self, key):
+        position = self.positions.get(key)
+        if position is not None:
+            self.referenced[position] = True
+
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is not None:
+            self.keys[position] = None
+            self.free.append(position)
+
+    def victim(self, evictable):
+        # Two turns around the clock, the first one might only clear reference bits
+        for _ in range(2 * len(self.keys)):
+            position = self.hand
+            self.hand = (self.hand + 1) % len(self.keys)
+            key = self.keys[position]
+            if key is None:
+                continue
+            if self.referenced[position]:
+                self.referenced[position] = False
+            elif evictable(key):
+                return key
+        return None
@@ -0,0 +1,378 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import threading
+
+from lstore.page import Page, MappedPage, PAGE_SIZE
+
+"""
+Every page range is stored in a single segment file (tables/<table>/<n>.seg) instead of one file per physical page.
+
+  block 0        header: magic, version, where the page table is, and how many blocks are in use
+  block 1 .. n   physical pages, each one 4096 byte block, in the same big endian format as the old .bin files
+  after block n  page table: JSON with the page range metadata and the block number of every physical page
+
+New physical pages get the next free block, and the page table is rewritten after the last block on every save.
+The page table the header points to is never written over: a new block that would land on it moves it further out
+first, and a new page table goes after it if it would overlap. Only then does the header change, so a crash at any
+point leaves a readable segment. Pages are read and written with positioned I/O so we never have to seek or reopen
+anything per page.
+
+Blocks are written in place, so for crash recovery each segment can also have undo logs (<n>.seg.undo.<checkpoint>,
+see UndoLog) with the contents from before the first write since that checkpoint. Rolling them back puts the segment
+back exactly the way the checkpoint left it.
+"""
+
+SEGMENT_MAGIC = b"SQRLSEG1"
+SEGMENT_VERSION = 1
+# magic, version, page table offset, page table length, number of blocks (header included)
+_HEADER = struct.Struct(">8sIQQQ")
+
+UNDO_MAGIC = b"SQRLUNDO"
+# magic, checkpoint, segment file size, number of blocks, page table offset, page table length. The old header block
+# and page table follow, then one entry per block: its number and its old contents
+_UNDO_HEADER = struct.Struct(">8sQQQQQ")
+_UNDO_BLOCK = struct.Struct(">Q")
+_UNDO_ENTRY_SIZE = _UNDO_BLOCK.size + PAGE_SIZE
+
+
+class UndoLog:
+  """
+  Everything needed to put a segment back the way it was at a checkpoint: the header, page table and size it had then,
+  and the old contents of every block written in place since. A block is logged once, right before its first write,
+  and the log is fsynced before the segment is written. Blocks past the old end of the segment are new and don't need logging,
+  rolling back truncates them away. Use UndoLog.get, there is one per segment and checkpoint
+  """
+  __logs = {}  # (segment path, checkpoint) -> UndoLog
+  __lock = threading.Lock()
+
+  def __init__(self, segment, checkpoint):
+    self.path = f"{segment.path}.undo.{checkpoint}"
+    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+    data = os.pread(self.fd, _UNDO_HEADER.size, 0)
+    if len(data) == _UNDO_HEADER.size:
+      # Left by an earlier run that got this far before checkpointing, keep adding to it
+      _, _, _, self.num_blocks, _, page_table_length = _UNDO_HEADER.unpack(data)
+      start = _UNDO_HEADER.size + PAGE_SIZE + page_table_length
+      size = os.fstat(self.fd).st_size
+      self.end = start + (size - start) // _UNDO_ENTRY_SIZE * _UNDO_ENTRY_SIZE
+      self.logged = {_UNDO_BLOCK.unpack(os.pread(self.fd, _UNDO_BLOCK.size, offset))[0]
+                     for offset in range(start, self.end, _UNDO_ENTRY_SIZE)}
+    else:
+      # Written before anything in the segment changes, in one write so it's either all there or ignored
+      page_table = b""
+      if segment.page_table_length:
+        page_table = os.pread(segment.fd, segment.page_table_length, segment.page_table_offset)
+      header = _UNDO_HEADER.pack(UNDO_MAGIC, checkpoint, os.fstat(segment.fd).st_size, segment.num_blocks,
+                                 segment.page_table_offset, len(page_table))
+      data = header + os.pread(segment.fd, PAGE_SIZE, 0).ljust(PAGE_SIZE, b"\0") + page_table
+      os.ftruncate(self.fd, 0)
+      os.pwrite(self.fd, data, 0)
+      # On disk, and listed in its directory, before the segment is touched
+      os.fsync(self.fd)
+      fsync_directory(os.path.dirname(self.path))
+      self.num_blocks = segment.num_blocks
+      self.end = len(data)
+      self.logged = set()
+
+  @classmethod
+  def get(cls, segment, checkpoint):
+    with cls.__lock:
+      log = cls.__logs.get((segment.path, checkpoint))
+      if log is None:
+        log = cls.__logs[(segment.path, checkpoint)] = cls(segment, checkpoint)
+      return log
+
+  def log_block(self, segment, block):
+    """
+    Saves the old contents of block before it is written for the first time since the checkpoint
+    """
+    if block >= self.num_blocks or block in self.logged:
+      return
+    entry = _UNDO_BLOCK.pack(block) + os.pread(segment.fd, PAGE_SIZE, block * PAGE_SIZE).ljust(PAGE_SIZE, b"\0")
+    os.pwrite(self.fd, entry, self.end)
+    os.fsync(self.fd)
+    self.end += len(entry)
+    self.logged.add(block)
+
+  def close(self):
+    os.close(self.fd)
+
+  @classmethod
+  def forget(cls, path, checkpoint_below):
+    """
+    Closes the logs of the segments under path from checkpoints before checkpoint_below
+    """
+    prefix = os.path.join(path, "")
+    with cls.__lock:
+      for key in [key for key in cls.__logs if key[0].startswith(prefix) and key[1] < checkpoint_below]:
+        cls.__logs.pop(key).close()
+
+
+def fsync_directory(path):
+  # Makes files created, renamed or removed in a directory stick, fsyncing the files doesn't cover their names
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def sync_segments(path):
+  """
+  Forces every segment in a database to disk, along with the table directories they are listed in
+  """
+  tables_path = os.path.join(path, "tables")
+  if not os.path.isdir(tables_path):
+    return
+  for table_name in os.listdir(tables_path):
+    table_path = os.path.join(tables_path, table_name)
+    if not os.path.isdir(table_path):
+      continue
+    for file_name in os.listdir(table_path):
+      if file_name.endswith(".seg"):
+        fd = os.open(os.path.join(table_path, file_name), os.O_RDONLY)
+        try:
+          os.fsync(fd)
+        finally:
+          os.close(fd)
+    fsync_directory(table_path)
+  fsync_directory(tables_path)
+
+
+def roll_back(segment_path, undo_path):
+  """
+  Puts a segment back the way its undo log says it was, then removes the log. Safe to run again if it gets interrupted
+  """
+  with open(undo_path, "rb") as file:
+    data = file.read()
+  if len(data) >= _UNDO_HEADER.size + PAGE_SIZE:
+    magic, _, size, _, page_table_offset, page_table_length = _UNDO_HEADER.unpack_from(data)
+    start = _UNDO_HEADER.size + PAGE_SIZE + page_table_length
+    if magic == UNDO_MAGIC and len(data) >= start:
+      if not size:
+        # The segment didn't exist yet
+        if os.path.exists(segment_path):
+          os.remove(segment_path)
+      else:
+        fd = os.open(segment_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+          restored = set()
+          # A torn entry at the end never made it to the segment
+          for offset in range(start, len(data) - _UNDO_ENTRY_SIZE + 1, _UNDO_ENTRY_SIZE):
+            block = _UNDO_BLOCK.unpack_from(data, offset)[0]
+            if block not in restored:
+              os.pwrite(fd, data[offset + _UNDO_BLOCK.size:offset + _UNDO_ENTRY_SIZE], block * PAGE_SIZE)
+              restored.add(block)
+          if page_table_length:
+            os.pwrite(fd, data[start - page_table_length:start], page_table_offset)
+          os.pwrite(fd, data[_UNDO_HEADER.size:_UNDO_HEADER.size + PAGE_SIZE], 0)
+          os.ftruncate(fd, size)
+          # The log only goes away once the rolled back segment is on disk
+          os.fsync(fd)
+        finally:
+          os.close(fd)
+  # Anything shorter was cut off before the segment was touched
+  os.remove(undo_path)
+
+
+def _undo_logs(path):
+  # (table directory, segment file name, checkpoint, undo log file name) of every undo log in a database
+  tables_path = os.path.join(path, "tables")
+  if not os.path.isdir(tables_path):
+    return
+  for table_name in os.listdir(tables_path):
+    table_path = os.path.join(tables_path, table_name)
+    if os.path.isdir(table_path):
+      for file_name in os.listdir(table_path):
+        segment_name, _, checkpoint = file_name.rpartition(".undo.")
+        if segment_name and checkpoint.isdigit():
+          yield table_path, segment_name, int(checkpoint), file_name
+
+
+def recover_database(path, checkpoint):
+  """
+  Rolls every segment in a database back to the given checkpoint, newest undo log first. Logs from before it are left
+  over from checkpoints that finished and just get removed. Returns how many segments were rolled back
+  """
+  UndoLog.forget(path, float("inf"))
+  logs = sorted(_undo_logs(path), key=lambda log: log[2], reverse=True)
+  rolled_back = set()
+  for table_path, segment_name, log_checkpoint, file_name in logs:
+    if log_checkpoint >= checkpoint:
+      roll_back(os.path.join(table_path, segment_name), os.path.join(table_path, file_name))
+      rolled_back.add((table_path, segment_name))
+    else:
+      os.remove(os.path.join(table_path, file_name))
+  return len(rolled_back)
+
+
+def remove_undo_logs(path, checkpoint_below):
+  """
+  Removes the undo logs from before a checkpoint once that checkpoint is complete
+  """
+  UndoLog.forget(path, checkpoint_below)
+  for table_path, _, log_checkpoint, file_name in list(_undo_logs(path)):
+    if log_checkpoint < checkpoint_below:
+      os.remove(os.path.join(table_path, file_name))
+
+
+class SegmentFile:
+
+  def __init__(self, path, checkpoint=None):
+    self.path = path
+    # Checkpoint that in place writes are undo logged against, None to not keep an undo log
+    self.checkpoint = checkpoint
+    self.undo = None
+    self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    header = os.pread(self.fd, _HEADER.size, 0)
+
+    # The header is first written with the first page table, a save cut off before that leaves it zeroed
+    if header.strip(b"\0"):
+      magic, version, self.page_table_offset, self.page_table_length, self.num_blocks = _HEADER.unpack(header)
+      if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+        os.close(self.fd)
+        raise Exception(f"{path} is not a segment file")
+    else:
+      # Brand new file, block 0 is reserved for the header
+      self.page_table_offset = 0
+      self.page_table_length = 0
+      self.num_blocks = 1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception_value, exception_traceback):
+    self.close()
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  def __protect(self):
+    # Called before anything in the file changes
+    if self.checkpoint is not None and self.undo is None:
+      self.undo = UndoLog.get(self, self.checkpoint)
+
+  def allocate_block(self):
+    block = self.num_blocks
+    if self.page_table_length and (block + 1) * PAGE_SIZE > self.page_table_offset:
+      self.__protect()
+      self.__move_page_table()
+    self.num_blocks += 1
+    return block
+
+  def __page_table_end(self):
+    # First block boundary after the page table the header points to
+    return -(-(self.page_table_offset + self.page_table_length) // PAGE_SIZE) * PAGE_SIZE
+
+  def __move_page_table(self):
+    # New blocks are about to go over the page table. It gets copied well past them first (twice as far out as the
+    # blocks go, so a save that adds a lot of pages only moves it a few times) and the header is pointed at the copy
+    data = os.pread(self.fd, self.page_table_length, self.page_table_offset)
+    self.page_table_offset = max(self.__page_table_end(), 2 * (self.num_blocks + 1) * PAGE_SIZE)
+    os.pwrite(self.fd, data, self.page_table_offset)
+    self.__write_header()
+
+  def __write_header(self):
+    header = _HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self.page_table_offset, self.page_table_length,
+                          self.num_blocks)
+    return os.pwrite(self.fd, header.ljust(PAGE_SIZE, b"\0"), 0)
+
+  def read_page(self, block):
+    return Page.from_bytes(os.pread(self.fd, PAGE_SIZE, block * PAGE_SIZE))
+
+  def write_page(self, block, page):
+    """
+    Writes one physical page into its block and marks it clean. Returns the number of bytes written
+    """
+    self.__protect()
+    if self.undo is not None:
+      self.undo.log_block(self, block)
+    # Clear the flag before copying the data so a write that sneaks in afterwards marks the page dirty again
+    page.dirty = False
+    return os.pwrite(self.fd, page.to_bytes(), block * PAGE_SIZE)
+
+  def read_page_table(self):
+    if not self.page_table_length:
+      return None
+    return json.loads(os.pread(self.fd, self.page_table_length, self.page_table_offset))
+
+  def write_page_table(self, page_table):
+    """
+    Writes the page table right after the last block, or after the current page table if it would overlap it, and
+    then points the header at it. Returns the number of bytes written
+    """
+    self.__protect()
+    data = json.dumps(page_table).encode("utf-8")
+    offset = self.num_blocks * PAGE_SIZE
+    if self.page_table_length and offset < self.page_table_offset + self.page_table_length \
+        and offset + len(data) > self.page_table_offset:
+      offset = self.__page_table_end()
+    written = os.pwrite(self.fd, data, offset)
+
+    self.page_table_offset = offset
+    self.page_table_length = len(data)
+    written += self.__write_header()
+    # Whatever is past the new page table (an old one, or room left by a move) isn't needed anymore
+    os.ftruncate(self.fd, offset + len(data))
+    return written
+
+  def map(self):
+    """
+    Maps the whole file so MappedPages can point straight at their blocks. The mapping is copy on write: writes to
+    a MappedPage stay in memory until write_page writes the page, which keeps them going through the undo log
+    """
+    return mmap.mmap(self.fd, 0, access=mmap.ACCESS_COPY)
+
+
+def convert_page_range(json_path, dir_path, segment_path, remove_legacy=True):
+  """
+  Converts one page range saved in the old layout (<n>.json and a <n>/ folder of b*/t* conceptual pages with colN/K.bin
+  files) into a segment file
+  """
+  # This needs to be done in here to prevent errors
+  from lstore.page_range import PageRange
+
+  with open(json_path, "rb") as file:
+    page_range = PageRange.from_dict(json.load(file), dir_path)
+  page_range.save_segment(segment_path)
+
+  if remove_legacy:
+    os.remove(json_path)
+    shutil.rmtree(dir_path)
+
+
+def convert_table(table_path, remove_legacy=True):
+  """
+  Converts every page range in tables/<name>/ into a segment file. Returns how many page ranges were converted
+  """
+  converted = 0
+  for file_name in os.listdir(table_path):
+    name, extension = os.path.splitext(file_name)
+    dir_path = os.path.join(table_path, name)
+    if extension == ".json" and name.isdigit() and os.path.isdir(dir_path):
+      convert_page_range(os.path.join(table_path, file_name), dir_path, os.path.join(table_path, f"{name}.seg"),
+                         remove_legacy)
+      converted += 1
+  return converted
+
+
+def convert_database(path, remove_legacy=True):
+  tables_path = os.path.join(path, "tables")
+  converted = 0
+  if os.path.isdir(tables_path):
+    for table_name in os.listdir(tables_path):
+      table_path = os.path.join(tables_path, table_name)
+      if os.path.isdir(table_path):
+        converted += convert_table(table_path, remove_legacy)
+  return converted
+
+
+if __name__ == "__main__":
+  # python -m lstore.segment <database path>
+  print(f"Converted {convert_database(sys.argv[1])} page ranges")
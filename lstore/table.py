@@ -22,16 +22,18 @@ class Table:
     :param num_columns: int     #Number of Columns: all columns are integer
     :param key: int             #Index of table key in columns
     """
-    def __init__(self, name, num_columns, key, bufferpool, page_ranges_index=0, page_directory={}, rid=1):
+    def __init__(self, name, num_columns, key, bufferpool, page_ranges_index=0, page_directory=None, rid=1):
         self.name: str = name
         self.key = key
         self.num_columns = num_columns
         self.page_ranges_index = page_ranges_index
-        self.page_directory = page_directory
+        self.page_directory = page_directory if page_directory is not None else {}
         self.index: Index = Index(self)
-        self.rid = 1
+        self.rid = rid
 
         self.lock_manager = defaultdict()
+        # Held by inserts and by everything else that changes records (updates, deletes, undos). A checkpoint takes
+        # both to get a consistent copy of the table
         self.new_record = threading.Lock()
         self.update_record = threading.Lock()
 
@@ -43,6 +45,12 @@ class Table:
       self.rid += 1
       return tmp
 
+    def new_rids(self, count):
+      # A block of consecutive rids for bulk inserts
+      tmp = self.rid
+      self.rid += count
+      return range(tmp, tmp + count)
+
     def to_dict(self):
       data = {}
       data["name"] = self.name
@@ -51,7 +59,8 @@ class Table:
       data["page_ranges_index"] = self.page_ranges_index
       data["page_directory_keys"] = []
       data["page_directory_values"] = []
-      for k,v in self.page_directory.items():
+      # Copied first, a checkpoint can run while queries are adding to it
+      for k,v in list(self.page_directory.items()):
         data["page_directory_keys"].append(k)
         data["page_directory_values"].append(v)
       data["rid"] = int(self.rid)
@@ -59,7 +68,9 @@ class Table:
       return data
 
     def add_new_page_range(self):
-      if not self.bufferpool.get_frame(self.name, self.page_ranges_index, self.num_columns).page_range.has_base_page_capacity():
+      with self.bufferpool.get_frame(self.name, self.page_ranges_index, self.num_columns) as frame:
+        full = not frame.page_range.has_base_page_capacity()
+      if full:
         self.page_ranges_index += 1
 
     def merge(self):
@@ -0,0 +1,47 @@
+import sys
+import os
+import random
+import time
+
+# par dir for path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lstore.replacement import ClockPolicy, LRUPolicy
+
+# Simulates a bufferpool through the policy API only, so the numbers don't depend on disk speed
+def hit_rate(policy, accesses, capacity):
+  resident = set()
+  hits = 0
+  for key in accesses:
+    if key in resident:
+      policy.touch(key)
+      hits += 1
+      continue
+    if len(resident) >= capacity:
+      victim = policy.victim(lambda key: True)
+      policy.remove(victim)
+      resident.remove(victim)
+    policy.admit(key)
+    resident.add(key)
+  return hits / len(accesses)
+
+def skewed_accesses(num_keys, count, skew, seed=165):
+  # Zipf-like, key k gets picked with weight 1 / (k + 1) ** skew
+  weights = [1 / (key + 1) ** skew for key in range(num_keys)]
+  return random.Random(seed).choices(range(num_keys), weights, k=count)
+
+def evaluate(num_keys=1000, count=200000, capacity=64):
+  policies = [("clock", ClockPolicy), ("lru", LRUPolicy)]
+  print(f"{'skew':<8}" + "".join(f"{name + ' hits':>14}{name + ' s':>10}" for name, _ in policies))
+  for skew in (0.0, 0.8, 1.0, 1.2):
+    accesses = skewed_accesses(num_keys, count, skew)
+    row = f"{skew:<8}"
+    for _, policy_class in policies:
+      start_time = time.perf_counter()
+      rate = hit_rate(policy_class(), accesses, capacity)
+      row += f"{rate:>14.3f}{time.perf_counter() - start_time:>10.3f}"
+    print(row)
+
+
+if __name__ == "__main__":
+  evaluate()
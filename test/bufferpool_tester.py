@@ -0,0 +1,365 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from lstore.bufferpool import BufferPool
+from lstore.replacement import ClockPolicy, LRUPolicy
+import lstore.config as config
+
+sys.path.append('../lstore')
+
+import unittest
+
+
+class MyTestCase(unittest.TestCase):
+  def test_lru_policy(self):
+    policy = LRUPolicy()
+    for key in ["a", "b", "c"]:
+      policy.admit(key)
+    policy.touch("a")
+    self.assertEqual(policy.victim(lambda key: True), "b")
+    # Keys that can't be evicted (pinned) get skipped
+    self.assertEqual(policy.victim(lambda key: key != "b"), "c")
+    policy.remove("b")
+    policy.remove("c")
+    self.assertEqual(policy.victim(lambda key: True), "a")
+    self.assertIsNone(policy.victim(lambda key: False))
+
+  def test_clock_policy(self):
+    policy = ClockPolicy()
+    for key in ["a", "b", "c"]:
+      policy.admit(key)
+    # Everything starts referenced, so the first turn just clears the bits
+    self.assertEqual(policy.victim(lambda key: True), "a")
+    policy.touch("b")
+    self.assertEqual(policy.victim(lambda key: True), "c")
+    policy.remove("c")
+    policy.admit("d")
+    self.assertEqual(policy.keys, ["a", "b", "d"])
+    self.assertIsNone(policy.victim(lambda key: False))
+
+  def test_clock_policy_readmit(self):
+    policy = ClockPolicy()
+    for key in ["a", "b"]:
+      policy.admit(key)
+    # Admitting a key that's already there only marks it as used
+    policy.admit("a")
+    self.assertEqual(policy.keys, ["a", "b"])
+    policy.remove("a")
+    for _ in range(4):
+      self.assertEqual(policy.victim(lambda key: True), "b")
+    policy.remove("b")
+    self.assertIsNone(policy.victim(lambda key: True))
+
+  def test_capacity_is_enforced(self):
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory, capacity=2)
+      for page_range_index in range(5):
+        frame = bp.get_frame("test", page_range_index, 1)
+        frame.page_range.write_base_record([0, page_range_index, 0, 0, page_range_index * 10])
+        frame.is_dirty = True
+        frame.unpin()
+        self.assertLessEqual(bp.resident, 2)
+      self.assertEqual(bp.resident, 2)
+
+      # Evicted frames were written back, so reading them in again gives back the data
+      for page_range_index in range(5):
+        with bp.get_frame("test", page_range_index, 1) as frame:
+          self.assertEqual(frame.page_range.read_base_record(0, 0, [1])[config.NUM_META_COLUMNS], page_range_index * 10)
+
+  def test_pinned_frames_are_not_evicted(self):
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory, capacity=2, policy=LRUPolicy())
+      # get_frame hands out pinned frames
+      pinned = bp.get_frame("test", 0, 1)
+      for page_range_index in range(1, 5):
+        bp.get_frame("test", page_range_index, 1).unpin()
+      self.assertIs(bp.frames["test"][0], pinned)
+
+      # With everything pinned the pool goes over capacity instead of failing
+      bp.frames["test"][4].pin += 1
+      bp.get_frame("test", 5, 1)
+      self.assertEqual(bp.resident, 3)
+
+  def test_evicted_frame_is_detached(self):
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory, capacity=1)
+      old_frame = bp.get_frame("test", 0, 1)
+      old_frame.page_range.write_base_record([0, 1, 0, 0, 10])
+      old_frame.unpin()
+      conceptual_page = old_frame.page_range.base_pages[0]
+      # Admitting a page that is already cached doesn't count it twice
+      resident_pages = bp.resident_pages
+      bp.admit_page(conceptual_page, config.NUM_META_COLUMNS, 0)
+      self.assertEqual(bp.resident_pages, resident_pages)
+
+      bp.get_frame("test", 1, 1)
+      self.assertNotIn(0, bp.frames["test"])
+      self.assertIsNone(conceptual_page.cache)
+      # Reading through the evicted copy goes to disk without putting its pages back in the pool
+      self.assertEqual(old_frame.page_range.read_base_record(0, 0, [1])[config.NUM_META_COLUMNS], 10)
+      self.assertFalse(any(key[1] == 0 for key in bp.page_frames))
+      self.assertEqual(bp.resident_pages, len(bp.page_frames))
+      self.assertEqual(bp.resident_pages, bp.frames["test"][1].resident_pages)
+
+  def test_failed_write_keeps_frame(self):
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory, capacity=1)
+      with bp.get_frame("test", 0, 1) as frame:
+        frame.page_range.write_base_record([0, 1, 0, 0, 42])
+        frame.is_dirty = True
+      # Something in the way of the segment file so saving it fails
+      segment_path = os.path.join(directory, "tables", "test", "0.seg")
+      os.makedirs(segment_path)
+      self.assertRaises(OSError, bp.evict_frame)
+      self.assertRaises(OSError, bp.flush_all)
+      # Still there and still dirty, nothing was lost
+      self.assertIs(bp.frames["test"][0], frame)
+      self.assertTrue(frame.is_dirty)
+      self.assertFalse(frame.evicted)
+
+      os.rmdir(segment_path)
+      self.assertTrue(bp.evict_frame())
+      with bp.get_frame("test", 0, 1) as frame:
+        self.assertEqual(frame.page_range.read_base_record(0, 0, [1])[config.NUM_META_COLUMNS], 42)
+
+  def test_unreadable_segment_raises(self):
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory, capacity=2)
+      os.makedirs(os.path.join(directory, "tables", "test"))
+      with open(os.path.join(directory, "tables", "test", "0.seg"), "wb") as file:
+        file.write(b"not a segment".ljust(4096, b"x"))
+      self.assertRaisesRegex(Exception, "not a segment file", bp.get_frame, "test", 0, 1)
+      # The failed load doesn't hold on to anything
+      self.assertEqual(bp.resident, 0)
+      self.assertFalse(bp.loading)
+      bp.get_frame("test", 1, 1).unpin()
+      self.assertEqual(bp.resident, 1)
+
+  def test_physical_pages_are_evicted(self):
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory, memory_budget=20 * 4096)
+      frame = bp.get_frame("test", 0, 2)
+      for i in range(6000):
+        frame.page_range.write_base_record([0, i, 0, 0, i, 2 * i])
+      # The page range stays pinned but its pages still get evicted, memory follows the pages in use
+      self.assertEqual(bp.resident_pages, 20)
+      self.assertEqual(len(bp.page_frames), 20)
+      self.assertEqual(bp.resident_bytes, 20 * 4096)
+      self.assertEqual(frame.resident_bytes, 20 * 4096)
+
+      for i in range(0, 6000, 7):
+        self.assertEqual(frame.page_range.read_base_record(i // 4096, i % 4096, [1, 1]), [0, i, 0, 0, i, 2 * i])
+      self.assertEqual(bp.resident_pages, 20)
+      key = ("test", 0, "base", 0, config.NUM_META_COLUMNS, 0)
+      self.assertIsNone(frame.page_range.base_pages[0].pages[config.NUM_META_COLUMNS].pages[0])
+
+      # A pinned page stays in memory no matter how many other pages come in
+      frame.page_range.read_base_record(0, 0, [1, 0])
+      with bp.get_page_frame(key) as page_frame:
+        for i in range(4096, 6000, 512):
+          frame.page_range.read_base_record(1, i - 4096, [1, 1])
+        self.assertIs(bp.get_page_frame(key), page_frame)
+        self.assertIsNotNone(page_frame.page)
+      frame.unpin()
+
+  def __dirty_pages(self, bp):
+    return sum(1 for page_frame in bp.page_frames.values() if page_frame.page.dirty)
+
+  def test_flush_pages(self):
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory)
+      frame = bp.get_frame("test", 0, 2)
+      for i in range(6000):
+        frame.page_range.write_base_record([0, i, 0, 0, i, 2 * i])
+      bp.write_frame(frame)
+      self.assertEqual(self.__dirty_pages(bp), 0)
+
+      for i in range(0, 6000, 512):
+        frame.page_range.update_base_record_column(i // 4096, i % 4096, config.INDIRECTION_COLUMN, 7)
+      self.assertEqual(self.__dirty_pages(bp), 12)
+      # Stops once the budget is used up
+      self.assertEqual(bp.flush_pages(2 * 4096), 2 * 4096)
+      self.assertEqual(self.__dirty_pages(bp), 10)
+      # Above the high water mark the budget doesn't count
+      bp.flush_pages(0, high_water=4)
+      self.assertEqual(self.__dirty_pages(bp), 4)
+
+  def test_background_flusher(self):
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory)
+      bp.start_flusher(interval=0.01)
+      try:
+        frame = bp.get_frame("test", 0, 2)
+        for i in range(6000):
+          frame.page_range.write_base_record([0, i, 0, 0, i, 2 * i])
+        frame.unpin()
+        for _ in range(200):
+          if not self.__dirty_pages(bp):
+            break
+          time.sleep(0.01)
+        self.assertEqual(self.__dirty_pages(bp), 0)
+      finally:
+        bp.stop_flusher()
+      self.assertIsNone(bp.flusher)
+
+      # Only the page table is left for close
+      self.assertLess(bp.flush_all(), 2 * 4096)
+      bp = BufferPool(directory)
+      self.assertEqual(bp.get_frame("test", 0, 2).page_range.read_base_record(1, 10, [1, 1]), [0, 4106, 0, 0, 4106, 8212])
+
+  def __write_page_ranges(self, directory, count):
+    bp = BufferPool(directory)
+    for page_range_index in range(count):
+      frame = bp.get_frame("test", page_range_index, 2)
+      for i in range(1000):
+        frame.page_range.write_base_record([0, i, 0, 0, page_range_index, i])
+    bp.flush_all()
+
+  def test_prefetch(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.__write_page_ranges(directory, 3)
+      bp = BufferPool(directory)
+      futures = bp.prefetch("test", [0, 2, 7], [1])
+      for future in futures:
+        future.result()
+      # 7 doesn't exist, nothing gets made up for it
+      self.assertEqual(sorted(bp.frames["test"]), [0, 2])
+      base_page = bp.frames["test"][2].page_range.base_pages[0]
+      self.assertEqual([base_page.pages.is_loaded(column) for column in range(base_page.total_columns)],
+                       [True, True, True, True, False, True])
+      self.assertEqual(bp.prefetching, set())
+      self.assertEqual(bp.stats()["prefetch_failures"], 0)
+
+      # A page range that can't be read fails its future and gets counted
+      with open(os.path.join(directory, "tables", "test", "1.seg"), "wb") as file:
+        file.write(b"not a segment".ljust(4096, b"x"))
+      future, = bp.prefetch("test", [1])
+      self.assertRaises(Exception, future.result)
+      self.assertEqual(bp.stats()["prefetch_failures"], 1)
+      self.assertNotIn(1, bp.frames["test"])
+      bp.on_close()
+
+  def test_sequential_read_ahead(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.__write_page_ranges(directory, 5)
+      bp = BufferPool(directory)
+      bp.get_frame("test", 0, 2)
+      bp.get_frame("test", 2, 2)
+      self.assertIsNone(bp.prefetcher)
+      # 2 then 3 is in order, so the next page ranges get loaded ahead of time
+      bp.get_frame("test", 3, 2)
+      bp.prefetcher.shutdown(wait=True)
+      self.assertEqual(sorted(bp.frames["test"]), [0, 2, 3, 4])
+      self.assertTrue(bp.frames["test"][4].page_range.base_pages[0].pages.is_loaded(config.INDIRECTION_COLUMN))
+
+  def test_stats(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.__write_page_ranges(directory, 3)
+      bp = BufferPool(directory, capacity=2)
+      for page_range_index in [2, 2, 0, 2]:
+        bp.get_frame("test", page_range_index, 2).unpin()
+      frame = bp.get_frame("test", 1, 2)
+      frame.page_range.read_base_record(0, 5, [1, 1])
+
+      stats = bp.stats()
+      self.assertEqual((stats["requests"], stats["hits"], stats["misses"], stats["evictions"]), (5, 2, 3, 1))
+      self.assertEqual(stats["page_loads"], 6)
+      self.assertEqual(stats["bytes_read"], 6 * 4096)
+      self.assertGreater(stats["avg_page_load_ms"], 0)
+      self.assertEqual(stats["tables"]["test"], {"resident": 2, "pinned": 1, "dirty": 0, "resident_pages": 6,
+                                                 "resident_bytes": 6 * 4096, "pinned_pages": 0})
+
+      bp.reset_stats()
+      stats = bp.stats()
+      self.assertEqual((stats["requests"], stats["hits"], stats["page_loads"], stats["bytes_read"]), (0, 0, 0, 0))
+      # What's in memory right now doesn't get reset
+      self.assertEqual(stats["resident_pages"], 6)
+      frame.unpin()
+
+  def test_concurrent_misses_load_once(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.__write_page_ranges(directory, 2)
+      bp = BufferPool(directory)
+      reads = []
+      read_frame = bp.read_frame
+
+      def slow_read_frame(table_name, page_range_index, num_columns):
+        reads.append(page_range_index)
+        time.sleep(0.05)
+        return read_frame(table_name, page_range_index, num_columns)
+      bp.read_frame = slow_read_frame
+
+      frames = []
+      threads = [threading.Thread(target=lambda index=index: frames.append(bp.get_frame("test", index % 2, 2)))
+                 for index in range(8)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+      # One read per page range, and everyone asking for the same page range got the same frame
+      self.assertEqual(sorted(reads), [0, 1])
+      self.assertEqual(len({id(frame) for frame in frames}), 2)
+      self.assertEqual(bp.resident, 2)
+      self.assertEqual(bp.loading, {})
+
+  def test_hits_during_eviction(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.__write_page_ranges(directory, 8)
+      # Far fewer frames and pages than the threads need, so hits, misses, prefetches and evictions all overlap
+      bp = BufferPool(directory, capacity=2, memory_budget=64 * 4096)
+      errors = []
+
+      def work(page_range_index):
+        try:
+          for i in range(200):
+            with bp.get_frame("test", page_range_index, 2) as frame:
+              frame.page_range.write_base_record([0, 1000 + i, 0, 0, page_range_index, 1000 + i])
+              frame.is_dirty = True
+            bp.prefetch("test", [(page_range_index + 1) % 8, (page_range_index + 2) % 8], [1])
+        except Exception as e:
+          errors.append(e)
+
+      threads = [threading.Thread(target=work, args=(index,)) for index in range(8)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      bp.on_close()
+      self.assertEqual(errors, [])
+
+      # No write went into a copy that had already left the pool
+      bp = BufferPool(directory)
+      for page_range_index in range(8):
+        with bp.get_frame("test", page_range_index, 2) as frame:
+          self.assertEqual(frame.page_range.base_pages[0].num_records, 1200)
+          self.assertEqual(frame.page_range.read_base_record(0, 1199, [1, 1]), [0, 1199, 0, 0, page_range_index, 1199])
+      self.assertEqual(bp.resident_pages, len(bp.page_frames))
+
+  def test_ring_keeps_hot_pages(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.__write_page_ranges(directory, 3)
+      bp = BufferPool(directory, memory_budget=12 * 4096)
+      hot = bp.get_frame("test", 0, 2)
+      hot.page_range.read_base_record(0, 0, [1, 1])
+      hot_keys = set(bp.page_frames)
+      self.assertEqual(len(hot_keys), 6)
+
+      with bp.ring(size=4) as ring:
+        for page_range_index in [1, 2]:
+          frame = bp.get_frame("test", page_range_index, 2)
+          for slot in range(0, 1000, 100):
+            self.assertEqual(frame.page_range.read_base_record(0, slot, [1, 1]), [0, slot, 0, 0, page_range_index, slot])
+          self.assertLessEqual(len(ring.keys), 4)
+        # The scan only ever had its ring, the pages loaded before it are all still here
+        self.assertTrue(hot_keys <= set(bp.page_frames))
+
+      # Its pages are gone once it's done
+      self.assertEqual(set(bp.page_frames), hot_keys)
+
+
+if __name__ == '__main__':
+  unittest.main()
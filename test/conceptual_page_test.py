@@ -56,6 +56,35 @@ class MyTestCase(unittest.TestCase):
       test_page.update_column(config.INDIRECTION_COLUMN ,i, i + 1)
       self.assertEqual(i + 1, test_page.read_metadata_at(i)[config.INDIRECTION_COLUMN])
 
+  def test_read_records(self):
+    test_page = ConceptualPage(2)
+    for i in range(2000):
+      test_page.write_record([i, i, i, i, 2 * i, 3 * i])
+
+    # Slots come back in the order they were asked for, even across physical pages
+    slots = [1999, 3, 600, 4, 1024]
+    columns = test_page.read_records(slots, [0, 1])
+    self.assertEqual(len(columns), 6)
+    self.assertEqual(columns[config.RID_COLUMN], slots)
+    self.assertIsNone(columns[config.NUM_META_COLUMNS])
+    self.assertEqual(columns[config.NUM_META_COLUMNS + 1], [3 * slot for slot in slots])
+    with self.assertRaises(IndexError):
+      test_page.read_records([2000], [1, 1])
+
+  def test_scan_column(self):
+    test_page = ConceptualPage(2)
+    for i in range(1500):
+      test_page.write_record([0, i, 0, 0, i, 2 * i])
+
+    # One view per physical page that was touched
+    views = list(test_page.scan_column(config.NUM_META_COLUMNS + 1))
+    self.assertEqual([len(view) for view in views], [512, 512, 476])
+    self.assertEqual(sum(sum(view) for view in views), sum(2 * i for i in range(1500)))
+
+    # Scans can start and stop in the middle of a physical page
+    values = [value for view in test_page.scan_column(config.RID_COLUMN, 500, 530) for value in view]
+    self.assertEqual(values, list(range(500, 530)))
+
   def test_load_and_dump_files(self):
     test_conceptual_page = ConceptualPage(2)
 
@@ -1,8 +1,12 @@
 import sys
 import os
 import shutil # For removing the directory
+import subprocess
+import tempfile
 
-from lstore.db import Database
+import lstore.config as config
+from lstore.db import Database, write_json_atomically
+from lstore.query import Query
 
 sys.path.append('../lstore')
 
@@ -19,6 +23,239 @@ class MyTestCase(unittest.TestCase):
 
     shutil.rmtree('./ECS165') # clean up
 
+  def test_checkpoint(self):
+    with tempfile.TemporaryDirectory() as directory:
+      db = Database()
+      db.open(directory)
+      query = Query(db.create_table("Grades", 3, 0))
+      for i in range(1000):
+        query.insert(i, i, i)
+      for i in range(0, 1000, 10):
+        query.update(i, None, -i, None)
+      marker = db.checkpoint()
+      self.assertEqual(marker["sequence"], 1)
+      self.assertEqual(marker["tables"]["Grades"]["rid"], 1101)
+
+      # Changes after the checkpoint are lost in a crash, so we stop without closing
+      query.insert(5000, 1, 1)
+      db.stop_checkpoints()
+      db.bufferpool.stop_flusher()
+
+      db = Database()
+      db.open(directory)
+      self.assertEqual(db.last_checkpoint, marker)
+      table = db.get_table("Grades")
+      self.assertEqual(table.rid, 1101)
+      query = Query(table)
+      self.assertEqual(query.sum(0, 999, 1), sum(-i if i % 10 == 0 else i for i in range(1000)))
+      self.assertFalse(query.select(5000, 0, [1, 1, 1]))
+      db.close()
+
+
+  def test_killed_after_checkpoint(self):
+    # A separate process keeps updating and inserting after a checkpoint, with the background flusher and eviction
+    # writing its pages out, until it gets killed. Reopening has to give back exactly the checkpoint
+    child = """
+import sys
+import lstore.config as config
+config.FLUSH_INTERVAL = 0.01
+config.BUFFERPOOL_BYTES = 64 * 4096
+config.CHECKPOINT_INTERVAL = 0
+from lstore.db import Database
+from lstore.query import Query
+
+db = Database()
+db.open(sys.argv[1])
+table = db.create_table("Grades", 3, 0)
+query = Query(table)
+query.insert_many([[i, i, 0] for i in range(20000)])
+table.index.create_index(2)
+db.checkpoint()
+print("checkpoint", flush=True)
+i = 0
+while True:
+  query.update(i * 7 % 20000, None, None, i + 1)
+  query.insert(20000 + i, 0, 0)
+  i += 1
+  if i % 1000 == 0:
+    print("progress", flush=True)
+"""
+    with tempfile.TemporaryDirectory() as directory:
+      process = subprocess.Popen([sys.executable, "-c", child, directory], stdout=subprocess.PIPE, text=True,
+                                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+      try:
+        self.assertEqual(process.stdout.readline().strip(), "checkpoint")
+        for _ in range(3):
+          self.assertEqual(process.stdout.readline().strip(), "progress")
+      finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+      # Pages really did get written after the checkpoint
+      table_path = os.path.join(directory, "tables", "Grades")
+      self.assertTrue(any(".undo." in file_name for file_name in os.listdir(table_path)))
+
+      db = Database()
+      db.open(directory)
+      self.assertFalse(any(".undo." in file_name for file_name in os.listdir(table_path)))
+      table = db.get_table("Grades")
+      self.assertEqual(table.rid, 20001)
+      query = Query(table)
+      self.assertEqual(query.sum(0, 19999, 1), sum(range(20000)))
+      self.assertEqual(query.sum(0, 19999, 2), 0)
+      self.assertFalse(query.select(20000, 0, [1, 1, 1]))
+      self.assertEqual(len(table.index.locate(2, 0)), 20000)
+      for key in range(0, 20000, 7):
+        self.assertEqual(query.select(key, 0, [1, 1, 1])[0].columns, [key, key, 0])
+      # And it keeps working from there
+      query.update(7, None, None, 5)
+      self.assertEqual(query.sum(0, 19999, 2), 5)
+      db.close()
+
+  def test_killed_during_checkpoints(self):
+    # Same, but checkpoints keep being taken in the background so the kill can land in the middle of one. Whichever
+    # checkpoint was the last one to finish, the table has to be exactly the way it was at that point
+    child = """
+import sys
+import lstore.config as config
+config.FLUSH_INTERVAL = 0.01
+config.BUFFERPOOL_BYTES = 64 * 4096
+config.CHECKPOINT_INTERVAL = 0.02
+from lstore.db import Database
+from lstore.query import Query
+
+db = Database()
+db.open(sys.argv[1])
+table = db.create_table("Grades", 3, 0)
+query = Query(table)
+query.insert_many([[i, i, 0] for i in range(20000)])
+i = 0
+while True:
+  query.update(i * 7 % 20000, None, None, i + 1)
+  query.insert(20000 + i, 0, i + 1)
+  i += 1
+  if i % 1000 == 0:
+    print("progress", db.last_checkpoint["sequence"] if db.last_checkpoint else 0, flush=True)
+"""
+    with tempfile.TemporaryDirectory() as directory:
+      process = subprocess.Popen([sys.executable, "-c", child, directory], stdout=subprocess.PIPE, text=True,
+                                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+      try:
+        # Wait until a few checkpoints went by
+        for line in process.stdout:
+          if int(line.split()[1]) >= 3:
+            break
+      finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+      db = Database()
+      db.open(directory)
+      table = db.get_table("Grades")
+      self.assertEqual(table.rid, db.last_checkpoint["tables"]["Grades"]["rid"])
+      query = Query(table)
+      # Every insert i took RID 20000 + 2 * i + 2 and came right after the update that took RID 20000 + 2 * i + 1
+      inserted = (table.rid - 20001) // 2
+      updated = (table.rid - 20000) // 2
+      self.assertEqual(query.sum(20000, 10 ** 6, 2), sum(range(1, inserted + 1)))
+      self.assertFalse(query.select(20000 + inserted, 0, [1, 1, 1]))
+      latest = {}
+      for i in range(updated):
+        latest[i * 7 % 20000] = i + 1
+      self.assertEqual(query.sum(0, 19999, 2), sum(latest.values()))
+      for key in range(0, 20000, 13):
+        self.assertEqual(query.select(key, 0, [1, 1, 1])[0].columns, [key, key, latest.get(key, 0)])
+      db.close()
+
+  def test_killed_during_checkpoints_with_deletes(self):
+    # Deletes change the pages, the page directory and the index too, a checkpoint can't catch one halfway
+    child = """
+import sys
+import lstore.config as config
+config.FLUSH_INTERVAL = 0.01
+config.BUFFERPOOL_BYTES = 64 * 4096
+config.CHECKPOINT_INTERVAL = 0.02
+from lstore.db import Database
+from lstore.query import Query
+
+db = Database()
+db.open(sys.argv[1])
+table = db.create_table("Grades", 3, 0)
+query = Query(table)
+query.insert_many([[i, i, 0] for i in range(20000)])
+table.index.create_index(1)
+db.checkpoint()
+for i in range(20000):
+  query.delete(i)
+  if i % 500 == 0:
+    print("progress", db.last_checkpoint["sequence"] if db.last_checkpoint else 0, flush=True)
+"""
+    with tempfile.TemporaryDirectory() as directory:
+      process = subprocess.Popen([sys.executable, "-c", child, directory], stdout=subprocess.PIPE, text=True,
+                                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+      try:
+        # A few checkpoints after the deletes started
+        first = None
+        for line in process.stdout:
+          sequence = int(line.split()[1])
+          first = sequence if first is None else first
+          if sequence >= first + 3:
+            break
+      finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+      db = Database()
+      db.open(directory)
+      table = db.get_table("Grades")
+      query = Query(table)
+      # Keys are deleted in order, so whatever is left is every key from some point on
+      keys = list(table.index.indices[0].keys())
+      self.assertTrue(keys)
+      self.assertEqual(keys, list(range(keys[0], 20000)))
+      self.assertEqual(list(table.index.indices[1].keys()), keys)
+      # And the pages agree with the index: exactly those records still have their RID
+      live = 0
+      for page_range_index in range(table.page_ranges_index + 1):
+        with db.bufferpool.get_frame(table.name, page_range_index, table.num_columns) as frame:
+          live += sum(sum(1 for rid in view if rid) for view in frame.page_range.scan_column(config.RID_COLUMN))
+      self.assertEqual(live, len(keys))
+      self.assertEqual(query.select(keys[0], 0, [1, 1, 1])[0].columns, [keys[0], keys[0], 0])
+      self.assertFalse(query.select(keys[0] - 1, 0, [1, 1, 1]))
+      db.close()
+
+  def test_index_file(self):
+    with tempfile.TemporaryDirectory() as directory:
+      db = Database()
+      db.open(directory)
+      table = db.create_table("Grades", 3, 0)
+      query = Query(table)
+      query.insert_many([[i, i % 3, i % 300] for i in range(3000)])
+      table.index.create_index(1)
+      table.index.create_index(2)
+      expected = [{key: list(table.index.locate(column, key)) for key in table.index.indices[column]}
+                  for column in range(3)]
+      db.close()
+      self.assertTrue(os.path.exists(os.path.join(directory, "tables", "Gradesindex.bin")))
+
+      def located(index):
+        return [{key: list(index.locate(column, key)) for key in index.indices[column]} for column in range(3)]
+
+      db = Database()
+      db.open(directory)
+      table = db.get_table("Grades")
+      self.assertEqual(located(table.index), expected)
+
+      # Databases saved with the JSON index still open
+      os.remove(os.path.join(directory, "tables", "Gradesindex.bin"))
+      write_json_atomically(os.path.join(directory, "tables", "Gradesindex.json"), table.index.to_arr())
+      self.assertEqual(located(db.get_table("Grades").index), expected)
+      db.close()
+      self.assertFalse(os.path.exists(os.path.join(directory, "tables", "Gradesindex.json")))
+
 
 if __name__ == '__main__':
   unittest.main()
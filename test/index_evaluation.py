@@ -0,0 +1,88 @@
+import sys
+import os
+import random
+import tempfile
+import time
+
+from BTrees.OOBTree import OOBTree
+
+# par dir for path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lstore.bufferpool import BufferPool
+from lstore.query import Query
+from lstore.table import Table
+
+# How create_index used to build an index, a select per primary key and one tree insert per record.
+# Kept here so the numbers can be compared side by side
+def select_build(table, column_number):
+  query = Query(table)
+  tree = OOBTree()
+  for key in table.index.indices[table.key].keys():
+    for record in query.select(key, table.key, [1] * table.num_columns):
+      value = record.columns[column_number]
+      if value not in tree:
+        tree[value] = set()
+      tree[value].add(record.rid)
+  return tree
+
+def build_table(directory, num_records, num_columns=5):
+  table = Table("test", num_columns, 0, BufferPool(directory))
+  query = Query(table)
+  query.insert_many([[key] + [key % 1000] * (num_columns - 1) for key in range(num_records)])
+  # Every tenth record gets an update so some values come from tail records
+  for key in range(0, num_records, 10):
+    query.update(key, *[None, None, key % 997, None, None])
+  return table
+
+def evaluate(num_records=1000000, column_number=2):
+  with tempfile.TemporaryDirectory() as directory:
+    print(f"Building a table with {num_records} records...")
+    table = build_table(directory, num_records)
+
+    start_time = time.perf_counter()
+    old_tree = select_build(table, column_number)
+    old_duration = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    table.index.create_index(column_number)
+    new_duration = time.perf_counter() - start_time
+
+    new_tree = table.index.indices[column_number]
+    assert list(old_tree.keys()) == list(new_tree.keys())
+    assert all(old_tree[key] == set(table.index.locate(column_number, key)) for key in old_tree.keys())
+
+    print(f"{'build':<16}{'seconds':>10}")
+    print(f"{'select per key':<16}{old_duration:>10.2f}")
+    print(f"{'page range scan':<16}{new_duration:>10.2f}")
+    print(f"speedup {old_duration / new_duration:.1f}x")
+
+def point_lookups(function, keys):
+  # microseconds per lookup
+  start_time = time.perf_counter()
+  for key in keys:
+    function(key)
+  return (time.perf_counter() - start_time) / len(keys) * 1e6
+
+def evaluate_hash(num_records=1000000, num_lookups=100000):
+  with tempfile.TemporaryDirectory() as directory:
+    print(f"Building a table with {num_records} records...")
+    table = Table("test", 3, 0, BufferPool(directory))
+    query = Query(table)
+    # Same values in both columns, one gets a B-tree and the other a hash index
+    query.insert_many([[key, key * 7, key * 7] for key in range(num_records)])
+    table.index.create_index(1, kind="btree")
+    table.index.create_index(2, kind="hash")
+
+    keys = [key * 7 for key in random.Random(165).choices(range(num_records), k=num_lookups)]
+    print(f"{'index':<8}{'locate us':>12}{'select us':>12}")
+    for kind, column in (("btree", 1), ("hash", 2)):
+      locate_cost = point_lookups(lambda key: table.index.locate(column, key), keys)
+      select_cost = point_lookups(lambda key: query.select(key, column, [1, 0, 0]), keys)
+      print(f"{kind:<8}{locate_cost:>12.2f}{select_cost:>12.2f}")
+
+
+if __name__ == "__main__":
+  num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  evaluate(num_records)
+  evaluate_hash(num_records)
@@ -1,9 +1,12 @@
 import random
 import sys
+import tempfile
 from collections import defaultdict
 
 from persistent.mapping import default
 
+from lstore.bufferpool import BufferPool
+from lstore.index import Index
 from lstore.table import Table
 import lstore.config as config
 from lstore.query import Query
@@ -62,6 +65,17 @@ class MyTestCase(unittest.TestCase):
       index.delete(record)
       self.assertTrue(pk not in index.indices[0])
 
+  def test_locate_range(self):
+    # Only the index gets used, no page ranges are needed
+    table = Table("test_table", 3, 0, None)
+    index = table.index
+    for rid, pk in enumerate([5, 10, 10 ** 9, 20, 15], 1):
+      index.add(self.__record_builder(rid, pk, 2, 3))
+    # Both ends are included and only keys that exist come back
+    self.assertEqual(sorted(index.locate_range(10, 20, 0)), [2, 4, 5])
+    self.assertEqual(sorted(index.locate_range(0, 10 ** 12, 0)), [1, 2, 3, 4, 5])
+    self.assertEqual(index.locate_range(21, 10 ** 8, 0), [])
+
   def test_add_and_delete_duplicates(self):
     table = Table("test_table", 3, 0)
     index = table.index
@@ -94,7 +108,7 @@ class MyTestCase(unittest.TestCase):
         self.assertTrue(pk not in index.indices[0])
       else:
         # RID should not be in the set anymore
-        self.assertTrue(rid not in index.indices[0][pk])
+        self.assertTrue(rid not in index.locate(0, pk))
 
   def test_create_index(self):
     table = Table("test_table", 3, 0)
@@ -121,6 +135,43 @@ class MyTestCase(unittest.TestCase):
         # make sure that key with indexed on is in the columns
         self.assertEqual(record.columns[2], key)
 
+  def test_create_index_sees_latest_values(self):
+    with tempfile.TemporaryDirectory() as directory:
+      table = Table("test_table", 3, 0, BufferPool(directory))
+      query = Query(table)
+      query.insert_many([[pk, pk % 7, pk % 3] for pk in range(10000)])
+      for pk in range(0, 10000, 5):
+        query.update(pk, *[None, None, 100 + pk % 4])
+      query.update(1, *[None, 50, None])
+      for pk in range(0, 10000, 11):
+        query.delete(pk)
+
+      table.index.create_index(2)
+      expected = defaultdict(set)
+      for pk in range(10000):
+        for record in query.select(pk, 0, [1, 1, 1]):
+          expected[record.columns[2]].add(record.rid)
+      self.assertEqual({key: set(table.index.locate(2, key)) for key in table.index.indices[2]}, expected)
+
+  def test_hash_index(self):
+    with tempfile.TemporaryDirectory() as directory:
+      table = Table("test_table", 3, 0, BufferPool(directory))
+      query = Query(table)
+      query.insert_many([[pk, pk % 7, pk % 3] for pk in range(1000)])
+      table.index.create_index(1, kind="hash")
+      table.index.create_index(2)
+      self.assertEqual(table.index.kind(table.index.indices[1]), "hash")
+
+      query.update(5, *[None, 100, None])
+      self.assertEqual([record.columns for record in query.select(100, 1, [1, 1, 1])], [[5, 100, 2]])
+      self.assertEqual(sorted(table.index.locate(1, 3)), [pk + 1 for pk in range(1000) if pk % 7 == 3])
+      self.assertRaises(Exception, table.index.locate_range, 0, 10, 1)
+
+      # The kind is saved with the index
+      loaded = Index.from_bytes(table, table.index.to_bytes())
+      self.assertEqual([loaded.kind(tree) for tree in loaded.indices], ["btree", "hash", "btree"])
+      self.assertEqual(list(loaded.locate(1, 100)), [6])
+
   def test_index_after_updates(self):
     table = Table("test_table", 3, 0)
     query = Query(table)
@@ -0,0 +1,70 @@
+import sys
+import os
+import time
+
+# par dir for path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lstore.page import Page, SLOTS_PER_PAGE
+
+# The bytearray page we used before switching to array('q'). Kept here so the numbers can be compared side by side
+class BytearrayPage:
+
+  def __init__(self):
+    self.data = bytearray(4096)
+
+  def write(self, value, slot):
+    val_to_byte = value.to_bytes(8, byteorder='big')
+    i = slot * 8
+    for byte in val_to_byte:
+      self.data[i] = byte
+      i += 1
+
+  def read(self, slot):
+    return int.from_bytes(self.data[slot * 8: (slot + 1) * 8], byteorder='big')
+
+def time_per_slot(function, rounds):
+  start_time = time.perf_counter()
+  for _ in range(rounds):
+    function()
+  duration = time.perf_counter() - start_time
+  # nanoseconds per slot
+  return duration / (rounds * SLOTS_PER_PAGE) * 1e9
+
+def evaluate(rounds=200):
+  values = list(range(SLOTS_PER_PAGE))
+  slots = range(SLOTS_PER_PAGE)
+  old_page = BytearrayPage()
+  new_page = Page()
+
+  def old_write():
+    for slot in slots:
+      old_page.write(values[slot], slot)
+
+  def old_read():
+    for slot in slots:
+      old_page.read(slot)
+
+  def new_write():
+    for slot in slots:
+      new_page.write(values[slot], slot)
+
+  def new_read():
+    for slot in slots:
+      new_page.read(slot)
+
+  results = [
+    ("write", time_per_slot(old_write, rounds), time_per_slot(new_write, rounds)),
+    ("read", time_per_slot(old_read, rounds), time_per_slot(new_read, rounds)),
+    ("write_many", None, time_per_slot(lambda: new_page.write_many(0, values), rounds)),
+    ("read_many", None, time_per_slot(lambda: new_page.read_many(slots), rounds)),
+  ]
+
+  print(f"{'operation':<12}{'bytearray ns/slot':>20}{'array ns/slot':>16}")
+  for name, old_cost, new_cost in results:
+    old_cost = f"{old_cost:.1f}" if old_cost is not None else "-"
+    print(f"{name:<12}{old_cost:>20}{new_cost:>16.1f}")
+
+
+if __name__ == "__main__":
+  evaluate()
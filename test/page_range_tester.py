@@ -20,6 +20,17 @@ class MyTestCase(unittest.TestCase):
 
       self.assertFalse(test_page_range.has_base_page_capacity())
 
+    def test_write_base_records(self):
+      test_page_range = PageRange(2)
+      records = [[0, i, 0, 0, i, 2 * i] for i in range(70000)]
+      # Only 65536 records fit, the locations tell the caller how many made it in
+      locations = test_page_range.write_base_records(records)
+      self.assertEqual(len(locations), 65536)
+      self.assertFalse(test_page_range.has_base_page_capacity())
+      for i in [0, 511, 512, 4095, 4096, 65535]:
+        self.assertEqual(locations[i], (i // 4096, i % 4096))
+        self.assertEqual(records[i], test_page_range.read_base_record(*locations[i], [1, 1]))
+
     def test_write_and_read_tail_record(self):
       test_page_range = PageRange(2)
       for i in range(65536):
@@ -34,6 +45,23 @@ class MyTestCase(unittest.TestCase):
         index, slot = test_page_range.write_base_record([i, i, i, i, i, i])
         self.assertEqual([i, i], test_page_range.read_base_record(index, slot, [1, 1])[4:])
 
+    def test_read_base_and_tail_records(self):
+      test_page_range = PageRange(2)
+      base_locations = [test_page_range.write_base_record([0, i, 0, 0, i, 2 * i]) for i in range(9000)]
+      tail_locations = [test_page_range.write_tail_record([0, i, 0, 0, 3 * i, 4 * i]) for i in range(5000)]
+
+      wanted = [8999, 0, 4096, 17, 8192]
+      columns = test_page_range.read_base_records([base_locations[i] for i in wanted], [1, 0])
+      self.assertEqual(columns[config.RID_COLUMN], wanted)
+      self.assertEqual(columns[config.NUM_META_COLUMNS], wanted)
+      self.assertIsNone(columns[config.NUM_META_COLUMNS + 1])
+
+      wanted = [4999, 0, 4096, 17]
+      columns = test_page_range.read_tail_records([tail_locations[i] for i in wanted], [1, 1])
+      for i, record in enumerate(wanted):
+        self.assertEqual([column[i] for column in columns],
+                         test_page_range.read_tail_record(*tail_locations[record], [1, 1]))
+
     def test_update_for_both_records(self):
       test_page_range = PageRange(1)
       for i in range(8000):
@@ -48,6 +76,14 @@ class MyTestCase(unittest.TestCase):
         test_page_range.update_tail_record_column(b_index, b_slot, config.INDIRECTION_COLUMN, i + 1)
         self.assertEqual(i + 1, test_page_range.read_tail_record(t_index, t_slot, [0])[config.INDIRECTION_COLUMN])
 
+    def test_scan_column(self):
+      test_page_range = PageRange(1)
+      for i in range(10000):
+        test_page_range.write_base_record([0, i, 0, 0, i])
+
+      values = [value for view in test_page_range.scan_column(config.NUM_META_COLUMNS) for value in view]
+      self.assertEqual(values, list(range(10000)))
+
     def test_to_and_from_dict(self):
         test_page_range = PageRange(1)
         for i in range(3000):
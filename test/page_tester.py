@@ -2,8 +2,10 @@
 import sys
 sys.path.append('../lstore')
 
+import os
+import tempfile
 import unittest
-from page import Page
+from page import Page, MappedPage
 
 class MyTestCase(unittest.TestCase):
   def test_has_capacity(self):
@@ -36,6 +38,57 @@ class MyTestCase(unittest.TestCase):
       self.assertEqual(test_page.num_records, new_page.num_records)
       self.assertEqual(test_page.data, new_page.data)
 
+  def test_read_many_and_write_many(self):
+    test_page = Page()
+    test_page.write_many(0, list(range(512)))
+    self.assertEqual(test_page.read_many(range(512)), list(range(512)))
+    self.assertEqual(test_page.read_many([511, 0, 7]), [511, 0, 7])
+    # Bulk writes can start in the middle of the page
+    test_page.write_many(500, [1] * 12)
+    self.assertEqual(test_page.read_many(range(498, 512)), [498, 499] + [1] * 12)
+    with self.assertRaises(IndexError):
+      test_page.write_many(510, [1, 2, 3])
+
+  def test_disk_layout(self):
+    # The on disk format is 512 big endian 64 bit ints
+    test_page = Page()
+    test_page.write(906659671, 3)
+    raw = test_page.to_bytes()
+    self.assertEqual(len(raw), 4096)
+    self.assertEqual(int.from_bytes(raw[24:32], byteorder='big'), 906659671)
+    self.assertEqual(Page.from_bytes(raw).read(3), 906659671)
+
+  def test_mapped_page(self):
+    test_page = Page()
+    test_page.write_many(0, list(range(512)))
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "0.bin")
+      test_page.save(path)
+
+      mapped_page = MappedPage.from_file(path)
+      self.assertEqual(mapped_page.read_many(range(512)), list(range(512)))
+      # Writes go through the mapping and land in the file once the page is saved
+      mapped_page.write(1000, 5)
+      mapped_page.write_many(10, [7, 8])
+      mapped_page.save(path)
+      loaded_page = Page.from_dict(path)
+      self.assertEqual(loaded_page.read_many([5, 10, 11, 12]), [1000, 7, 8, 12])
+
+      # Views decode the big endian mapping into native ints, for just the slots asked for
+      view = mapped_page.view(4, 13)
+      self.assertEqual(view.tolist(), [4, 1000, 6, 7, 8, 9, 7, 8, 12])
+      self.assertEqual(sum(mapped_page.view()), sum(range(512)) - 5 + 1000 - 10 - 11 + 7 + 8)
+      view.release()
+      mapped_page.buffer.close()
+
+  def test_view(self):
+    test_page = Page()
+    test_page.write_many(0, list(range(512)))
+    view = test_page.view(100, 103)
+    self.assertEqual(view.tolist(), [100, 101, 102])
+    # Points straight at the page, no copy
+    test_page.write(7, 101)
+    self.assertEqual(view[1], 7)
 
 
 
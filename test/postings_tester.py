@@ -0,0 +1,58 @@
+import random
+import sys
+from array import array
+
+from lstore.postings import RidBitmap, posting_add, posting_remove, posting_rids, posting_from_rids
+import lstore.config as config
+
+sys.path.append('../lstore')
+
+import unittest
+
+
+class MyTestCase(unittest.TestCase):
+  def test_posting_grows_and_shrinks(self):
+    posting = posting_add(None, 7)
+    self.assertEqual(posting, 7)
+    posting = posting_add(posting, 3)
+    self.assertEqual(posting, array('q', [3, 7]))
+
+    rids = [3, 7]
+    for rid in range(100, 100 + config.POSTING_ARRAY_MAX):
+      posting = posting_add(posting, rid)
+      rids.append(rid)
+    # Past the limit it turns into a bitmap
+    self.assertIsInstance(posting, RidBitmap)
+    self.assertEqual(list(posting_rids(posting)), rids)
+
+    # And back down again once enough RIDs are gone
+    while len(rids) > config.POSTING_ARRAY_MAX // 2:
+      posting = posting_remove(posting, rids.pop())
+    self.assertIsInstance(posting, array)
+    while len(rids) > 1:
+      posting = posting_remove(posting, rids.pop())
+    self.assertEqual(posting, 3)
+    self.assertIsNone(posting_remove(posting, 3))
+    self.assertRaises(KeyError, posting_remove, 4, 3)
+
+  def test_bitmap(self):
+    rids = set(random.sample(range(1, 300000), 20000)) | set(range(70000, 80000))
+    bitmap = RidBitmap(rids)
+    self.assertEqual(len(bitmap), len(rids))
+    self.assertEqual(list(bitmap), sorted(rids))
+    # The dense chunk became a bitmap, the sparse ones are still arrays
+    self.assertIsInstance(bitmap.chunks[1], bytearray)
+    self.assertIsInstance(bitmap.chunks[4], array)
+
+    for rid in list(rids)[:5000]:
+      self.assertIn(rid, bitmap)
+      bitmap.remove(rid)
+      self.assertNotIn(rid, bitmap)
+      rids.remove(rid)
+    self.assertEqual(list(bitmap), sorted(rids))
+    self.assertRaises(KeyError, bitmap.remove, 0)
+    self.assertEqual(list(posting_from_rids(bitmap)), sorted(rids))
+
+
+if __name__ == '__main__':
+  unittest.main()
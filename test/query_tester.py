@@ -1,10 +1,14 @@
 import unittest
 
+import os
 import sys
+from datetime import datetime
 import random
+import tempfile
 from selectors import KqueueSelector
 
 from lstore.table import Table
+from lstore.index import Index
 import lstore.config as config
 from lstore.query import Query
 from lstore.bufferpool import BufferPool
@@ -38,7 +42,7 @@ class MyTestCase(unittest.TestCase):
       record_data = [pk, 2, 3]
       query.insert(*record_data)
       # Check index has the right value
-      self.assertTrue(rid in index.indices[0][pk])
+      self.assertTrue(rid in index.locate(0, pk))
       self.assertTrue(rid in page_directory) # Not going to check  the values of this just yet
       # This is an actual record object
       record = query.select(pk, 0, [1, 1, 1])[0]
@@ -58,6 +62,57 @@ class MyTestCase(unittest.TestCase):
     for i, record in enumerate(records):
       self.assertEqual(records_data[i], record.columns)
 
+  def test_insert_many(self):
+    bp = BufferPool("testbp")
+    table = Table("test", 3, 0, bp)
+    query = Query(table)
+    # Enough rows to spill into a second page range, passed in as a generator
+    self.assertEqual(query.insert_many([pk, pk * 2, 3] for pk in range(70000)), 70000)
+    self.assertEqual(table.page_ranges_index, 1)
+    for pk in [0, 4095, 4096, 65535, 65536, 69999]:
+      self.assertEqual(query.select(pk, 0, [1, 1, 1])[0].columns, [pk, pk * 2, 3])
+
+    # Rows insert would reject are skipped: existing keys, repeated keys and the wrong number of columns
+    self.assertEqual(query.insert_many([[5, 0, 0], [70000, 1, 1], [70000, 2, 2], [70001, 1]]), 1)
+    self.assertEqual(query.select(70000, 0, [1, 1, 1])[0].columns, [70000, 1, 1])
+    self.assertEqual(query.select(5, 0, [1, 1, 1])[0].columns, [5, 10, 3])
+
+  def test_lazy_record(self):
+    bp = BufferPool("testbp")
+    table = Table("test", 3, 0, bp)
+    query = Query(table)
+    query.insert(1, 2, 3)
+    query.update(1, *[None, None, 30])
+
+    record = query.select(1, 0, [0, 1, 1])[0]
+    self.assertEqual(record.rid, 1)
+    self.assertEqual(record.indirection, 2)
+    self.assertEqual(record.schema_encoding, [0, 0, 1])
+    self.assertTrue(isinstance(record.timestamp, datetime))
+    self.assertEqual(record.columns, [None, 2, 30])
+    # entire_record keeps the base record's columns like Record did
+    self.assertEqual(record.entire_record[config.NUM_META_COLUMNS:], [None, 2, 3])
+    with self.assertRaises(AttributeError):
+      record.something_else = 1
+
+  def test_lazy_record_after_eviction(self):
+    # Its own directory, the eviction writes the page range to disk
+    with tempfile.TemporaryDirectory() as directory:
+      bp = BufferPool(directory, capacity=1)
+      query = Query(Table("test", 3, 0, bp))
+      other_query = Query(Table("other", 3, 0, bp))
+      query.insert(1, 2, 3)
+      other_query.insert(1, 5, 6)
+
+      record = query.select(1, 0, [1, 1, 1])[0]
+      # Its page range gets evicted before the columns are used, they were already read while it was pinned
+      other_query.select(1, 0, [1, 1, 1])
+      self.assertNotIn(0, bp.frames["test"])
+      # Nothing is read from disk anymore
+      os.remove(os.path.join(directory, "tables", "test", "0.seg"))
+      self.assertEqual(record.columns, [1, 2, 3])
+      self.assertEqual(bp.resident_pages, len(bp.page_frames))
+
   def test_select_version_with_no_updates(self):
     bp = BufferPool("testbp")
     # Testing how the method works when we only have one version of a record
@@ -150,6 +205,106 @@ class MyTestCase(unittest.TestCase):
     query.undo_insert(1,1,True)
     self.assertTrue(len(query.select(1, 0 , [1,1,1])) == 0)
 
+  def test_update_index_maintenance(self):
+    bp = BufferPool("testbp")
+    table = Table("test", 3, 0, bp)
+    query = Query(table)
+    index = table.index
+    for pk in range(10):
+      query.insert(pk, pk % 2, pk)
+    index.create_index(1)
+
+    # Nothing indexed changes, so the update doesn't need to select anything
+    selects = []
+    select = query.select
+    query.select = lambda *args: selects.append(args) or select(*args)
+    query.update(3, *[3, None, 30])
+    self.assertEqual(selects, [])
+    query.select = select
+
+    query.update(3, *[None, 0, None])
+    query.update(4, *[None, 0, 40])
+    # The RID of key 3 (4) moved from 1 to 0, key 4 already had a 0
+    self.assertEqual(sorted(index.locate(1, 0)), [1, 3, 4, 5, 7, 9])
+    self.assertEqual(sorted(index.locate(1, 1)), [2, 6, 8, 10])
+    query.update(5, *[None, 7, None])
+    query.update(5, *[None, 8, None])
+    self.assertIsNone(index.locate(1, 7))
+    self.assertEqual(list(index.locate(1, 8)), [6])
+    self.assertEqual(query.select(8, 1, [1, 1, 1])[0].columns, [5, 8, 5])
+
+  def test_delete_updated_indexed_record(self):
+    bp = BufferPool("testbp")
+    table = Table("test", 3, 0, bp)
+    query = Query(table)
+    index = table.index
+    for pk in range(5):
+      query.insert(pk, pk, 1)
+    index.create_index(1)
+    index.create_covering_index([1])
+
+    # The index has 99 for key 2 (RID 3), the base record still has 2
+    query.update(2, *[None, 99, None])
+    self.assertTrue(query.delete(2))
+    self.assertIsNone(index.locate(0, 2))
+    self.assertIsNone(index.locate(1, 99))
+    self.assertIsNone(index.locate(1, 2))
+    self.assertNotIn(2, index.covering[1])
+    self.assertEqual(query.select(2, 0, [1, 1, 1]), [])
+
+    query.undo_delete(3)
+    self.assertEqual(list(index.locate(1, 99)), [3])
+    self.assertEqual(index.covering[1][2], 99)
+    self.assertEqual(query.select(99, 1, [1, 1, 1])[0].columns, [2, 99, 1])
+
+  def test_covering_sum(self):
+    bp = BufferPool("testbp")
+    table = Table("test", 3, 0, bp)
+    query = Query(table)
+    query.insert_many([[pk, pk, pk % 10] for pk in range(1000)])
+    query.update(5, *[None, 1000, None])
+    table.index.create_covering_index([1])
+
+    query.update(5, *[None, 2000, None])
+    query.insert(5000, 7, 7)
+    query.delete(6)
+    query.undo_delete(7)
+    query.undo_latest_update(6)
+    expected = sum(range(1000)) - 5 + 1000
+    self.assertEqual(sum(table.index.covering[1].values(0, 999)), expected)
+
+    # Answered without reading the page ranges, the answers are the same either way
+    bp.get_frame = None
+    self.assertEqual(query.sum(0, 999, 1), expected)
+    self.assertEqual(query.sum(0, 10 ** 9, 1), expected + 7)
+    self.assertFalse(query.sum(1001, 4999, 1))
+    del bp.get_frame
+    self.assertEqual(query.sum_version(0, 999, 1, -1), expected - 1000 + 5)
+    # Saved with the rest of the index
+    loaded = Index.from_bytes(table, table.index.to_bytes())
+    self.assertEqual(list(loaded.covering[1].items()), list(table.index.covering[1].items()))
+    table.index.covering = {}
+    self.assertEqual(query.sum(0, 999, 1), expected)
+
+  def test_sum_sparse_range(self):
+    bp = BufferPool("testbp")
+    table = Table("test", 3, 0, bp)
+    query = Query(table)
+    # Keys spread far apart, the sum should only visit these and not every number in between
+    keys = [i * 10 ** 6 for i in range(50)]
+    for key in keys:
+      query.insert(key, key // 10 ** 6, 1)
+    query.update(keys[3], *[None, 100, None])
+    query.update(keys[3], *[None, 200, None])
+    query.delete(keys[4])
+
+    expected = sum(range(50)) - 3 - 4
+    self.assertEqual(query.sum(0, 10 ** 9, 1), expected + 200)
+    self.assertEqual(query.sum_version(0, 10 ** 9, 1, -1), expected + 100)
+    self.assertEqual(query.sum_version(0, 10 ** 9, 1, -2), expected + 3)
+    self.assertEqual(query.sum(keys[10], keys[19], 2), 10)
+    self.assertFalse(query.sum(1, 10 ** 6 - 1, 1))
+
 
 
 
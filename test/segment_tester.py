@@ -0,0 +1,172 @@
+import json
+import os
+import sys
+import tempfile
+
+from lstore.page import Page
+from lstore.page_range import PageRange
+from lstore.segment import SegmentFile, convert_table
+import lstore.config as config
+
+sys.path.append('../lstore')
+
+import unittest
+
+
+class MyTestCase(unittest.TestCase):
+  def __fill_page_range(self):
+    test_page_range = PageRange(2)
+    for i in range(6000):
+      test_page_range.write_base_record([0, i, i, 0, i, 2 * i])
+    for i in range(1000):
+      test_page_range.write_tail_record([0, i, i, 0, 3 * i, 4 * i])
+    return test_page_range
+
+  def __assert_same_records(self, test_page_range, new_page_range):
+    self.assertEqual(test_page_range.to_dict(), new_page_range.to_dict())
+    for i in range(6000):
+      self.assertEqual(test_page_range.read_base_record(i // 4096, i % 4096, [1, 1]),
+                       new_page_range.read_base_record(i // 4096, i % 4096, [1, 1]))
+    for i in range(1000):
+      self.assertEqual(test_page_range.read_tail_record(0, i, [1, 1]), new_page_range.read_tail_record(0, i, [1, 1]))
+
+  def test_save_and_load_segment(self):
+    test_page_range = self.__fill_page_range()
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "0.seg")
+      test_page_range.save_segment(path)
+      new_page_range = PageRange.from_segment(path)
+      self.__assert_same_records(test_page_range, new_page_range)
+
+      # Pages are 4096 byte blocks after the header block
+      with SegmentFile(path) as segment:
+        self.assertEqual(segment.page_table_offset % 4096, 0)
+        self.assertEqual(segment.page_table_offset, segment.num_blocks * 4096)
+
+      # Saving again reuses the blocks, only the new physical pages are appended (two more levels of tail pages)
+      num_blocks = SegmentFile(path).num_blocks
+      for i in range(1000, 1600):
+        new_page_range.write_tail_record([0, i, i, 0, 3 * i, 4 * i])
+      new_page_range.save_segment(path)
+      self.assertEqual(SegmentFile(path).num_blocks, num_blocks + 2 * new_page_range.total_columns)
+      self.assertEqual([0, 1599, 1599, 0, 4797, 6396], PageRange.from_segment(path).read_tail_record(0, 1599, [1, 1]))
+
+  def test_page_table_is_never_overwritten(self):
+    test_page_range = self.__fill_page_range()
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "0.seg")
+      test_page_range.save_segment(path)
+
+      # A save that dies after writing its new pages but before its page table still leaves the old page table
+      with SegmentFile(path) as segment:
+        for _ in range(50):
+          segment.write_page(segment.allocate_block(), Page.from_bytes(b"\xff" * 4096))
+      self.__assert_same_records(test_page_range, PageRange.from_segment(path))
+
+      # Saving with nothing new puts the page table somewhere else than the one the header points to
+      with SegmentFile(path) as segment:
+        offset = segment.page_table_offset
+      test_page_range.save_segment(path)
+      with SegmentFile(path) as segment:
+        self.assertNotEqual(segment.page_table_offset, offset)
+        self.assertEqual(os.path.getsize(path), segment.page_table_offset + segment.page_table_length)
+      self.__assert_same_records(test_page_range, PageRange.from_segment(path))
+
+  def test_segment_without_page_table(self):
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "0.seg")
+      # Cut off before the first page table was written: a block and a header, nothing else
+      with SegmentFile(path) as segment:
+        segment.write_page(segment.allocate_block(), Page())
+      self.assertRaises(Exception, PageRange.from_segment, path)
+      new_page_range = PageRange.from_segment(path, 2)
+      self.assertEqual(new_page_range.to_dict(), PageRange(2).to_dict())
+
+      # Saving it again gives a normal segment
+      new_page_range.write_base_record([0, 1, 0, 0, 7, 8])
+      new_page_range.save_segment(path)
+      self.assertEqual([0, 1, 0, 0, 7, 8], PageRange.from_segment(path).read_base_record(0, 0, [1, 1]))
+
+  def test_only_dirty_pages_are_written(self):
+    test_page_range = self.__fill_page_range()
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "0.seg")
+      first_save = test_page_range.save_segment(path)
+      # Nothing changed, so only the header and page table get rewritten
+      page_table_bytes = test_page_range.save_segment(path)
+      self.assertLess(page_table_bytes, 4096 * 2)
+
+      test_page_range.update_base_record_column(1, 10, config.INDIRECTION_COLUMN, 99)
+      self.assertEqual(test_page_range.save_segment(path), 4096 + page_table_bytes)
+      self.assertGreater(first_save, 80 * 4096)
+      self.assertEqual(99, PageRange.from_segment(path).read_base_record(1, 10, [0, 0])[config.INDIRECTION_COLUMN])
+
+  def test_columns_load_lazily(self):
+    test_page_range = self.__fill_page_range()
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "0.seg")
+      test_page_range.save_segment(path)
+      new_page_range = PageRange.from_segment(path)
+      base_page = new_page_range.base_pages[0]
+      self.assertFalse(any(base_page.pages.is_loaded(column) for column in range(base_page.total_columns)))
+
+      # Only the metadata columns and the projected column get read
+      self.assertEqual([0, 7, 7, 0, None, 14], new_page_range.read_base_record(0, 7, [0, 1]))
+      self.assertEqual([base_page.pages.is_loaded(column) for column in range(base_page.total_columns)],
+                       [True, True, True, True, False, True])
+
+      # Saving doesn't load the other columns either
+      new_page_range.save_segment(path)
+      self.assertFalse(base_page.pages.is_loaded(config.NUM_META_COLUMNS))
+      self.__assert_same_records(test_page_range, PageRange.from_segment(path))
+
+  def test_mapped_segment(self):
+    test_page_range = self.__fill_page_range()
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "0.seg")
+      test_page_range.save_segment(path)
+
+      config.MMAP_PAGES = True
+      try:
+        mapped_page_range = PageRange.from_segment(path)
+      finally:
+        config.MMAP_PAGES = False
+      self.__assert_same_records(test_page_range, mapped_page_range)
+
+      mapped_page_range.update_base_record_column(0, 10, config.INDIRECTION_COLUMN, 99)
+      mapped_page_range.save_segment(path)
+      self.assertEqual(99, PageRange.from_segment(path).read_base_record(0, 10, [0, 0])[config.INDIRECTION_COLUMN])
+
+  def test_convert_table(self):
+    test_page_range = self.__fill_page_range()
+    with tempfile.TemporaryDirectory() as directory:
+      # Old layout: 0.json next to a 0/ folder full of conceptual pages
+      os.makedirs(os.path.join(directory, "0"))
+      with open(os.path.join(directory, "0.json"), "w") as file:
+        json.dump(test_page_range.to_dict(), file)
+      test_page_range.save_contents(os.path.join(directory, "0"))
+
+      self.assertEqual(convert_table(directory), 1)
+      self.assertEqual(os.listdir(directory), ["0.seg"])
+      self.__assert_same_records(test_page_range, PageRange.from_segment(os.path.join(directory, "0.seg")))
+
+  def test_convert_table_with_many_columns(self):
+    # 7 data columns make 11 with the metadata ones, col10 has to come after col9
+    test_page_range = PageRange(7)
+    for i in range(1000):
+      test_page_range.write_base_record([0, i, i, 0] + [i * 10 + column for column in range(7)])
+    with tempfile.TemporaryDirectory() as directory:
+      os.makedirs(os.path.join(directory, "0"))
+      with open(os.path.join(directory, "0.json"), "w") as file:
+        json.dump(test_page_range.to_dict(), file)
+      test_page_range.save_contents(os.path.join(directory, "0"))
+
+      self.assertEqual(convert_table(directory), 1)
+      new_page_range = PageRange.from_segment(os.path.join(directory, "0.seg"))
+      for i in range(0, 1000, 7):
+        self.assertEqual(new_page_range.read_base_record(0, i, [1] * 7),
+                         test_page_range.read_base_record(0, i, [1] * 7))
+
+
+if __name__ == '__main__':
+  unittest.main()